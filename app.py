@@ -1,14 +1,31 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-import requests
 import json
 import os
 import time
 import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import logging
 from werkzeug.utils import secure_filename
 from config import config
+from moonraker import (MoonrakerClient, MoonrakerSubscription, WEBSOCKET_AVAILABLE, iter_chunks,
+                       objects_query, uploaded_item)
+from storage import Storage
+from jobs import JobStore, JobNotFound, JobConflict, can_transition, check_transition
+from scheduler import JobDispatcher, ACTIVE_COPY_STATES
+from eta import PrintTimeEstimator
+from distribution import FileDistributor
+from library import FileLibrary, file_type
+from gcode_analyzer import GcodeAnalyzer, format_duration
+from webcam import WebcamProxy, THUMBNAIL_MIN_WIDTH, THUMBNAIL_MAX_WIDTH
+from file_index import FileIndex
+from compression import COMPRESSIBLE_TYPES, choose_encoding, compress
+from telemetry import TelemetryStore, TelemetryRecorder, METRICS
+from reports import FleetReports, REPORTS, day_range, stream_csv, stream_xlsx
+from metrics import (REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_REQUEST_SECONDS,
+                     POLLER_CYCLE_SECONDS, ProfilingMiddleware)
 
 # Определение конфигурации
 config_name = os.environ.get('FLASK_ENV', 'default')
@@ -21,6 +38,11 @@ app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB
 
 CORS(app, origins=app.config['CORS_ORIGINS'])
 
+# Профилирование запросов (cProfile, сохраняются запросы дольше PROFILE_MIN_MS)
+if app.config['PROFILE_REQUESTS']:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, app.config['PROFILE_DIR'],
+                                       min_duration=app.config['PROFILE_MIN_MS'] / 1000)
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
@@ -29,11 +51,25 @@ UPLOAD_FOLDER = app.config['UPLOAD_FOLDER']
 ALLOWED_EXTENSIONS = app.config['ALLOWED_EXTENSIONS']
 PRINTERS_FILE = app.config['PRINTERS_FILE']
 PRINT_JOBS_FILE = app.config['PRINT_JOBS_FILE']
+STATUS_UPDATE_INTERVAL = app.config['STATUS_UPDATE_INTERVAL']
+REQUEST_TIMEOUT = app.config['REQUEST_TIMEOUT']
+UPLOAD_MIN_BANDWIDTH = app.config['UPLOAD_MIN_BANDWIDTH']
+STATUS_POLL_WORKERS = app.config['STATUS_POLL_WORKERS']
+MOONRAKER_WEBSOCKET = app.config['MOONRAKER_WEBSOCKET'] and WEBSOCKET_AVAILABLE
+STATUS_STREAM_MAX_RATE = app.config['STATUS_STREAM_MAX_RATE']
+COMPRESS_RESPONSES = app.config['COMPRESS_RESPONSES']
+COMPRESS_MIN_SIZE = app.config['COMPRESS_MIN_SIZE']
+SCHEDULER_AUTO_CONTINUE = app.config['SCHEDULER_AUTO_CONTINUE']
+SCHEDULER_MAX_RETRIES = app.config['SCHEDULER_MAX_RETRIES']
+DISTRIBUTION_WORKERS = app.config['DISTRIBUTION_WORKERS']
+FILE_LIST_REFRESH_INTERVAL = app.config['FILE_LIST_REFRESH_INTERVAL']
+BULK_ACTION_TIMEOUT = app.config['BULK_ACTION_TIMEOUT']
+BULK_ACTION_WORKERS = app.config['BULK_ACTION_WORKERS']
 
 # Создание папок если не существуют
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Файлы для хранения данных
+# Файлы для хранения данных (JSON используются только для первичной миграции)
 FILES_DB_FILE = os.path.join(os.path.dirname(__file__), 'data', 'files.json')
 USERS_DB_FILE = os.path.join(os.path.dirname(__file__), 'data', 'users.json')
 JOBS_DB_FILE = os.path.join(os.path.dirname(__file__), 'data', 'jobs.json')
@@ -41,16 +77,59 @@ JOBS_DB_FILE = os.path.join(os.path.dirname(__file__), 'data', 'jobs.json')
 # Создание папки data если не существует
 os.makedirs(os.path.dirname(FILES_DB_FILE), exist_ok=True)
 
+# Основное хранилище данных
+storage = Storage(app.config['DATABASE_FILE'])
+storage.migrate_json('printers', PRINTERS_FILE)
+storage.migrate_json('jobs', JOBS_DB_FILE)
+job_store = JobStore(storage)
+storage.migrate_json('files', FILES_DB_FILE)
+storage.migrate_json('users', USERS_DB_FILE, default=[
+    # Администратор по умолчанию
+    {
+        'id': 'admin-001',
+        'name': 'Администратор',
+        'email': 'admin@fcrm.local',
+        'role': 'admin',
+        'created': datetime.now().isoformat()
+    }
+])
+
+# Библиотека файлов (содержимое по SHA-256)
+library = FileLibrary(storage, os.path.join(UPLOAD_FOLDER, 'library'),
+                      compress_level=app.config['LIBRARY_COMPRESS_LEVEL'])
+library.adopt_legacy()
+
+def apply_file_metadata(sha256, analysis):
+    """Метаданные G-code в записях файлов и оценки времени в заданиях с этим файлом"""
+    metadata = {k: v for k, v in analysis.items() if k not in ('id', 'analyzed')}
+    estimated = metadata.get('estimated_time')
+    with storage.transaction():
+        names = set()
+        for file_info in storage.all('files'):
+            if file_info.get('sha256') == sha256:
+                storage.update('files', file_info['id'], {'metadata': metadata})
+                names.add(file_info['name'])
+        if estimated is None:
+            return
+        for job in storage.all('jobs'):
+            if (job['filename'] in names and job.get('estimated_seconds') is None
+                    and job['status'] in ('pending', 'running', 'paused')):
+                fields = {'estimated_seconds': estimated}
+                if job.get('estimated_time') in (None, format_duration(None)):
+                    fields['estimated_time'] = format_duration(estimated)
+                job_store.modify(job['id'], lambda job: job.update(fields))
+
+# Разбор метаданных G-code (время печати, филамент, слои, миниатюры)
+gcode_analyzer = GcodeAnalyzer(storage, os.path.join(UPLOAD_FOLDER, 'thumbnails'),
+                               max_workers=app.config['GCODE_ANALYZER_WORKERS'],
+                               on_analyzed=apply_file_metadata)
+
 # Загрузка данных принтеров
 def load_printers():
-    if os.path.exists(PRINTERS_FILE):
-        with open(PRINTERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    return storage.all('printers')
 
 def save_printers(printers):
-    with open(PRINTERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(printers, f, ensure_ascii=False, indent=2)
+    storage.replace_all('printers', printers)
 
 def load_print_jobs():
     if os.path.exists(PRINT_JOBS_FILE):
@@ -64,101 +143,293 @@ def save_print_jobs(jobs):
 
 # Функции для работы с файлами
 def load_files():
-    if os.path.exists(FILES_DB_FILE):
-        with open(FILES_DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    return storage.all('files')
 
 def save_files(files):
-    with open(FILES_DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(files, f, ensure_ascii=False, indent=2)
+    storage.replace_all('files', files)
 
 # Функции для работы с пользователями
 def load_users():
-    if os.path.exists(USERS_DB_FILE):
-        with open(USERS_DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    # Создаем администратора по умолчанию
-    default_users = [
-        {
-            'id': 'admin-001',
-            'name': 'Администратор',
-            'email': 'admin@fcrm.local',
-            'role': 'admin',
-            'created': datetime.now().isoformat()
-        }
-    ]
-    save_users(default_users)
-    return default_users
+    return storage.all('users')
 
 def save_users(users):
-    with open(USERS_DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    storage.replace_all('users', users)
 
 # Функции для работы с заданиями
-def load_jobs():
-    if os.path.exists(JOBS_DB_FILE):
-        with open(JOBS_DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+def load_jobs(status=None):
+    return storage.all('jobs', status)
 
 def save_jobs(jobs):
-    with open(JOBS_DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(jobs, f, ensure_ascii=False, indent=2)
+    storage.replace_all('jobs', jobs)
+
+def _same_status(old, new):
+    """Сравнение статусов без учета времени последнего опроса"""
+    if old is None:
+        return False
+    return ({k: v for k, v in old.items() if k != 'last_update'} ==
+            {k: v for k, v in new.items() if k != 'last_update'})
+
+def diff_status(old, new):
+    """Изменившиеся поля статуса (вложенно); удаленные поля передаются как None"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    delta = {}
+    for key, value in new.items():
+        if key not in old:
+            delta[key] = value
+        elif old[key] != value:
+            delta[key] = diff_status(old[key], value)
+    for key in old:
+        if key not in new:
+            delta[key] = None
+    return delta
+
+# Поля компактного статуса (?format=compact или выборка ?fields=state,progress,temps)
+COMPACT_FIELDS = ('online', 'state', 'filename', 'progress', 'duration', 'filament', 'layer',
+                  'temps', 'message', 'klippy', 'files_version', 'error', 'last_update')
+
+def compact_status(status, fields=COMPACT_FIELDS):
+    """Плоский статус для дашборда вместо структур Moonraker; пустые поля не передаются
+
+    Температуры - пары [текущая, целевая] с точностью до десятой градуса, поэтому
+    шум датчика не порождает лишних дельт в потоке статусов.
+    """
+    print_stats = status.get('print_stats') or {}
+    info = print_stats.get('info') or {}
+    temperature = status.get('temperature') or {}
+    progress = (status.get('virtual_sdcard') or {}).get('progress')
+    online = bool(status.get('online'))
+    values = {
+        'online': online,
+        'state': print_stats.get('state') if online else 'offline',
+        'filename': print_stats.get('filename') or None,
+        'progress': round(progress, 3) if progress is not None else None,
+        'duration': print_stats.get('print_duration'),
+        'filament': print_stats.get('filament_used'),
+        'layer': ([info.get('current_layer'), info.get('total_layer')]
+                  if info.get('total_layer') is not None else None),
+        'temps': {
+            name: [round(temperature[key].get('temperature') or 0, 1), temperature[key].get('target')]
+            for name, key in (('extruder', 'extruder'), ('bed', 'heater_bed')) if key in temperature
+        } or None,
+        'message': print_stats.get('message') or None,
+        'klippy': ((status.get('printer_info') or {}).get('result') or {}).get('state'),
+        'files_version': status.get('files_version'),
+        'error': status.get('error'),
+        'last_update': status.get('last_update'),
+    }
+    return {field: values[field] for field in fields if values[field] is not None}
+
+def status_view(args):
+    """Представление статуса по параметрам запроса (None - полный статус Moonraker)
+
+    ?fields=... - выборка полей компактного статуса, ?format=compact - все его поля.
+    Неизвестное поле - ValueError.
+    """
+    fields = args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in COMPACT_FIELDS]
+        if unknown:
+            raise ValueError(f"Неизвестные поля: {', '.join(unknown)}; доступны: {', '.join(COMPACT_FIELDS)}")
+        return lambda status: compact_status(status, fields)
+    if args.get('format') == 'compact':
+        return compact_status
+    return None
+
+# Команды управления печатью: действие -> (путь Moonraker, текст ошибки).
+# Общие для синхронного PrinterManager и асинхронного режима (asgi.py)
+PRINT_COMMANDS = {
+    'start': ('/printer/print/start', 'Ошибка запуска печати'),
+    'pause': ('/printer/print/pause', 'Ошибка паузы'),
+    'resume': ('/printer/print/resume', 'Ошибка возобновления'),
+    'cancel': ('/printer/print/cancel', 'Ошибка отмены'),
+    'ready': ('/printer/gcode/script', 'Ошибка сброса состояния'),
+    'led': ('/printer/gcode/script', 'Ошибка установки подсветки'),
+    'gcode': ('/printer/gcode/script', 'Ошибка выполнения G-code'),
+}
+
+# Действия, доступные в групповом управлении (POST /api/printers/bulk)
+BULK_ACTIONS = ('pause', 'resume', 'cancel', 'ready', 'led', 'gcode')
+
+def print_command(action, filename=None, state=None, script=None):
+    """Путь, тело запроса и текст ошибки для команды управления печатью"""
+    path, error = PRINT_COMMANDS[action]
+    body = None
+    if action == 'start':
+        body = {'filename': filename}
+    elif action == 'ready':
+        body = {'script': 'SDCARD_RESET_FILE'}
+    elif action == 'led':
+        body = led_script(state)
+    elif action == 'gcode':
+        body = {'script': script}
+    return path, body, error
+
+def parse_bulk_request(data):
+    """Проверка тела группового действия: (принтеры, действие, параметры, срок в секундах)
+
+    Без списка printers действие применяется ко всем принтерам. Неверный
+    запрос - ValueError с текстом для ответа 400.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Ожидается JSON-объект')
+    action = data.get('action')
+    if action not in BULK_ACTIONS:
+        raise ValueError(f"Неизвестное действие, доступны: {', '.join(BULK_ACTIONS)}")
+    
+    params = {}
+    if action == 'led':
+        params['state'] = parse_led_state(data.get('state'))
+    elif action == 'gcode':
+        script = data.get('script')
+        if not isinstance(script, str) or not script.strip():
+            raise ValueError('Не указан G-code (script)')
+        params['script'] = script
+    
+    printer_ids = data.get('printers')
+    if printer_ids is None:
+        printer_ids = [p['id'] for p in printer_manager.printers]
+    elif not isinstance(printer_ids, list):
+        raise ValueError('printers должен быть списком id')
+    
+    timeout = data.get('timeout', BULK_ACTION_TIMEOUT)
+    if not isinstance(timeout, (int, float)) or not 0 < timeout <= 60:
+        raise ValueError('timeout должен быть от 0 до 60 секунд')
+    return list(dict.fromkeys(printer_ids)), action, params, float(timeout)
+
+def parse_led_state(value):
+    """Яркость подсветки 0-255; true/false и 'on'/'off' - полная яркость или выключение"""
+    if isinstance(value, bool) or value in ('on', 'off'):
+        return 255 if value in (True, 'on') else 0
+    if isinstance(value, int) and 0 <= value <= 255:
+        return value
+    raise ValueError('state должен быть числом 0-255, true/false или on/off')
+
+def led_script(state):
+    """G-code установки яркости подсветки (0-255 по всем каналам)"""
+    return {'script': f'SET_LED LED=led RED={state} GREEN={state} BLUE={state}'}
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return any(filename.lower().endswith('.' + ext) for ext in ALLOWED_EXTENSIONS)
 
 class PrinterManager:
     def __init__(self):
-        self.printers = load_printers()
         self.print_jobs = load_print_jobs()
         self.printer_status = {}
+        self.status_lock = threading.Lock()
+        self.status_changed = threading.Condition(self.status_lock)
+        self.poller_thread = None
+        # Версия снимка парка: эпоха процесса + счетчик изменений
+        self.status_epoch = uuid.uuid4().hex[:8]
+        self.status_counter = 0
+        self.status_versions = {}
+        # Пул для параллельного опроса принтеров и отдельный пул для запросов
+        # к Moonraker внутри одного опроса (разделены, чтобы не было взаимной блокировки)
+        self.poll_executor = ThreadPoolExecutor(
+            max_workers=STATUS_POLL_WORKERS, thread_name_prefix='status-poll')
+        self.request_executor = ThreadPoolExecutor(
+            max_workers=STATUS_POLL_WORKERS * 2, thread_name_prefix='moonraker')
+        # Пул групповых команд (пауза/отмена всего парка и т.п.)
+        self.bulk_executor = ThreadPoolExecutor(
+            max_workers=BULK_ACTION_WORKERS, thread_name_prefix='bulk')
+        # Постоянные WebSocket-подписки на обновления статуса (по принтеру)
+        self.subscriptions = {}
+        # Списки файлов на принтерах (в статусе только версия)
+        self.file_index = FileIndex()
+        # HTTP-клиенты Moonraker с пулом соединений (по принтеру)
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        # Прогресс потоковых загрузок файлов на принтеры
+        self.uploads = {}
+        self.uploads_lock = threading.Lock()
         
     def add_printer(self, name, ip_address, port=7125):
         """Добавление нового принтера"""
-        printer = {
-            'id': f"ZB3D-{len(self.printers)+1:03d}",
-            'name': name,
-            'ip_address': ip_address,
-            'port': port,
-            'status': 'offline',
-            'last_seen': None,
-            'webcam_url': f"http://{ip_address}:8080/webcam/?action=stream",
-            'moonraker_url': f"http://{ip_address}:{port}"
-        }
-        self.printers.append(printer)
-        save_printers(self.printers)
+        with storage.transaction():
+            printer = {
+                'id': storage.next_id('printers', 'ZB3D'),
+                'name': name,
+                'ip_address': ip_address,
+                'port': port,
+                'status': 'offline',
+                'last_seen': None,
+                'webcam_url': f"http://{ip_address}:8080/webcam/?action=stream",
+                'moonraker_url': f"http://{ip_address}:{port}"
+            }
+            storage.insert('printers', printer)
         return printer
     
     def remove_printer(self, printer_id):
         """Удаление принтера"""
-        self.printers = [p for p in self.printers if p['id'] != printer_id]
-        save_printers(self.printers)
+        storage.delete('printers', printer_id)
+        webcam_proxy.remove(printer_id)
+        telemetry_store.remove_printer(printer_id)
+        self.file_index.remove(printer_id)
+        subscription = self.subscriptions.pop(printer_id, None)
+        if subscription is not None:
+            subscription.stop()
+        with self.clients_lock:
+            client = self.clients.pop(printer_id, None)
+        if client is not None:
+            client.close()
+        with self.status_lock:
+            self.printer_status.pop(printer_id, None)
+            self.status_versions.pop(printer_id, None)
+            self.status_counter += 1
+            self.status_changed.notify_all()
         return True
     
+    @property
+    def printers(self):
+        """Список принтеров из общего хранилища (изменения других процессов видны сразу)"""
+        return load_printers()
+    
+    def get_printer(self, printer_id):
+        return storage.get('printers', printer_id)
+    
+    def get_client(self, printer):
+        """HTTP-клиент Moonraker для принтера (создается при первом обращении)"""
+        with self.clients_lock:
+            client = self.clients.get(printer['id'])
+            if client is None or client.base_url != printer['moonraker_url'].rstrip('/'):
+                client = MoonrakerClient(
+                    printer['moonraker_url'],
+                    timeout=REQUEST_TIMEOUT,
+                    upload_bandwidth=UPLOAD_MIN_BANDWIDTH,
+                    name=printer['id']
+                )
+                self.clients[printer['id']] = client
+            return client
+    
     def get_printer_status(self, printer):
         """Получение статуса принтера через Moonraker API"""
         try:
-            base_url = printer['moonraker_url']
-            
-            # Получение информации о принтере
-            printer_info = requests.get(f"{base_url}/printer/info", timeout=5).json()
+            client = self.get_client(printer)
             
-            # Получение статуса печати
-            print_status = requests.get(f"{base_url}/printer/objects/query?print_stats", timeout=5).json()
+            # Информация о принтере и (если устарел) список файлов запрашиваются параллельно
+            info_future = self.request_executor.submit(
+                lambda: client.get("/printer/info").json())
+            files_future = None
+            if self.file_index.is_stale(printer['id'], FILE_LIST_REFRESH_INTERVAL):
+                files_future = self.request_executor.submit(
+                    lambda: client.get("/server/files/list").json())
             
-            # Получение информации о температуре
-            temp_info = requests.get(f"{base_url}/printer/objects/query?heater_bed&extruder", timeout=5).json()
+            # Статус печати, прогресс и температуры одним запросом objects/query
+            objects = client.get(
+                f"/printer/objects/query?{objects_query()}"
+            ).json()['result']['status']
             
-            # Получение информации о файлах
-            files_info = requests.get(f"{base_url}/server/files/list", timeout=5).json()
+            printer_info = info_future.result()
+            if files_future is not None:
+                self.file_index.replace(printer['id'], files_future.result()['result'])
             
             status = {
                 'printer_info': printer_info,
-                'print_stats': print_status['result']['status']['print_stats'],
-                'temperature': temp_info['result']['status'],
-                'files': files_info['result'],
+                'print_stats': objects['print_stats'],
+                'virtual_sdcard': objects.get('virtual_sdcard', {}),
+                'temperature': {k: objects[k] for k in ('heater_bed', 'extruder') if k in objects},
+                'files_version': self.file_index.version(printer['id']),
                 'last_update': datetime.now().isoformat(),
                 'online': True
             }
@@ -172,132 +443,337 @@ class PrinterManager:
                 'last_update': datetime.now().isoformat()
             }
     
-    def upload_file(self, printer_id, file):
-        """Загрузка файла на принтер"""
-        printer = next((p for p in self.printers if p['id'] == printer_id), None)
-        if not printer:
-            return {'error': 'Принтер не найден'}
-        
-        try:
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(file_path)
-            
-            # Загрузка файла на принтер через Moonraker
-            with open(file_path, 'rb') as f:
-                files = {'file': (filename, f, 'application/octet-stream')}
-                response = requests.post(
-                    f"{printer['moonraker_url']}/server/files/upload",
-                    files=files,
-                    timeout=30
+    def store_status(self, printer_id, status):
+        """Сохранение статуса в общий кэш с увеличением версии при изменении"""
+        with self.status_lock:
+            previous = self.printer_status.get(printer_id)
+            self.printer_status[printer_id] = status
+            if not _same_status(previous, status):
+                self.status_counter += 1
+                self.status_versions[printer_id] = self.status_counter
+                self.status_changed.notify_all()
+        return status
+    
+    def refresh_status(self, printer):
+        """Опрос принтера и сохранение статуса в общий кэш"""
+        return self.store_status(printer['id'], self.get_printer_status(printer))
+    
+    def refresh_all_statuses(self):
+        """Обновление кэша статусов для всех принтеров (параллельно, ограниченным пулом)"""
+        printers = self.printers
+        self.prune_statuses({p['id'] for p in printers})
+        self.sync_subscriptions(printers)
+        # Принтеры с активной WebSocket-подпиской обновляются push-уведомлениями
+        polled = [p for p in printers if not self.is_subscribed(p['id'])]
+        list(self.poll_executor.map(self.refresh_status, polled))
+    
+    def is_subscribed(self, printer_id):
+        subscription = self.subscriptions.get(printer_id)
+        return subscription is not None and subscription.available
+    
+    def prune_statuses(self, printer_ids):
+        """Удаление из кэша статусов принтеров, удаленных в других процессах"""
+        with self.status_lock:
+            removed = set(self.printer_status) - printer_ids
+            for printer_id in removed:
+                del self.printer_status[printer_id]
+                self.status_versions.pop(printer_id, None)
+            if removed:
+                self.status_counter += 1
+                self.status_changed.notify_all()
+    
+    def sync_subscriptions(self, printers):
+        """Запуск подписок для новых принтеров и остановка для удаленных"""
+        if not MOONRAKER_WEBSOCKET:
+            return
+        printers = {p['id']: p for p in printers}
+        for printer_id in list(self.subscriptions):
+            if printer_id not in printers:
+                self.subscriptions.pop(printer_id).stop()
+        for printer_id, printer in printers.items():
+            if printer_id not in self.subscriptions:
+                subscription = MoonrakerSubscription(
+                    printer_id,
+                    printer['moonraker_url'],
+                    on_update=self._on_subscription_update,
+                    file_index=self.file_index
                 )
-            
-            if response.status_code == 200:
-                return {'success': True, 'filename': filename}
-            else:
-                return {'error': f'Ошибка загрузки: {response.status_code}'}
-                
+                self.subscriptions[printer_id] = subscription
+                subscription.start()
+    
+    def _on_subscription_update(self, printer_id, status):
+        """Инкрементальное обновление от WebSocket; None - подписка потеряна"""
+        if status is not None:
+            self.store_status(printer_id, status)
+            return
+        # До переподключения статус берется HTTP-опросом
+        printer = self.get_printer(printer_id)
+        if printer:
+            self.poll_executor.submit(self.refresh_status, printer)
+    
+    def files_need_sync(self, printer_id, refresh=False):
+        """Нужно ли запросить список файлов у принтера перед выдачей из кэша"""
+        if refresh or self.file_index.version(printer_id) is None:
+            return True
+        # Список принтера с подпиской обновляется уведомлениями
+        return (not self.is_subscribed(printer_id)
+                and self.file_index.is_stale(printer_id, FILE_LIST_REFRESH_INTERVAL))
+    
+    def sync_files(self, printer):
+        """Полный список файлов от Moonraker в кэш; None или текст ошибки"""
+        try:
+            response = self.get_client(printer).get("/server/files/list")
+            if response.status_code != 200:
+                return f'Ошибка получения файлов: {response.status_code}'
+            if self.file_index.replace(printer['id'], response.json()['result']):
+                self.publish_files_version(printer['id'])
         except Exception as e:
-            logger.error(f"Ошибка загрузки файла: {str(e)}")
-            return {'error': str(e)}
+            return str(e)
+        return None
     
-    def start_print(self, printer_id, filename):
-        """Запуск печати"""
-        printer = next((p for p in self.printers if p['id'] == printer_id), None)
-        if not printer:
-            return {'error': 'Принтер не найден'}
+    def publish_files_version(self, printer_id):
+        """Новая версия списка файлов в кэше статусов (уходит клиентам дельтой)"""
+        status = self.peek_status(printer_id)
+        if status and status.get('online'):
+            self.store_status(printer_id, dict(status, files_version=self.file_index.version(printer_id)))
+    
+    def record_file(self, printer_id, path, size=None, modified=None):
+        """Файл, загруженный на принтер через F-CRM, сразу попадает в кэш списка"""
+        if self.file_index.add(printer_id, path, size=size, modified=modified):
+            self.publish_files_version(printer_id)
+    
+    def has_file(self, printer_id, filename):
+        return self.file_index.get(printer_id, filename) is not None
+    
+    def peek_status(self, printer_id):
+        """Статус из кэша без обращения к принтеру (None, если еще не опрашивался)"""
+        with self.status_lock:
+            return self.printer_status.get(printer_id)
+    
+    def status_snapshot(self):
+        """Копия кэша статусов всех принтеров"""
+        with self.status_lock:
+            return dict(self.printer_status)
+    
+    def get_cached_status(self, printer):
+        """Статус принтера из кэша (опрос Moonraker только при первом обращении)"""
+        with self.status_lock:
+            status = self.printer_status.get(printer['id'])
+        if status is None:
+            status = self.refresh_status(printer)
+        return status
+    
+    @property
+    def status_version(self):
+        """Текущая версия снимка статусов (используется как ETag)"""
+        return f"{self.status_epoch}-{self.status_counter}"
+    
+    def get_statuses(self, printer_ids=None, since=None):
+        """Снимок статусов из кэша, опционально только изменившихся после версии since"""
+        since_counter = 0
+        if since:
+            epoch, _, counter = since.partition('-')
+            if epoch == self.status_epoch and counter.isdigit():
+                since_counter = int(counter)
         
-        try:
-            response = requests.post(
-                f"{printer['moonraker_url']}/printer/print/start",
-                json={'filename': filename},
-                timeout=10
+        with self.status_lock:
+            version = self.status_version
+            statuses = {
+                printer_id: status
+                for printer_id, status in self.printer_status.items()
+                if (printer_ids is None or printer_id in printer_ids)
+                and self.status_versions.get(printer_id, 0) > since_counter
+            }
+        return version, statuses
+    
+    def wait_for_status_change(self, version, timeout):
+        """Ожидание новой версии снимка статусов; возвращает актуальную версию"""
+        with self.status_changed:
+            self.status_changed.wait_for(lambda: self.status_version != version, timeout)
+            return self.status_version
+    
+    def start_status_poller(self):
+        """Запуск фонового опроса принтеров (однократно на процесс)"""
+        with self.status_lock:
+            if self.poller_thread is not None and self.poller_thread.is_alive():
+                return
+            self.poller_thread = threading.Thread(
+                target=self._poll_loop,
+                name='status-poller',
+                daemon=True
             )
-            
-            if response.status_code == 200:
-                return {'success': True}
-            else:
-                return {'error': f'Ошибка запуска печати: {response.status_code}'}
-                
-        except Exception as e:
-            logger.error(f"Ошибка запуска печати: {str(e)}")
-            return {'error': str(e)}
+            self.poller_thread.start()
     
-    def pause_print(self, printer_id):
-        """Пауза печати"""
-        printer = next((p for p in self.printers if p['id'] == printer_id), None)
+    def _poll_loop(self):
+        """Цикл фонового опроса с интервалом STATUS_UPDATE_INTERVAL"""
+        while True:
+            started = time.monotonic()
+            try:
+                with POLLER_CYCLE_SECONDS.time():
+                    self.refresh_all_statuses()
+            except Exception as e:
+                logger.error(f"Ошибка фонового опроса принтеров: {str(e)}")
+            elapsed = time.monotonic() - started
+            time.sleep(max(0, STATUS_UPDATE_INTERVAL - elapsed))
+    
+    def upload_file(self, printer_id, file, save_copy=False):
+        """Загрузка файла на принтер (из multipart-формы, без промежуточного сохранения)"""
+        filename = secure_filename(file.filename)
+        stream = file.stream
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        return self.upload_stream(printer_id, filename, stream, size, save_copy=save_copy)
+    
+    def upload_library_file(self, printer_id, file_info, upload_id=None):
+        """Загрузка файла библиотеки на принтер (в исходном, несжатом виде)"""
+        with library.open(file_info) as f:
+            return self.upload_stream(printer_id, file_info['name'], f, file_info['size'],
+                                      upload_id=upload_id)
+    
+    def upload_stream(self, printer_id, filename, stream, size, save_copy=False, upload_id=None):
+        """Потоковая передача файла в Moonraker блоками, с учетом прогресса
+
+        При save_copy файл по пути сохраняется в UPLOAD_FOLDER.
+        """
+        printer = self.get_printer(printer_id)
         if not printer:
             return {'error': 'Принтер не найден'}
         
+        upload_id = upload_id or uuid.uuid4().hex
+        upload = {
+            'id': upload_id,
+            'printer_id': printer_id,
+            'filename': filename,
+            'size': size,
+            'sent': 0,
+            'status': 'uploading',
+            'started': datetime.now().isoformat()
+        }
+        with self.uploads_lock:
+            self._prune_uploads()
+            self.uploads[upload_id] = upload
+        
+        def progress(sent):
+            upload['sent'] = sent
+        
+        tee = None
         try:
-            response = requests.post(
-                f"{printer['moonraker_url']}/printer/print/pause",
-                timeout=10
+            if save_copy:
+                tee = open(os.path.join(UPLOAD_FOLDER, filename), 'wb')
+            response = self.get_client(printer).upload(
+                filename,
+                iter_chunks(stream, tee=tee),
+                size,
+                progress=progress
             )
             
-            if response.status_code == 200:
-                return {'success': True}
+            if response.status_code in (200, 201):
+                upload['status'] = 'done'
+                item = uploaded_item(response)
+                self.record_file(printer_id, item.get('path') or filename,
+                                 size=item.get('size', size), modified=item.get('modified'))
+                return {'success': True, 'filename': filename, 'upload_id': upload_id}
             else:
-                return {'error': f'Ошибка паузы: {response.status_code}'}
+                upload['status'] = 'failed'
+                return {'error': f'Ошибка загрузки: {response.status_code}', 'upload_id': upload_id}
                 
         except Exception as e:
-            logger.error(f"Ошибка паузы печати: {str(e)}")
-            return {'error': str(e)}
+            logger.error(f"Ошибка загрузки файла: {str(e)}")
+            upload['status'] = 'failed'
+            return {'error': str(e), 'upload_id': upload_id}
+        finally:
+            upload['finished'] = datetime.now().isoformat()
+            if tee is not None:
+                tee.close()
     
-    def resume_print(self, printer_id):
-        """Возобновление печати"""
-        printer = next((p for p in self.printers if p['id'] == printer_id), None)
+    def get_uploads(self):
+        with self.uploads_lock:
+            return [dict(u) for u in self.uploads.values()]
+    
+    def _prune_uploads(self, keep=100):
+        """Ограничение истории загрузок последними keep записями"""
+        finished = [k for k, u in self.uploads.items() if u['status'] != 'uploading']
+        for upload_id in finished[:max(0, len(self.uploads) - keep)]:
+            del self.uploads[upload_id]
+    
+    def run_command(self, printer_id, action, timeout=None, **params):
+        """Команда управления печатью из PRINT_COMMANDS (timeout - срок ответа в секундах)"""
+        printer = self.get_printer(printer_id)
         if not printer:
             return {'error': 'Принтер не найден'}
         
+        path, body, error = print_command(action, **params)
         try:
-            response = requests.post(
-                f"{printer['moonraker_url']}/printer/print/resume",
-                timeout=10
-            )
+            client = self.get_client(printer)
+            response = client.post(path, json=body,
+                                   timeout=(min(client.timeout[0], timeout), timeout) if timeout else None)
             
             if response.status_code == 200:
                 return {'success': True}
             else:
-                return {'error': f'Ошибка возобновления: {response.status_code}'}
+                return {'error': f'{error}: {response.status_code}'}
                 
         except Exception as e:
-            logger.error(f"Ошибка возобновления печати: {str(e)}")
+            logger.error(f"{error} ({printer_id}): {str(e)}")
             return {'error': str(e)}
     
+    def bulk_action(self, printer_ids, action, timeout=None, **params):
+        """Одна команда на набор принтеров параллельно; результат по каждому принтеру
+
+        Каждому принтеру дается не больше timeout секунд: зависший принтер не
+        задерживает ответ для остальных.
+        """
+        timeout = timeout or BULK_ACTION_TIMEOUT
+        futures = {
+            printer_id: self.bulk_executor.submit(self.run_command, printer_id, action,
+                                                  timeout=timeout, **params)
+            for printer_id in printer_ids
+        }
+        # Запас на ожидание свободного потока пула и разбор ответа
+        deadline = time.monotonic() + timeout + 1
+        results = {}
+        for printer_id, future in futures.items():
+            try:
+                results[printer_id] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                results[printer_id] = {'error': 'Превышено время ожидания'}
+        return results
+    
+    def mark_ready(self, printer_id):
+        """Подтверждение, что стол очищен: сброс завершенной печати (состояние standby)"""
+        return self.run_command(printer_id, 'ready')
+    
+    def start_print(self, printer_id, filename):
+        """Запуск печати"""
+        return self.run_command(printer_id, 'start', filename=filename)
+    
+    def pause_print(self, printer_id):
+        """Пауза печати"""
+        return self.run_command(printer_id, 'pause')
+    
+    def resume_print(self, printer_id):
+        """Возобновление печати"""
+        return self.run_command(printer_id, 'resume')
+    
     def cancel_print(self, printer_id):
         """Отмена печати"""
-        printer = next((p for p in self.printers if p['id'] == printer_id), None)
-        if not printer:
-            return {'error': 'Принтер не найден'}
-        
-        try:
-            response = requests.post(
-                f"{printer['moonraker_url']}/printer/print/cancel",
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                return {'success': True}
-            else:
-                return {'error': f'Ошибка отмены: {response.status_code}'}
-                
-        except Exception as e:
-            logger.error(f"Ошибка отмены печати: {str(e)}")
-            return {'error': str(e)}
+        return self.run_command(printer_id, 'cancel')
     
-    def toggle_light(self, printer_id):
-        """Переключение подсветки"""
-        printer = next((p for p in self.printers if p['id'] == printer_id), None)
+    def toggle_light(self, printer_id, state=None):
+        """Переключение подсветки; с явным state - установка одним запросом"""
+        if state is not None:
+            result = self.run_command(printer_id, 'led', state=state)
+            return dict(result, state=state) if 'success' in result else result
+        
+        printer = self.get_printer(printer_id)
         if not printer:
             return {'error': 'Принтер не найден'}
         
         try:
             # Получение текущего состояния подсветки
-            response = requests.get(
-                f"{printer['moonraker_url']}/printer/objects/query?led",
-                timeout=5
-            )
+            client = self.get_client(printer)
+            response = client.get("/printer/objects/query?led")
             
             if response.status_code == 200:
                 led_status = response.json()['result']['status']['led']
@@ -307,11 +783,7 @@ class PrinterManager:
                 new_state = 0 if current_state > 0 else 255
                 
                 # Установка нового состояния
-                set_response = requests.post(
-                    f"{printer['moonraker_url']}/printer/gcode/script",
-                    json={'script': f'SET_LED LED=led RED={new_state} GREEN={new_state} BLUE={new_state}'},
-                    timeout=10
-                )
+                set_response = client.post("/printer/gcode/script", json=led_script(new_state))
                 
                 if set_response.status_code == 200:
                     return {'success': True, 'state': new_state}
@@ -327,6 +799,101 @@ class PrinterManager:
 # Создание экземпляра менеджера принтеров
 printer_manager = PrinterManager()
 
+def find_library_file(filename):
+    """Последний загруженный файл библиотеки с таким именем (для планировщика)"""
+    return next((f for f in reversed(load_files()) if f['name'] == filename), None)
+
+# Прокси веб-камер: одно входящее соединение на камеру
+webcam_proxy = WebcamProxy(
+    timeout=REQUEST_TIMEOUT,
+    idle_timeout=app.config['WEBCAM_IDLE_TIMEOUT'],
+    snapshot_interval=app.config['WEBCAM_SNAPSHOT_INTERVAL'],
+    thumbnail_width=app.config['WEBCAM_THUMBNAIL_WIDTH']
+)
+
+# История телеметрии (температуры, прогресс, доступность)
+TELEMETRY_INTERVAL = app.config['TELEMETRY_INTERVAL']
+telemetry_store = TelemetryStore(app.config['TELEMETRY_DATABASE_FILE'], retention={
+    'samples_raw': app.config['TELEMETRY_RAW_HOURS'] * 3600,
+    'samples_1m': app.config['TELEMETRY_MINUTE_DAYS'] * 86400,
+    'samples_15m': app.config['TELEMETRY_RETENTION_DAYS'] * 86400
+})
+telemetry_recorder = TelemetryRecorder(telemetry_store, storage, printer_manager.status_snapshot,
+                                       interval=TELEMETRY_INTERVAL)
+
+# Отчеты по парку: суммы по дням обновляются по мере завершения печатей
+fleet_reports = FleetReports(telemetry_store, storage,
+                             interval=app.config['REPORTS_UPDATE_INTERVAL'])
+
+# Рассылка файлов библиотеки на принтеры
+file_distributor = FileDistributor(storage, printer_manager, max_workers=DISTRIBUTION_WORKERS)
+
+# Модель времени печати по истории завершенных копий
+print_estimator = PrintTimeEstimator(storage, refit_interval=app.config['ETA_REFIT_INTERVAL'],
+                                     half_life_days=app.config['ETA_HALF_LIFE_DAYS'])
+
+# Планировщик заданий
+job_dispatcher = JobDispatcher(
+    storage,
+    printer_manager,
+    find_file=find_library_file,
+    interval=STATUS_UPDATE_INTERVAL,
+    auto_continue=SCHEDULER_AUTO_CONTINUE,
+    max_retries=SCHEDULER_MAX_RETRIES,
+    estimator=print_estimator
+)
+
+@app.before_request
+def ensure_status_poller():
+    """Фоновые опрос и планировщик запускаются в процессе, который обслуживает запросы"""
+    printer_manager.start_status_poller()
+    job_dispatcher.start()
+    gcode_analyzer.start()
+    telemetry_recorder.start()
+    fleet_reports.start()
+    print_estimator.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    """Время обработки по шаблону маршрута (не по пути, чтобы не плодить метки)"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else 'unmatched',
+            method=request.method,
+            status=response.status_code
+        )
+    return response
+
+@app.after_request
+def compress_response(response):
+    """gzip/Brotli для ответов API от COMPRESS_MIN_SIZE байт (потоки и файлы не сжимаются)"""
+    if (not COMPRESS_RESPONSES or response.direct_passthrough or response.is_streamed
+            or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None or response.content_length < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое тело отличается побайтно: ETag становится слабым
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Метрики процесса в формате Prometheus"""
+    return Response(REGISTRY.render(), mimetype=METRICS_CONTENT_TYPE)
+
 @app.route('/')
 def index():
     return app.send_static_file('index.html')
@@ -353,19 +920,132 @@ def remove_printer(printer_id):
     success = printer_manager.remove_printer(printer_id)
     return jsonify({'success': success})
 
+@app.route('/api/printers/status', methods=['GET'])
+def get_printers_status():
+    """Статус всех принтеров (или ids=...) одним ответом с поддержкой ETag и since"""
+    try:
+        view = status_view(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    ids = request.args.get('ids')
+    printer_ids = set(filter(None, ids.split(','))) if ids else None
+    since = request.args.get('since')
+    
+    version, statuses = printer_manager.get_statuses(printer_ids, since)
+    if view:
+        statuses = {printer_id: view(status) for printer_id, status in statuses.items()}
+    response = jsonify({'version': version, 'printers': statuses})
+    response.set_etag(version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/api/printers/stream', methods=['GET'])
+def stream_printers_status():
+    """Server-Sent Events: полный снимок статусов, затем только изменившиеся поля"""
+    try:
+        view = status_view(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    min_interval = 1.0 / STATUS_STREAM_MAX_RATE
+    
+    def events():
+        version, statuses = printer_manager.get_statuses()
+        if view:
+            statuses = {printer_id: view(status) for printer_id, status in statuses.items()}
+        sent = dict(statuses)
+        yield sse_event('snapshot', {'version': version, 'printers': statuses})
+        
+        while True:
+            last_sent = time.monotonic()
+            current = printer_manager.wait_for_status_change(version, timeout=15)
+            if current == version:
+                # Комментарий поддерживает соединение и выявляет отключившихся клиентов
+                yield ': keepalive\n\n'
+                continue
+            
+            # Изменения, пришедшие быстрее допустимой частоты, объединяются в одно событие
+            time.sleep(max(0, min_interval - (time.monotonic() - last_sent)))
+            version, deltas = status_deltas(sent, version, view)
+            if deltas:
+                yield sse_event('delta', {'version': version, 'printers': deltas})
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def status_deltas(sent, version, view=None):
+    """Изменения статусов после version относительно уже отправленных клиенту
+
+    Обновляет sent; возвращает новую версию и {printer_id: изменившиеся поля
+    или None для удаленного принтера}. view - представление статуса из status_view.
+    """
+    current, changed = printer_manager.get_statuses(since=version)
+    with printer_manager.status_lock:
+        known_ids = set(printer_manager.printer_status)
+    
+    deltas = {}
+    for printer_id, status in changed.items():
+        if view:
+            status = view(status)
+        delta = diff_status(sent.get(printer_id, {}), status)
+        delta.pop('last_update', None)
+        if delta:
+            if 'last_update' in status:
+                delta['last_update'] = status['last_update']
+            deltas[printer_id] = delta
+        sent[printer_id] = status
+    for printer_id in set(sent) - known_ids:
+        deltas[printer_id] = None
+        del sent[printer_id]
+    return current, deltas
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @app.route('/api/printers/<printer_id>/status', methods=['GET'])
 def get_printer_status(printer_id):
-    """Получение статуса конкретного принтера"""
-    printer = next((p for p in printer_manager.printers if p['id'] == printer_id), None)
+    """Получение статуса конкретного принтера (?fields=... или ?format=compact - компактный)"""
+    try:
+        view = status_view(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    printer = printer_manager.get_printer(printer_id)
     if not printer:
         return jsonify({'error': 'Принтер не найден'}), 404
     
-    status = printer_manager.get_printer_status(printer)
-    return jsonify(status)
+    status = printer_manager.get_cached_status(printer)
+    return jsonify(view(status) if view else status)
 
 @app.route('/api/printers/<printer_id>/upload', methods=['POST'])
 def upload_file(printer_id):
-    """Загрузка файла на принтер"""
+    """Загрузка файла на принтер
+
+    Поддерживаются multipart-форма (поле file) и «сырое» тело запроса
+    application/octet-stream с ?filename=...: во втором случае данные
+    передаются в Moonraker по мере поступления, без буферизации на диске.
+    Параметр save=1 дополнительно сохраняет копию в UPLOAD_FOLDER.
+    """
+    if request.mimetype == 'application/octet-stream':
+        save_copy = request.args.get('save') in ('1', 'true')
+        filename = secure_filename(request.args.get('filename', ''))
+        if not filename:
+            return jsonify({'error': 'Не указано имя файла'}), 400
+        if not allowed_file(filename):
+            return jsonify({'error': 'Неподдерживаемый тип файла'}), 400
+        if request.content_length is None:
+            return jsonify({'error': 'Не указан размер файла (Content-Length)'}), 411
+        
+        result = printer_manager.upload_stream(
+            printer_id,
+            filename,
+            request.stream,
+            request.content_length,
+            save_copy=save_copy,
+            upload_id=request.args.get('upload_id')
+        )
+        return jsonify(result)
+    
     if 'file' not in request.files:
         return jsonify({'error': 'Файл не найден'}), 400
     
@@ -376,9 +1056,23 @@ def upload_file(printer_id):
     if not allowed_file(file.filename):
         return jsonify({'error': 'Неподдерживаемый тип файла'}), 400
     
-    result = printer_manager.upload_file(printer_id, file)
+    save_copy = request.values.get('save') in ('1', 'true')
+    result = printer_manager.upload_file(printer_id, file, save_copy=save_copy)
     return jsonify(result)
 
+@app.route('/api/uploads', methods=['GET'])
+def get_uploads():
+    """Прогресс загрузок файлов на принтеры"""
+    return jsonify(printer_manager.get_uploads())
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Прогресс одной загрузки"""
+    upload = next((u for u in printer_manager.get_uploads() if u['id'] == upload_id), None)
+    if not upload:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    return jsonify(upload)
+
 @app.route('/api/printers/<printer_id>/print/start', methods=['POST'])
 def start_print(printer_id):
     """Запуск печати"""
@@ -404,27 +1098,128 @@ def cancel_print(printer_id):
     result = printer_manager.cancel_print(printer_id)
     return jsonify(result)
 
+@app.route('/api/printers/<printer_id>/ready', methods=['POST'])
+def mark_printer_ready(printer_id):
+    """Стол очищен, принтер готов к следующей копии задания"""
+    result = printer_manager.mark_ready(printer_id)
+    job_dispatcher.notify()
+    return jsonify(result)
+
 @app.route('/api/printers/<printer_id>/light/toggle', methods=['POST'])
 def toggle_light(printer_id):
-    """Переключение подсветки"""
-    result = printer_manager.toggle_light(printer_id)
+    """Переключение подсветки (с {"state": ...} - установка без запроса текущего состояния)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        state = parse_led_state(data['state']) if 'state' in data else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    result = printer_manager.toggle_light(printer_id, state=state)
     return jsonify(result)
 
+@app.route('/api/printers/bulk', methods=['POST'])
+def bulk_action():
+    """Групповое действие над набором принтеров с результатом по каждому"""
+    try:
+        printer_ids, action, params, timeout = parse_bulk_request(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    results = printer_manager.bulk_action(printer_ids, action, timeout=timeout, **params)
+    if action == 'ready':
+        job_dispatcher.notify()
+    return jsonify(bulk_response(action, results))
+
+def bulk_response(action, results):
+    """Ответ группового действия: результаты по принтерам и итоги"""
+    succeeded = sum(1 for r in results.values() if r.get('success'))
+    return {
+        'action': action,
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded
+    }
+
+@app.route('/api/printers/<printer_id>/webcam/stream', methods=['GET'])
+def webcam_stream(printer_id):
+    """MJPEG-поток камеры через общий прокси"""
+    printer = printer_manager.get_printer(printer_id)
+    camera = webcam_proxy.get(printer) if printer else None
+    if camera is None:
+        return jsonify({'error': 'Камера не найдена'}), 404
+    
+    return Response(
+        camera.frames(max_fps=app.config['WEBCAM_MAX_FPS']),
+        mimetype='multipart/x-mixed-replace; boundary=frame',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/printers/<printer_id>/webcam/snapshot.jpg', methods=['GET'])
+def webcam_snapshot(printer_id):
+    """Снимок камеры из кэша (обновляется не чаще WEBCAM_SNAPSHOT_INTERVAL)"""
+    return _webcam_image(printer_id, lambda camera: camera.snapshot())
+
+@app.route('/api/printers/<printer_id>/webcam/thumbnail.jpg', methods=['GET'])
+def webcam_thumbnail(printer_id):
+    """Уменьшенный снимок камеры для карточки принтера (?width=...)"""
+    width = request.args.get('width')
+    if width is not None:
+        try:
+            width = int(width)
+        except ValueError:
+            width = None
+        if width is None or not THUMBNAIL_MIN_WIDTH <= width <= THUMBNAIL_MAX_WIDTH:
+            return jsonify({'error': f'width должен быть от {THUMBNAIL_MIN_WIDTH} до {THUMBNAIL_MAX_WIDTH}'}), 400
+    return _webcam_image(printer_id, lambda camera: camera.thumbnail(width))
+
+def _webcam_image(printer_id, grab):
+    printer = printer_manager.get_printer(printer_id)
+    camera = webcam_proxy.get(printer) if printer else None
+    if camera is None:
+        return jsonify({'error': 'Камера не найдена'}), 404
+    
+    image = grab(camera)
+    if image is None:
+        return jsonify({'error': camera.error or 'Нет изображения'}), 503
+    return Response(image, mimetype='image/jpeg', headers={
+        'Cache-Control': f"max-age={max(1, int(app.config['WEBCAM_SNAPSHOT_INTERVAL']))}"
+    })
+
+def files_page_params(args):
+    """Параметры страницы списка файлов: offset, limit, sort (modified/path/size), q"""
+    offset = args.get('offset', 0, type=int)
+    limit = args.get('limit', 100, type=int)
+    sort = args.get('sort', 'modified')
+    if offset < 0 or not 0 < limit <= 1000:
+        raise ValueError('offset должен быть >= 0, limit - от 1 до 1000')
+    if sort not in ('modified', 'path', 'size'):
+        raise ValueError('sort: modified, path или size')
+    return {'offset': offset, 'limit': limit, 'sort': sort, 'query': args.get('q') or None}
+
+def files_page_response(page, params):
+    version, total, files = page
+    return {'version': version, 'total': total, 'offset': params['offset'],
+            'limit': params['limit'], 'files': files}
+
 @app.route('/api/printers/<printer_id>/files', methods=['GET'])
 def get_printer_files(printer_id):
-    """Получение списка файлов на принтере"""
-    printer = next((p for p in printer_manager.printers if p['id'] == printer_id), None)
+    """Список файлов на принтере из кэша, постранично (ETag - версия списка)"""
+    printer = printer_manager.get_printer(printer_id)
     if not printer:
         return jsonify({'error': 'Принтер не найден'}), 404
-    
     try:
-        response = requests.get(f"{printer['moonraker_url']}/server/files/list", timeout=10)
-        if response.status_code == 200:
-            return jsonify(response.json()['result'])
-        else:
-            return jsonify({'error': f'Ошибка получения файлов: {response.status_code}'}), 500
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        params = files_page_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if printer_manager.files_need_sync(printer_id, refresh=request.args.get('refresh') in ('1', 'true')):
+        error = printer_manager.sync_files(printer)
+        if error:
+            return jsonify({'error': error}), 500
+    
+    page = printer_manager.file_index.page(printer_id, **params)
+    response = jsonify(files_page_response(page, params))
+    response.set_etag(page[0])
+    return response.make_conditional(request)
 
 # API для файлов
 @app.route('/api/files', methods=['GET'])
@@ -435,7 +1230,27 @@ def get_files():
 
 @app.route('/api/files', methods=['POST'])
 def upload_system_file():
-    """Загрузка файла в систему"""
+    """Загрузка файла в систему
+
+    Содержимое сохраняется в библиотеке по SHA-256. Вместо файла можно передать
+    поля sha256 и name: если такое содержимое уже есть, запись создается без
+    повторной передачи данных, иначе возвращается 404 и файл нужно отправить.
+    """
+    description = request.form.get('description', '')
+    
+    if 'file' not in request.files and request.form.get('sha256'):
+        filename = secure_filename(request.form.get('name', ''))
+        if not filename or not allowed_file(filename):
+            return jsonify({'error': 'Неподдерживаемый тип файла'}), 400
+        if filename.lower().endswith('.gz'):
+            filename = filename[:-3]
+        sha256 = request.form['sha256'].lower()
+        known = next((f for f in storage.all('files') if f.get('sha256') == sha256), None)
+        if known is None:
+            return jsonify({'error': 'Содержимое не найдено'}), 404
+        return register_library_file(filename, sha256, known['size'], known.get('compressed', False),
+                                     description)
+    
     if 'file' not in request.files:
         return jsonify({'error': 'Файл не найден'}), 400
     
@@ -446,63 +1261,233 @@ def upload_system_file():
     if not allowed_file(file.filename):
         return jsonify({'error': 'Неподдерживаемый тип файла'}), 400
     
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(file_path)
-    
-    # Получаем описание файла, если оно предоставлено
-    description = request.form.get('description', '')
-    
-    # Добавляем информацию о файле в базу
-    files = load_files()
-    file_info = {
-        'id': f"file-{len(files)+1:03d}",
-        'name': filename,
-        'path': file_path,
-        'size': os.path.getsize(file_path),
-        'type': filename.rsplit('.', 1)[1].lower() if '.' in filename else 'unknown',
-        'description': description,
-        'uploaded': datetime.now().isoformat(),
-        'modified': datetime.now().isoformat()
-    }
-    files.append(file_info)
-    save_files(files)
+    try:
+        filename, sha256, size, compressed = library.store(file.stream, secure_filename(file.filename))
+    except OSError as e:
+        logger.error(f"Ошибка сохранения файла {file.filename}: {str(e)}")
+        return jsonify({'error': f'Ошибка сохранения файла: {str(e)}'}), 400
+    return register_library_file(filename, sha256, size, compressed, description)
+
+def register_library_file(filename, sha256, size, compressed, description):
+    """Запись о файле библиотеки; повторная загрузка того же файла возвращает существующую"""
+    with storage.transaction():
+        existing = next((f for f in storage.all('files')
+                         if f.get('sha256') == sha256 and f['name'] == filename), None)
+        if existing:
+            return jsonify(dict(existing, duplicate=True))
+        
+        file_info = {
+            'id': storage.next_id('files', 'file'),
+            'name': filename,
+            'path': library.blob_path(sha256, compressed),
+            'size': size,
+            'sha256': sha256,
+            'compressed': compressed,
+            'type': file_type(filename),
+            'description': description,
+            'uploaded': datetime.now().isoformat(),
+            'modified': datetime.now().isoformat()
+        }
+        analysis = gcode_analyzer.cached(sha256)
+        if analysis:
+            file_info['metadata'] = {k: v for k, v in analysis.items() if k not in ('id', 'analyzed')}
+        storage.insert('files', file_info)
     
+    if not analysis:
+        gcode_analyzer.submit(file_info)
     return jsonify(file_info)
 
 @app.route('/api/files/<file_id>', methods=['DELETE'])
 def delete_file(file_id):
     """Удаление файла"""
-    files = load_files()
-    file_info = next((f for f in files if f['id'] == file_id), None)
+    file_info = storage.get('files', file_id)
     
     if not file_info:
         return jsonify({'error': 'Файл не найден'}), 404
     
     try:
-        os.remove(file_info['path'])
-        files = [f for f in files if f['id'] != file_id]
-        save_files(files)
+        with storage.transaction():
+            storage.delete('files', file_id)
+            library.release(file_info)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/files/<file_id>/thumbnail', methods=['GET'])
+def get_file_thumbnail(file_id):
+    """Миниатюра из G-code (самая большая или ?size=small - самая маленькая)"""
+    file_info = storage.get('files', file_id)
+    thumbnails = ((file_info or {}).get('metadata') or {}).get('thumbnails')
+    if not thumbnails:
+        return jsonify({'error': 'Миниатюра не найдена'}), 404
+    
+    thumbnails = sorted(thumbnails, key=lambda t: t['width'] * t['height'])
+    thumbnail = thumbnails[0] if request.args.get('size') == 'small' else thumbnails[-1]
+    return send_file(
+        gcode_analyzer.thumbnail_path(file_info['sha256'], thumbnail),
+        mimetype=f"image/{'jpeg' if thumbnail['format'] == 'jpg' else thumbnail['format']}",
+        max_age=86400,
+        conditional=True
+    )
+
+@app.route('/api/files/<file_id>/distribute', methods=['POST'])
+def distribute_file(file_id):
+    """Параллельная загрузка файла библиотеки на набор принтеров"""
+    file_info = storage.get('files', file_id)
+    if not file_info or not os.path.exists(file_info['path']):
+        return jsonify({'error': 'Файл не найден'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    known = [p['id'] for p in printer_manager.printers]
+    printer_ids = data.get('printers')
+    if printer_ids is None:
+        printer_ids = known
+    elif not isinstance(printer_ids, list) or not all(isinstance(i, str) for i in printer_ids):
+        return jsonify({'error': 'printers должен быть списком id'}), 400
+    unknown = [i for i in printer_ids if i not in known]
+    if unknown:
+        return jsonify({'error': f"Неизвестные принтеры: {', '.join(unknown)}"}), 400
+    task = file_distributor.distribute(file_info, list(dict.fromkeys(printer_ids)),
+                                       force=bool(data.get('force', False)))
+    return jsonify(task), 202
+
+@app.route('/api/files/distributions', methods=['GET'])
+def get_distributions():
+    """Последние рассылки файлов"""
+    return jsonify(file_distributor.get_tasks())
+
+@app.route('/api/files/distributions/<task_id>', methods=['GET'])
+def get_distribution(task_id):
+    """Прогресс рассылки по каждому принтеру"""
+    task = file_distributor.get_task(task_id)
+    if not task:
+        return jsonify({'error': 'Рассылка не найдена'}), 404
+    return jsonify(task)
+
 @app.route('/api/files/<file_id>/download', methods=['GET'])
 def download_file(file_id):
     """Скачивание файла"""
-    files = load_files()
-    file_info = next((f for f in files if f['id'] == file_id), None)
+    file_info = storage.get('files', file_id)
     
     if not file_info:
         return jsonify({'error': 'Файл не найден'}), 404
     
-    return send_from_directory(UPLOAD_FOLDER, file_info['name'])
+    # Сжатое содержимое отдается как есть (Content-Encoding: gzip) через sendfile,
+    # с поддержкой Range; распаковка на сервере - только для клиентов без gzip
+    if not file_info.get('compressed') or 'gzip' in request.accept_encodings:
+        response = send_file(
+            file_info['path'],
+            mimetype='application/octet-stream',
+            as_attachment=True,
+            download_name=file_info['name'],
+            etag=file_info['sha256'],
+            conditional=True
+        )
+        if file_info.get('compressed'):
+            response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+        return response
+    
+    def generate():
+        with library.open(file_info) as f:
+            yield from iter(lambda: f.read(64 * 1024), b'')
+    
+    return Response(generate(), mimetype='application/octet-stream', headers={
+        'Content-Disposition': f"attachment; filename=\"{file_info['name']}\"",
+        'Content-Length': str(file_info['size']),
+        'Vary': 'Accept-Encoding'
+    })
+
+# API телеметрии
+@app.route('/api/telemetry', methods=['GET'])
+def get_telemetry():
+    """История метрик для графиков
+
+    Параметры: printers=id1,id2 (по умолчанию все), hours=24 или start/end
+    (unix-время), points - число точек на графике, metrics=extruder,bed,...
+    """
+    end = request.args.get('end', type=int) or int(time.time())
+    start = request.args.get('start', type=int) or end - int(request.args.get('hours', 24, type=float) * 3600)
+    if start >= end:
+        return jsonify({'error': 'Неверный интервал'}), 400
+    
+    printer_ids = [p for p in request.args.get('printers', '').split(',') if p]
+    metrics = [m for m in request.args.get('metrics', '').split(',') if m] or METRICS
+    result = telemetry_store.query(
+        printer_ids, start, end,
+        points=request.args.get('points', 300, type=int),
+        metrics=metrics,
+        sample_interval=TELEMETRY_INTERVAL
+    )
+    return jsonify(result)
+
+@app.route('/api/telemetry/summary', methods=['GET'])
+def get_telemetry_summary():
+    """Доля времени онлайн и в печати по принтерам за последние hours часов"""
+    end = int(time.time())
+    start = end - int(request.args.get('hours', 24, type=float) * 3600)
+    printer_ids = [p for p in request.args.get('printers', '').split(',') if p]
+    return jsonify(telemetry_store.summary(start, end, printer_ids, sample_interval=TELEMETRY_INTERVAL))
+
+# API для отчетов
+def _report_params():
+    """Тип отчета и период из параметров запроса: days=30 или start/end (YYYY-MM-DD)"""
+    start, end = day_range(request.args.get('days', type=int),
+                           request.args.get('start'), request.args.get('end'))
+    if start > end:
+        raise ValueError('Неверный интервал')
+    return start, end
+
+@app.route('/api/reports/<report_type>', methods=['GET'])
+def get_report(report_type):
+    """Отчет по парку: utilization, prints, materials или lead_times"""
+    if report_type not in REPORTS:
+        return jsonify({'error': 'Неизвестный тип отчета'}), 404
+    try:
+        start, end = _report_params()
+    except ValueError:
+        return jsonify({'error': 'Неверный интервал'}), 400
+    
+    return jsonify({
+        'report': report_type,
+        'start': start,
+        'end': end,
+        'columns': [{'key': key, 'title': title} for key, title in REPORTS[report_type]],
+        'rows': list(fleet_reports.report(report_type, start, end))
+    })
+
+@app.route('/api/reports/export', methods=['GET'])
+def export_report():
+    """Выгрузка отчета в CSV или XLSX (?type=...&format=csv|xlsx) потоком"""
+    report_type = request.args.get('type', 'utilization')
+    export_format = request.args.get('format', 'csv')
+    if report_type not in REPORTS:
+        return jsonify({'error': 'Неизвестный тип отчета'}), 404
+    if export_format not in ('csv', 'xlsx'):
+        return jsonify({'error': 'Поддерживаются форматы csv и xlsx'}), 400
+    try:
+        start, end = _report_params()
+    except ValueError:
+        return jsonify({'error': 'Неверный интервал'}), 400
+    
+    columns = REPORTS[report_type]
+    rows = fleet_reports.report(report_type, start, end)
+    if export_format == 'csv':
+        body, mimetype = stream_csv(columns, rows), 'text/csv; charset=utf-8'
+    else:
+        body = stream_xlsx(columns, rows)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    filename = f"report_{report_type}_{start}_{end}.{export_format}"
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 # API для заданий
 @app.route('/api/jobs', methods=['GET'])
 def get_jobs():
-    """Получение списка заданий"""
-    jobs = load_jobs()
+    """Получение списка заданий (опционально ?status=...)"""
+    jobs = load_jobs(request.args.get('status'))
     return jsonify(jobs)
 
 @app.route('/api/jobs', methods=['POST'])
@@ -510,127 +1495,178 @@ def create_job():
     """Создание нового задания"""
     data = request.json
     
-    jobs = load_jobs()
-    job = {
-        'id': f"job-{len(jobs)+1:03d}",
-        'name': data['name'],
-        'filename': data['filename'],
-        'quantity': data.get('quantity', 1),
-        'priority': data.get('priority', 'normal'),
-        'material': data.get('material', 'PLA'),
-        'printers': data.get('printers', []),
-        'status': 'pending',
-        'progress': 0,
-        'estimated_time': data.get('estimated_time', 'Неизвестно'),
-        'created': datetime.now().isoformat(),
-        'started': None,
-        'completed': None,
-        'current_file_index': 0,
-        'files_printed': 0
-    }
+    # Оценка времени из метаданных G-code, если пользователь ее не указал
+    file_info = find_library_file(data['filename'])
+    estimated = ((file_info or {}).get('metadata') or {}).get('estimated_time')
     
-    jobs.append(job)
-    save_jobs(jobs)
+    with storage.transaction():
+        job = {
+            'id': storage.next_id('jobs', 'job'),
+            'name': data['name'],
+            'filename': data['filename'],
+            'quantity': data.get('quantity', 1),
+            'priority': data.get('priority', 'normal'),
+            'material': data.get('material', 'PLA'),
+            'printers': data.get('printers', []),
+            'status': 'pending',
+            'progress': 0,
+            'estimated_time': data.get('estimated_time') or format_duration(estimated),
+            'estimated_seconds': estimated,
+            'created': datetime.now().isoformat(),
+            'started': None,
+            'completed': None,
+            'current_file_index': 0,
+            'files_printed': 0
+        }
+        job_store.create(job)
     return jsonify(job)
 
-@app.route('/api/jobs/<job_id>', methods=['PUT'])
-def update_job(job_id):
-    """Обновление задания"""
-    data = request.json
-    jobs = load_jobs()
-    
-    job = next((j for j in jobs if j['id'] == job_id), None)
+def job_error(e):
+    """Ответ на ошибку изменения задания: (данные, HTTP-код)"""
+    if isinstance(e, JobNotFound):
+        return {'error': 'Задание не найдено'}, 404
+    return {'error': str(e), 'job': e.job}, 409
+
+def request_revision(data=None):
+    """Ожидаемая ревизия задания из If-Match или поля revision (None - без проверки)"""
+    etags = request.if_match.as_set()
+    if etags:
+        return int(next(iter(etags)))
+    if data and data.get('revision') is not None:
+        return int(data['revision'])
+    return None
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Задание с ревизией в ETag"""
+    job = job_store.get(job_id)
     if not job:
         return jsonify({'error': 'Задание не найдено'}), 404
+    response = jsonify(job)
+    response.set_etag(str(job.get('revision', 0)))
+    return response
+
+@app.route('/api/jobs/<job_id>', methods=['PUT'])
+def update_job(job_id):
+    """Обновление задания (If-Match или revision - только если задание не изменилось)"""
+    data = request.json or {}
+    try:
+        job = job_store.edit(job_id, data, request_revision(data))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except (JobNotFound, JobConflict) as e:
+        error = job_error(e)
+        return jsonify(error[0]), error[1]
     
-    job.update(data)
-    job['modified'] = datetime.now().isoformat()
-    save_jobs(jobs)
-    return jsonify(job)
+    job_dispatcher.notify()
+    response = jsonify(job)
+    response.set_etag(str(job['revision']))
+    return response
 
 @app.route('/api/jobs/<job_id>', methods=['DELETE'])
 def delete_job(job_id):
     """Удаление задания"""
-    jobs = load_jobs()
-    jobs = [j for j in jobs if j['id'] != job_id]
-    save_jobs(jobs)
+    job_store.delete(job_id)
     return jsonify({'success': True})
 
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    """Журнал событий задания (?after=<seq> - только новые)"""
+    try:
+        after = int(request.args.get('after', 0))
+        limit = min(int(request.args.get('limit', 500)), 5000)
+    except ValueError:
+        return jsonify({'error': 'after и limit должны быть числами'}), 400
+    events = job_store.events(job_id, after, limit)
+    return jsonify({'events': events, 'last': events[-1]['seq'] if events else after})
+
 @app.route('/api/jobs/<job_id>/start', methods=['POST'])
 def start_job(job_id):
     """Запуск задания"""
-    jobs = load_jobs()
-    job = next((j for j in jobs if j['id'] == job_id), None)
-    
-    if not job:
-        return jsonify({'error': 'Задание не найдено'}), 404
+    job = job_store.get(job_id)
+    error = job_start_error(job)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
     
-    # Проверка доступности принтеров
-    available_printers = []
-    for printer_id in job['printers']:
-        printer = next((p for p in printer_manager.printers if p['id'] == printer_id), None)
-        if printer:
-            status = printer_manager.get_printer_status(printer)
-            if status.get('online') and status['print_stats'].get('state') == 'idle':
-                available_printers.append(printer_id)
+    try:
+        started = mark_job_running(job_id)
+    except (JobNotFound, JobConflict) as e:
+        error = job_error(e)
+        return jsonify(error[0]), error[1]
     
-    if not available_printers:
-        return jsonify({'error': 'Нет доступных принтеров'}), 400
+    # Продолжение приостановленного задания
+    if job['status'] == 'paused':
+        printer_manager.bulk_action(job_active_printers(started), 'resume')
     
-    # Назначение задания принтерам
-    for printer_id in available_printers:
-        printer = next((p for p in printer_manager.printers if p['id'] == printer_id), None)
-        if printer:
-            # Получение файлов для печати
-            response = requests.get(f"{printer['moonraker_url']}/server/files/list")
-            files = response.json().get('result', [])
-            gcode_files = [f for f in files if f['pathname'].endswith('.gcode')]
-            
-            if gcode_files:
-                # Выбор файла для печати
-                file_to_print = gcode_files[0]['pathname']
-                # Запуск печати
-                printer_manager.start_print(printer_id, file_to_print)
-    
-    job['status'] = 'running'
-    job['started'] = datetime.now().isoformat()
-    save_jobs(jobs)
-    return jsonify(job)
+    return jsonify(started)
 
 @app.route('/api/jobs/<job_id>/pause', methods=['POST'])
 def pause_job(job_id):
     """Пауза задания"""
-    jobs = load_jobs()
-    job = next((j for j in jobs if j['id'] == job_id), None)
-    
-    if not job:
-        return jsonify({'error': 'Задание не найдено'}), 404
+    try:
+        job = job_store.transition(job_id, 'paused')
+    except (JobNotFound, JobConflict) as e:
+        error = job_error(e)
+        return jsonify(error[0]), error[1]
     
-    # Пауза на всех принтерах
-    for printer_id in job['printers']:
-        printer_manager.pause_print(printer_id)
+    # Пауза на всех принтерах задания
+    printer_manager.bulk_action(job_active_printers(job), 'pause')
     
-    job['status'] = 'paused'
-    save_jobs(jobs)
     return jsonify(job)
 
 @app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
 def cancel_job(job_id):
     """Отмена задания"""
-    jobs = load_jobs()
-    job = next((j for j in jobs if j['id'] == job_id), None)
-    
-    if not job:
-        return jsonify({'error': 'Задание не найдено'}), 404
+    try:
+        job, printer_ids = mark_job_cancelled(job_id)
+    except (JobNotFound, JobConflict) as e:
+        error = job_error(e)
+        return jsonify(error[0]), error[1]
     
-    # Отмена на всех принтерах
-    for printer_id in job['printers']:
-        printer_manager.cancel_print(printer_id)
+    # Отмена на всех принтерах задания
+    printer_manager.bulk_action(printer_ids, 'cancel')
     
-    job['status'] = 'cancelled'
-    save_jobs(jobs)
     return jsonify(job)
 
+def job_start_error(job):
+    """Причина, по которой задание нельзя запустить: (текст, HTTP-код) или None"""
+    if not job:
+        return 'Задание не найдено', 404
+    if not can_transition(job['status'], 'running'):
+        return 'Задание уже завершено', 400
+    if job['printers'] and not any(printer_manager.get_printer(p) for p in job['printers']):
+        return 'Нет доступных принтеров', 400
+    return None
+
+def mark_job_running(job_id):
+    """Перевод задания в running; копии распределяет планировщик по мере освобождения принтеров"""
+    def start(job):
+        check_transition(job['status'], 'running', job=job)
+        job['status'] = 'running'
+        job['started'] = job.get('started') or datetime.now().isoformat()
+    job = job_store.modify(job_id, start)
+    job_dispatcher.notify()
+    return job
+
+def mark_job_cancelled(job_id):
+    """Отмена задания и его активных копий; возвращает задание и принтеры отмененных копий"""
+    printer_ids = []
+    
+    def cancel(job):
+        printer_ids.clear()
+        printer_ids.extend(job_active_printers(job))
+        for copy in job.get('copies', []):
+            if copy['status'] in ACTIVE_COPY_STATES:
+                copy.update({'status': 'cancelled', 'finished': datetime.now().isoformat()})
+        job['status'] = 'cancelled'
+    return job_store.modify(job_id, cancel), printer_ids
+
+def job_active_printers(job):
+    """Принтеры, на которых сейчас печатаются копии задания"""
+    if 'copies' not in job:
+        return job['printers']
+    return [c['printer_id'] for c in job['copies'] if c['status'] in ACTIVE_COPY_STATES]
+
 @app.route('/api/jobs/<job_id>/progress', methods=['POST'])
 def update_job_progress(job_id):
     """Обновление прогресса задания"""
@@ -639,17 +1675,27 @@ def update_job_progress(job_id):
     
     if progress is None:
         return jsonify({'error': 'Не указан прогресс'}), 400
+    if not isinstance(progress, (int, float)) or not 0 <= progress <= 100:
+        return jsonify({'error': 'Прогресс должен быть числом от 0 до 100'}), 400
     
-    jobs = load_jobs()
-    job = next((j for j in jobs if j['id'] == job_id), None)
-    
-    if not job:
-        return jsonify({'error': 'Задание не найдено'}), 404
+    def set_progress(job):
+        if job['status'] not in ('running', 'paused'):
+            raise JobConflict('Прогресс можно обновлять только у выполняемого задания', job)
+        job['progress'] = progress
+    try:
+        job = job_store.modify(job_id, set_progress)
+    except (JobNotFound, JobConflict) as e:
+        error = job_error(e)
+        return jsonify(error[0]), error[1]
     
-    job['progress'] = progress
-    save_jobs(jobs)
     return jsonify(job)
 
+@app.route('/api/forecast', methods=['GET'])
+def get_forecast():
+    """Прогноз освобождения принтеров и завершения заданий по модели времени печати"""
+    statuses = {p['id']: printer_manager.peek_status(p['id']) for p in printer_manager.printers}
+    return jsonify(print_estimator.forecast(load_jobs(), statuses))
+
 # API для пользователей
 @app.route('/api/users', methods=['GET'])
 def get_users():
@@ -662,39 +1708,31 @@ def create_user():
     """Создание нового пользователя"""
     data = request.json
     
-    users = load_users()
-    user = {
-        'id': f"user-{len(users)+1:03d}",
-        'name': data['name'],
-        'email': data['email'],
-        'role': data.get('role', 'operator'),
-        'created': datetime.now().isoformat()
-    }
-    
-    users.append(user)
-    save_users(users)
+    with storage.transaction():
+        user = {
+            'id': storage.next_id('users', 'user'),
+            'name': data['name'],
+            'email': data['email'],
+            'role': data.get('role', 'operator'),
+            'created': datetime.now().isoformat()
+        }
+        storage.insert('users', user)
     return jsonify(user)
 
 @app.route('/api/users/<user_id>', methods=['PUT'])
 def update_user(user_id):
     """Обновление пользователя"""
     data = request.json
-    users = load_users()
-    
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = storage.update('users', user_id, data)
     if not user:
         return jsonify({'error': 'Пользователь не найден'}), 404
     
-    user.update(data)
-    save_users(users)
     return jsonify(user)
 
 @app.route('/api/users/<user_id>', methods=['DELETE'])
 def delete_user(user_id):
     """Удаление пользователя"""
-    users = load_users()
-    users = [u for u in users if u['id'] != user_id]
-    save_users(users)
+    storage.delete('users', user_id)
     return jsonify({'success': True})
 
 if __name__ == '__main__':
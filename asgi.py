@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point для F-CRM: асинхронный режим для большого числа соединений
+
+Запуск: uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Маршруты, которые ждут принтеры (управление печатью и подсветкой, файлы на
+принтере, запуск/пауза/отмена заданий), и долгие потоки (SSE статусов, MJPEG
+камер) обслуживаются в цикле asyncio: запросы к Moonraker идут через aiohttp,
+а ожидание не занимает поток. Остальные маршруты - работа с хранилищем и
+загрузки файлов - выполняются тем же приложением Flask в ограниченном пуле
+потоков (a2wsgi), поэтому API совпадает с режимом wsgi.py.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import parse_qsl
+
+import aiohttp
+from a2wsgi import WSGIMiddleware
+from flask_cors.core import get_cors_headers, get_cors_options
+from werkzeug.datastructures import MultiDict
+
+from app import (
+    app, printer_manager, webcam_proxy, job_dispatcher, ensure_status_poller,
+    print_command, led_script, parse_led_state, parse_bulk_request, bulk_response, status_deltas, status_view,
+    files_page_params, files_page_response, sse_event, job_start_error, job_active_printers, mark_job_running, mark_job_cancelled,
+    job_store, job_error,
+    STATUS_STREAM_MAX_RATE, BULK_ACTION_TIMEOUT, COMPRESS_RESPONSES, COMPRESS_MIN_SIZE
+)
+from compression import choose_encoding, compress
+from jobs import JobConflict, JobNotFound
+from metrics import HTTP_REQUEST_SECONDS
+from moonraker import AsyncMoonrakerClient
+from webcam import multipart_part
+
+logger = logging.getLogger(__name__)
+
+# Тело запросов к асинхронным маршрутам - небольшой JSON
+MAX_JSON_BODY = 1024 * 1024
+
+wsgi_application = WSGIMiddleware(app.wsgi_app, workers=app.config['ASGI_WSGI_WORKERS'])
+
+# Те же настройки CORS, что у Flask-CORS в app.py: асинхронные маршруты минуют Flask
+CORS_OPTIONS = get_cors_options(app, {'origins': app.config['CORS_ORIGINS']})
+
+
+class StatusBroadcaster:
+    """Один поток ждет изменения кэша статусов и будит всех асинхронных подписчиков"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self._thread = threading.Thread(target=self._run, name='status-broadcaster', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        version = printer_manager.status_version
+        while not self.loop.is_closed():
+            current = printer_manager.wait_for_status_change(version, timeout=15)
+            if current != version:
+                version = current
+                try:
+                    self.loop.call_soon_threadsafe(self._notify)
+                except RuntimeError:  # цикл событий закрыт при остановке сервера
+                    return
+
+    def _notify(self):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+    async def wait(self, timeout):
+        """Ожидание следующего изменения; False - истек таймаут"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class _State:
+    """Объекты, привязанные к циклу событий (создаются при старте или первом запросе)"""
+    session = None
+    broadcaster = None
+
+
+state = _State()
+
+
+async def _startup():
+    if state.session is not None:
+        return
+    state.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=8))
+    state.broadcaster = StatusBroadcaster(asyncio.get_running_loop())
+    ensure_status_poller()
+
+
+async def _shutdown():
+    if state.session is not None:
+        await state.session.close()
+        state.session = None
+
+
+# Маршрутизация
+
+ROUTES = []
+
+
+def route(method, pattern):
+    regex = re.compile('^' + re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', pattern) + '$')
+
+    def register(handler):
+        ROUTES.append((method, regex, pattern, handler))
+        return handler
+    return register
+
+
+def _match(method, path):
+    for route_method, regex, pattern, handler in ROUTES:
+        if route_method == method:
+            match = regex.match(path)
+            if match:
+                return handler, match.groupdict(), pattern
+    return None, None, None
+
+
+class Request:
+    def __init__(self, scope, receive, params):
+        self.scope = scope
+        self.receive = receive
+        self.params = params
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'),
+                                        keep_blank_values=True))
+
+    def headers(self):
+        return {k.decode('latin-1').title(): v.decode('latin-1') for k, v in self.scope['headers']}
+
+    def header(self, name):
+        name = name.lower().encode()
+        return next((v.decode('latin-1') for k, v in self.scope['headers'] if k == name), None)
+
+    async def json(self):
+        body = bytearray()
+        while True:
+            message = await self.receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_JSON_BODY:
+                raise ValueError('Слишком большое тело запроса')
+            if not message.get('more_body'):
+                break
+        return json.loads(body) if body else {}
+
+
+async def send_json(send, data, status=200, headers=(), request=None):
+    """JSON-ответ; с request - сжатие по Accept-Encoding, как у маршрутов Flask"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    headers = list(headers)
+    if request is not None and COMPRESS_RESPONSES and status == 200:
+        headers.append((b'vary', b'Accept-Encoding'))
+        encoding = choose_encoding(request.header('accept-encoding'))
+        if encoding and len(body) >= COMPRESS_MIN_SIZE:
+            body = compress(body, encoding)
+            headers.append((b'content-encoding', encoding.encode()))
+            headers = [(k, b'W/' + v) if k == b'etag' and not v.startswith(b'W/') else (k, v)
+                       for k, v in headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+        *headers,
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+
+async def send_stream(request, send, content_type, chunks):
+    """Потоковый ответ до отключения клиента (отключение прерывает генератор)"""
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', content_type.encode()),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+
+    async def pump():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    async def disconnected():
+        while (await request.receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await chunks.aclose()
+    try:
+        await send({'type': 'http.response.body', 'body': b''})
+    except Exception:
+        pass
+    return 200
+
+
+async def to_thread(func, *args):
+    """Блокирующий вызов в пуле потоков цикла (asyncio.to_thread есть только с Python 3.9)"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+def _client(printer):
+    return AsyncMoonrakerClient(printer_manager.get_client(printer), state.session)
+
+
+async def run_command(printer_id, action, **params):
+    """Асинхронный аналог PrinterManager.run_command"""
+    printer = await to_thread(printer_manager.get_printer, printer_id)
+    if not printer:
+        return {'error': 'Принтер не найден'}
+
+    path, body, error = print_command(action, **params)
+    try:
+        response = await _client(printer).post(path, json=body)
+        if response.status_code == 200:
+            return {'success': True}
+        return {'error': f'{error}: {response.status_code}'}
+    except Exception as e:
+        logger.error(f"{error} ({printer_id}): {str(e) or type(e).__name__}")
+        return {'error': str(e) or type(e).__name__}
+
+
+async def bulk_action(printer_ids, action, timeout=None, **params):
+    """Асинхронный аналог PrinterManager.bulk_action: все принтеры сразу, у каждого свой срок"""
+    timeout = timeout or BULK_ACTION_TIMEOUT
+
+    async def run(printer_id):
+        try:
+            return await asyncio.wait_for(run_command(printer_id, action, **params), timeout)
+        except asyncio.TimeoutError:
+            return {'error': 'Превышено время ожидания'}
+
+    results = await asyncio.gather(*(run(printer_id) for printer_id in printer_ids))
+    return dict(zip(printer_ids, results))
+
+
+# Принтеры
+
+@route('GET', '/api/printers/stream')
+async def stream_printers_status(request, send):
+    """Server-Sent Events: полный снимок статусов, затем только изменившиеся поля"""
+    try:
+        view = status_view(request.args)
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+    min_interval = 1.0 / STATUS_STREAM_MAX_RATE
+
+    async def events():
+        version, statuses = printer_manager.get_statuses()
+        if view:
+            statuses = {printer_id: view(status) for printer_id, status in statuses.items()}
+        sent = dict(statuses)
+        yield sse_event('snapshot', {'version': version, 'printers': statuses}).encode('utf-8')
+
+        while True:
+            last_sent = time.monotonic()
+            if printer_manager.status_version == version:
+                if not await state.broadcaster.wait(15):
+                    yield b': keepalive\n\n'
+                    continue
+
+            await asyncio.sleep(max(0, min_interval - (time.monotonic() - last_sent)))
+            version, deltas = status_deltas(sent, version, view)
+            if deltas:
+                yield sse_event('delta', {'version': version, 'printers': deltas}).encode('utf-8')
+
+    return await send_stream(request, send, 'text/event-stream', events())
+
+
+@route('POST', '/api/printers/<printer_id>/print/start')
+async def start_print(request, send):
+    data = await request.json()
+    return await send_json(send, await run_command(request.params['printer_id'], 'start',
+                                                   filename=data['filename']))
+
+
+@route('POST', '/api/printers/<printer_id>/print/pause')
+async def pause_print(request, send):
+    return await send_json(send, await run_command(request.params['printer_id'], 'pause'))
+
+
+@route('POST', '/api/printers/<printer_id>/print/resume')
+async def resume_print(request, send):
+    return await send_json(send, await run_command(request.params['printer_id'], 'resume'))
+
+
+@route('POST', '/api/printers/<printer_id>/print/cancel')
+async def cancel_print(request, send):
+    return await send_json(send, await run_command(request.params['printer_id'], 'cancel'))
+
+
+@route('POST', '/api/printers/<printer_id>/ready')
+async def mark_printer_ready(request, send):
+    result = await run_command(request.params['printer_id'], 'ready')
+    job_dispatcher.notify()
+    return await send_json(send, result)
+
+
+@route('POST', '/api/printers/<printer_id>/light/toggle')
+async def toggle_light(request, send):
+    data = await request.json()
+    if 'state' in data:
+        try:
+            new_state = parse_led_state(data['state'])
+        except ValueError as e:
+            return await send_json(send, {'error': str(e)}, 400)
+        result = await run_command(request.params['printer_id'], 'led', state=new_state)
+        return await send_json(send, dict(result, state=new_state) if 'success' in result else result)
+
+    printer = await to_thread(printer_manager.get_printer, request.params['printer_id'])
+    if not printer:
+        return await send_json(send, {'error': 'Принтер не найден'})
+
+    try:
+        client = _client(printer)
+        response = await client.get('/printer/objects/query?led')
+        if response.status_code != 200:
+            return await send_json(send, {'error': f'Ошибка получения состояния подсветки: {response.status_code}'})
+        current_state = response.json()['result']['status']['led'].get('red', 0)
+        new_state = 0 if current_state > 0 else 255
+
+        set_response = await client.post('/printer/gcode/script', json=led_script(new_state))
+        if set_response.status_code != 200:
+            return await send_json(send, {'error': f'Ошибка установки подсветки: {set_response.status_code}'})
+        return await send_json(send, {'success': True, 'state': new_state})
+    except Exception as e:
+        logger.error(f"Ошибка переключения подсветки: {str(e) or type(e).__name__}")
+        return await send_json(send, {'error': str(e) or type(e).__name__})
+
+
+@route('POST', '/api/printers/bulk')
+async def bulk_printer_action(request, send):
+    try:
+        printer_ids, action, params, timeout = parse_bulk_request(await request.json())
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    results = await bulk_action(printer_ids, action, timeout=timeout, **params)
+    if action == 'ready':
+        job_dispatcher.notify()
+    return await send_json(send, bulk_response(action, results), request=request)
+
+
+@route('GET', '/api/printers/<printer_id>/files')
+async def get_printer_files(request, send):
+    """Список файлов из кэша постранично; к принтеру - только если кэш нужно обновить"""
+    printer_id = request.params['printer_id']
+    printer = await to_thread(printer_manager.get_printer, printer_id)
+    if not printer:
+        return await send_json(send, {'error': 'Принтер не найден'}, 404)
+    try:
+        params = files_page_params(request.args)
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    file_index = printer_manager.file_index
+    if printer_manager.files_need_sync(printer_id, refresh=request.args.get('refresh') in ('1', 'true')):
+        try:
+            response = await _client(printer).get('/server/files/list')
+            if response.status_code != 200:
+                return await send_json(send, {'error': f'Ошибка получения файлов: {response.status_code}'}, 500)
+            if file_index.replace(printer_id, response.json()['result']):
+                printer_manager.publish_files_version(printer_id)
+        except Exception as e:
+            return await send_json(send, {'error': str(e) or type(e).__name__}, 500)
+
+    page = file_index.page(printer_id, **params)
+    etag = f'"{page[0]}"'
+    if request.header('if-none-match') in (etag, 'W/' + etag):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': [(b'etag', etag.encode())]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return 304
+    return await send_json(send, files_page_response(page, params), headers=[(b'etag', etag.encode())],
+                           request=request)
+
+
+@route('GET', '/api/printers/<printer_id>/webcam/stream')
+async def webcam_stream(request, send):
+    """MJPEG-поток камеры: кадры от общего потока чтения без отдельного потока на зрителя"""
+    printer = await to_thread(printer_manager.get_printer, request.params['printer_id'])
+    camera = webcam_proxy.get(printer) if printer else None
+    if camera is None:
+        return await send_json(send, {'error': 'Камера не найдена'}, 404)
+
+    max_fps = app.config['WEBCAM_MAX_FPS']
+    min_interval = 1.0 / max_fps if max_fps else 0
+    loop = asyncio.get_running_loop()
+    frame_ready = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(frame_ready.set)
+
+    async def frames():
+        camera.attach(listener)
+        seq = 0
+        try:
+            while not camera.closed:
+                current, frame = camera.latest()
+                if current == seq or frame is None:
+                    try:
+                        await asyncio.wait_for(frame_ready.wait(), camera.timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    frame_ready.clear()
+                    continue
+                seq = current
+                yield multipart_part(frame)
+                if min_interval:
+                    await asyncio.sleep(min_interval)
+        finally:
+            camera.detach(listener)
+
+    return await send_stream(request, send, 'multipart/x-mixed-replace; boundary=frame', frames())
+
+
+# Задания: статус меняется атомарно, затем команды принтерам отправляются параллельно
+
+@route('POST', '/api/jobs/<job_id>/start')
+async def start_job(request, send):
+    job_id = request.params['job_id']
+    job = await to_thread(job_store.get, job_id)
+    error = job_start_error(job)
+    if error:
+        return await send_json(send, {'error': error[0]}, error[1])
+
+    try:
+        started = await to_thread(mark_job_running, job_id)
+    except (JobNotFound, JobConflict) as e:
+        return await send_json(send, *job_error(e))
+    if job['status'] == 'paused':
+        await bulk_action(job_active_printers(started), 'resume')
+    return await send_json(send, started)
+
+
+@route('POST', '/api/jobs/<job_id>/pause')
+async def pause_job(request, send):
+    try:
+        job = await to_thread(job_store.transition, request.params['job_id'], 'paused')
+    except (JobNotFound, JobConflict) as e:
+        return await send_json(send, *job_error(e))
+
+    await bulk_action(job_active_printers(job), 'pause')
+    return await send_json(send, job)
+
+
+@route('POST', '/api/jobs/<job_id>/cancel')
+async def cancel_job(request, send):
+    try:
+        job, printer_ids = await to_thread(mark_job_cancelled, request.params['job_id'])
+    except (JobNotFound, JobConflict) as e:
+        return await send_json(send, *job_error(e))
+
+    await bulk_action(printer_ids, 'cancel')
+    return await send_json(send, job)
+
+
+# Приложение
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await _startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def cors_headers(request):
+    """Заголовки Access-Control-* для ответа асинхронного маршрута"""
+    headers = get_cors_headers(CORS_OPTIONS, request.headers(), request.scope['method'])
+    return [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items(multi=True)]
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    # OPTIONS (preflight) не перехватывается: его обрабатывает Flask-CORS
+    if scope['type'] == 'http':
+        handler, params, pattern = _match(scope['method'], scope['path'])
+        if handler is not None:
+            await _startup()
+            request = Request(scope, receive, params)
+            cors = cors_headers(request)
+            response_started = False
+
+            async def send_response(message):
+                nonlocal response_started
+                if message['type'] == 'http.response.start':
+                    response_started = True
+                    message = dict(message, headers=[*message.get('headers', []), *cors])
+                await send(message)
+
+            started = time.perf_counter()
+            status = 500
+            try:
+                status = await handler(request, send_response)
+            except (ValueError, KeyError) as e:
+                if response_started:
+                    # Ответ уже начат (например, поток): статус не изменить, соединение закрывается
+                    logger.error(f"Ошибка в ответе {scope['path']}: {str(e)}")
+                    raise
+                status = await send_json(send_response, {'error': f'Неверный запрос: {str(e)}'}, 400)
+            finally:
+                HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=pattern,
+                                             method=scope['method'], status=status)
+            return
+
+    await wsgi_application(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host=app.config['HOST'], port=app.config['PORT'])
@@ -0,0 +1,6 @@
+"""
+Нагрузочные тесты F-CRM
+
+fake_moonraker - парк имитаций Moonraker (HTTP API и JSON-RPC WebSocket)
+load_test - запуск приложения, нагрузка на API и отчет в JSON
+"""
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Парк имитаций Moonraker для нагрузочных тестов
+
+Все принтеры обслуживаются одним циклом asyncio (aiohttp), каждый на своем
+порту: base_port, base_port + 1, ... Поддерживается то, чем пользуется F-CRM:
+/printer/info, /printer/objects/query, /server/files/list, /server/files/metadata,
+загрузка файлов, команды печати, /printer/gcode/script и WebSocket с подпиской
+на notify_status_update. Печать идет по часам: прогресс растет, температуры
+колеблются, по окончании принтер переходит в complete.
+
+Запуск отдельно:
+    python -m benchmarks.fake_moonraker --printers 100 --base-port 17125 --latency 20
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+
+from aiohttp import web, WSMsgType
+
+# Объекты Klipper, которые знает имитация
+OBJECTS = ('print_stats', 'virtual_sdcard', 'display_status', 'heater_bed', 'extruder', 'led')
+
+
+class FakePrinter:
+    """Состояние одного принтера"""
+
+    def __init__(self, index, files=20, print_seconds=600, printing=False):
+        self.index = index
+        self.hostname = f'fake-{index:03d}'
+        self.print_seconds = print_seconds
+        self.files = [
+            {'path': f'part_{n:03d}.gcode', 'size': random.randint(100_000, 20_000_000),
+             'modified': 1700000000.0 + n, 'permissions': 'rw'}
+            for n in range(files)
+        ]
+        self.state = 'standby'
+        self.filename = ''
+        self.elapsed = 0.0
+        self.led = 0
+        self.extruder = 22.0
+        self.bed = 21.0
+        self.sockets = set()
+        if printing and self.files:
+            self.start(random.choice(self.files)['path'])
+            self.elapsed = random.uniform(0, print_seconds * 0.9)
+
+    @property
+    def progress(self):
+        return min(1.0, self.elapsed / self.print_seconds) if self.filename else 0.0
+
+    def start(self, filename):
+        self.state = 'printing'
+        self.filename = filename
+        self.elapsed = 0.0
+
+    def gcode(self, script):
+        if script.startswith('SDCARD_RESET_FILE'):
+            self.state = 'standby'
+            self.filename = ''
+            self.elapsed = 0.0
+        match = re.search(r'RED=([\d.]+)', script)
+        if script.startswith('SET_LED') and match:
+            self.led = float(match.group(1))
+
+    def tick(self, dt):
+        """Продвижение печати и колебание температур; возвращает изменения"""
+        printing = self.state == 'printing'
+        target_extruder, target_bed = (210.0, 60.0) if printing else (0.0, 0.0)
+        self.extruder += (max(target_extruder, 22.0) - self.extruder) * 0.3 + random.uniform(-0.3, 0.3)
+        self.bed += (max(target_bed, 21.0) - self.bed) * 0.2 + random.uniform(-0.1, 0.1)
+        changes = {
+            'extruder': {'temperature': round(self.extruder, 2), 'target': target_extruder},
+            'heater_bed': {'temperature': round(self.bed, 2), 'target': target_bed},
+        }
+        if printing:
+            self.elapsed += dt
+            if self.elapsed >= self.print_seconds:
+                self.state = 'complete'
+            changes['print_stats'] = {'state': self.state, 'print_duration': round(self.elapsed, 1),
+                                      'total_duration': round(self.elapsed, 1)}
+            changes['virtual_sdcard'] = {'progress': round(self.progress, 4),
+                                         'is_active': self.state == 'printing'}
+            changes['display_status'] = {'progress': round(self.progress, 4)}
+        return changes
+
+    def objects(self, names=OBJECTS):
+        status = {
+            'print_stats': {
+                'state': self.state, 'filename': self.filename,
+                'print_duration': round(self.elapsed, 1), 'total_duration': round(self.elapsed, 1),
+                'filament_used': round(self.elapsed * 0.4, 1), 'message': '', 'info': {}
+            },
+            'virtual_sdcard': {'progress': round(self.progress, 4), 'is_active': self.state == 'printing',
+                               'file_path': self.filename or None},
+            'display_status': {'progress': round(self.progress, 4), 'message': None},
+            'extruder': {'temperature': round(self.extruder, 2), 'target': 210.0 if self.state == 'printing' else 0.0},
+            'heater_bed': {'temperature': round(self.bed, 2), 'target': 60.0 if self.state == 'printing' else 0.0},
+            'led': {'color_data': [[self.led] * 4], 'red': self.led},
+        }
+        return {name: status[name] for name in names if name in status}
+
+    def info(self):
+        return {'state': 'ready', 'state_message': 'Printer is ready', 'hostname': self.hostname,
+                'software_version': 'fake', 'klipper_path': '/home/pi/klipper'}
+
+    def file_metadata(self, filename):
+        entry = next((f for f in self.files if f['path'] == filename), None)
+        if entry is None:
+            return None
+        return dict(entry, filename=filename, estimated_time=self.print_seconds,
+                    filament_total=self.print_seconds * 0.4)
+
+
+class FakeFleet:
+    """N принтеров на последовательных портах с общей задержкой и долей ошибок"""
+
+    def __init__(self, count, base_port=17125, host='127.0.0.1', latency=0.0, jitter=0.0,
+                 failure_rate=0.0, files=20, print_seconds=600, printing_fraction=0.5,
+                 update_interval=1.0):
+        self.host = host
+        self.base_port = base_port
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.update_interval = update_interval
+        self.printers = [
+            FakePrinter(i, files=files, print_seconds=print_seconds,
+                        printing=random.random() < printing_fraction)
+            for i in range(count)
+        ]
+        self.runners = []
+        self.requests = 0
+        self.failures = 0
+        self._ticker = None
+
+    @property
+    def ports(self):
+        return [self.base_port + i for i in range(len(self.printers))]
+
+    async def start(self):
+        for printer, port in zip(self.printers, self.ports):
+            runner = web.AppRunner(self._make_app(printer), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, self.host, port, backlog=1024).start()
+            self.runners.append(runner)
+        self._ticker = asyncio.create_task(self._tick_loop())
+
+    async def stop(self):
+        if self._ticker:
+            self._ticker.cancel()
+        for runner in self.runners:
+            await runner.cleanup()
+
+    async def _delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    async def notify(self, printer, method, params):
+        """Уведомление всем WebSocket-подключениям принтера"""
+        message = json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params})
+        for ws, _ in list(printer.sockets):
+            if not ws.closed:
+                try:
+                    await ws.send_str(message)
+                except ConnectionError:
+                    pass
+
+    async def _tick_loop(self):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self.update_interval)
+            now = time.monotonic()
+            dt, last = now - last, now
+            for printer in self.printers:
+                changes = printer.tick(dt)
+                for ws, subscribed in list(printer.sockets):
+                    update = {k: v for k, v in changes.items() if k in subscribed}
+                    if update and not ws.closed:
+                        message = {'jsonrpc': '2.0', 'method': 'notify_status_update',
+                                   'params': [update, time.time()]}
+                        try:
+                            await ws.send_str(json.dumps(message))
+                        except ConnectionError:
+                            pass
+
+    def _make_app(self, printer):
+        fleet = self
+
+        @web.middleware
+        async def simulate(request, handler):
+            fleet.requests += 1
+            await fleet._delay()
+            if request.path != '/websocket' and random.random() < fleet.failure_rate:
+                fleet.failures += 1
+                return web.json_response({'error': {'code': 503, 'message': 'Simulated failure'}},
+                                         status=503)
+            return await handler(request)
+
+        def result(value):
+            return web.json_response({'result': value})
+
+        async def printer_info(request):
+            return result(printer.info())
+
+        async def server_info(request):
+            return result({'klippy_connected': True, 'klippy_state': 'ready',
+                           'moonraker_version': 'fake'})
+
+        async def objects_query(request):
+            names = [key.split('=')[0] for key in request.query_string.split('&') if key]
+            return result({'eventtime': time.time(), 'status': printer.objects(names)})
+
+        async def files_list(request):
+            return result(printer.files)
+
+        async def files_metadata(request):
+            metadata = printer.file_metadata(request.query.get('filename', ''))
+            if metadata is None:
+                return web.json_response({'error': {'code': 404, 'message': 'File not found'}},
+                                         status=404)
+            return result(metadata)
+
+        async def files_upload(request):
+            reader = await request.multipart()
+            size, filename = 0, None
+            async for part in reader:
+                if part.name == 'file':
+                    filename = part.filename
+                    while True:
+                        chunk = await part.read_chunk(64 * 1024)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+            if not filename:
+                return web.json_response({'error': {'code': 400, 'message': 'No file'}}, status=400)
+            action = 'modify_file' if any(f['path'] == filename for f in printer.files) else 'create_file'
+            item = {'path': filename, 'root': 'gcodes', 'size': size, 'modified': time.time(),
+                    'permissions': 'rw'}
+            printer.files = [f for f in printer.files if f['path'] != filename]
+            printer.files.append({k: v for k, v in item.items() if k != 'root'})
+            await fleet.notify(printer, 'notify_filelist_changed', [{'action': action, 'item': item}])
+            return web.json_response({'result': {'item': item, 'action': action}}, status=201)
+
+        async def print_start(request):
+            body = await request.json() if request.can_read_body else {}
+            printer.start(body.get('filename') or request.query.get('filename', ''))
+            return result('ok')
+
+        async def print_pause(request):
+            if printer.state == 'printing':
+                printer.state = 'paused'
+            return result('ok')
+
+        async def print_resume(request):
+            if printer.state == 'paused':
+                printer.state = 'printing'
+            return result('ok')
+
+        async def print_cancel(request):
+            if printer.state in ('printing', 'paused'):
+                printer.state = 'cancelled'
+            return result('ok')
+
+        async def gcode_script(request):
+            body = await request.json() if request.can_read_body else {}
+            printer.gcode(body.get('script') or request.query.get('script', ''))
+            return result('ok')
+
+        async def websocket(request):
+            ws = web.WebSocketResponse(heartbeat=None)
+            await ws.prepare(request)
+            entry = None
+            try:
+                async for message in ws:
+                    if message.type != WSMsgType.TEXT:
+                        continue
+                    call = json.loads(message.data)
+                    method, params = call.get('method'), call.get('params') or {}
+                    if method == 'printer.objects.subscribe':
+                        names = list((params.get('objects') or {}).keys())
+                        printer.sockets.discard(entry)
+                        entry = (ws, frozenset(names))
+                        printer.sockets.add(entry)
+                        reply = {'eventtime': time.time(), 'status': printer.objects(names)}
+                    elif method == 'printer.objects.query':
+                        reply = {'eventtime': time.time(),
+                                 'status': printer.objects(list((params.get('objects') or {}).keys()))}
+                    elif method == 'printer.info':
+                        reply = printer.info()
+                    elif method == 'server.files.list':
+                        reply = printer.files
+                    else:
+                        reply = 'ok'
+                    await fleet._delay()
+                    await ws.send_str(json.dumps({'jsonrpc': '2.0', 'id': call.get('id'), 'result': reply}))
+            finally:
+                printer.sockets.discard(entry)
+            return ws
+
+        app = web.Application(middlewares=[simulate], client_max_size=1024 ** 3)
+        app.router.add_get('/printer/info', printer_info)
+        app.router.add_get('/server/info', server_info)
+        app.router.add_get('/printer/objects/query', objects_query)
+        app.router.add_get('/server/files/list', files_list)
+        app.router.add_get('/server/files/metadata', files_metadata)
+        app.router.add_post('/server/files/upload', files_upload)
+        app.router.add_post('/printer/print/start', print_start)
+        app.router.add_post('/printer/print/pause', print_pause)
+        app.router.add_post('/printer/print/resume', print_resume)
+        app.router.add_post('/printer/print/cancel', print_cancel)
+        app.router.add_post('/printer/gcode/script', gcode_script)
+        app.router.add_get('/websocket', websocket)
+        return app
+
+
+def add_fleet_arguments(parser):
+    """Параметры парка (общие для запуска отдельно и из load_test)"""
+    parser.add_argument('--printers', type=int, default=100, help='число принтеров')
+    parser.add_argument('--base-port', type=int, default=17125, help='порт первого принтера')
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='разброс задержки, ± мс')
+    parser.add_argument('--failure-rate', type=float, default=0, help='доля HTTP-запросов с ответом 503')
+    parser.add_argument('--files', type=int, default=20, help='файлов на каждом принтере')
+    parser.add_argument('--print-seconds', type=float, default=600, help='длительность одной печати')
+    parser.add_argument('--printing-fraction', type=float, default=0.5, help='доля принтеров, печатающих при старте')
+    parser.add_argument('--update-interval', type=float, default=1.0, help='секунд между notify_status_update')
+    parser.add_argument('--seed', type=int, default=None, help='seed генератора случайных чисел')
+
+
+def fleet_from_arguments(args):
+    if args.seed is not None:
+        random.seed(args.seed)
+    return FakeFleet(
+        args.printers, base_port=args.base_port, latency=args.latency / 1000,
+        jitter=args.jitter / 1000, failure_rate=args.failure_rate, files=args.files,
+        print_seconds=args.print_seconds, printing_fraction=args.printing_fraction,
+        update_interval=args.update_interval
+    )
+
+
+async def serve(fleet):
+    await fleet.start()
+    # Строка готовности читается load_test перед регистрацией принтеров
+    print(json.dumps({'ready': True, 'host': fleet.host, 'ports': fleet.ports}), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fleet.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Парк имитаций Moonraker')
+    add_fleet_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(fleet_from_arguments(args)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест F-CRM на имитированном парке принтеров
+
+Запускает парк fake_moonraker и приложение (Flask или asgi.py) во временной
+папке, регистрирует принтеры и по очереди прогоняет фазы нагрузки. Все время
+теста открыты SSE-потоки «дашбордов». Результат - JSON с пропускной
+способностью, перцентилями задержек по операциям и памятью процесса
+приложения; его удобно сохранять и сравнивать между версиями.
+
+Пример:
+    python -m benchmarks.load_test --printers 100 --dashboards 20 --server asgi \\
+        --duration 20 --latency 20 --output results.json
+
+С --url нагрузка подается на уже запущенное приложение; зарегистрированные
+тестом принтеры в конце удаляются.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import aiohttp
+
+from benchmarks.fake_moonraker import add_fleet_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Фазы нагрузки: операция -> вес в случайной смеси
+PHASES = {
+    'printers': {'printers': 1},
+    'status': {'status': 3, 'printer_status': 1},
+    'jobs': {'jobs_list': 3, 'job_create': 1, 'job_cancel': 1},
+    'upload': {'upload': 1},
+    'mixed': {'printers': 2, 'status': 6, 'printer_status': 2, 'jobs_list': 2,
+              'job_create': 1, 'job_cancel': 1, 'upload': 1},
+}
+
+
+def percentile(sorted_values, q):
+    """Перцентиль по ближайшему рангу (значения уже отсортированы)"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(latencies):
+    """Сводка задержек в миллисекундах"""
+    values = sorted(latencies)
+    if not values:
+        return {}
+    summary = {f'p{q}': round(percentile(values, q) * 1000, 2) for q in (50, 90, 95, 99)}
+    summary['mean'] = round(sum(values) / len(values) * 1000, 2)
+    summary['max'] = round(values[-1] * 1000, 2)
+    return summary
+
+
+class Recorder:
+    """Задержки и коды ответов по операциям"""
+
+    def __init__(self):
+        self.operations = {}
+
+    def record(self, operation, elapsed, status):
+        entry = self.operations.setdefault(operation, {'latencies': [], 'statuses': {}, 'errors': 0})
+        entry['latencies'].append(elapsed)
+        entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+        if not isinstance(status, int) or status >= 400:
+            entry['errors'] += 1
+
+    def summary(self, duration):
+        operations = {}
+        all_latencies = []
+        errors = 0
+        for name, entry in sorted(self.operations.items()):
+            count = len(entry['latencies'])
+            operations[name] = {
+                'requests': count,
+                'rps': round(count / duration, 2) if duration else None,
+                'errors': entry['errors'],
+                'statuses': entry['statuses'],
+                'latency_ms': latency_summary(entry['latencies']),
+            }
+            all_latencies.extend(entry['latencies'])
+            errors += entry['errors']
+        return {
+            'duration': round(duration, 2),
+            'requests': len(all_latencies),
+            'rps': round(len(all_latencies) / duration, 2) if duration else None,
+            'errors': errors,
+            'latency_ms': latency_summary(all_latencies),
+            'operations': operations,
+        }
+
+
+class ProcessMonitor:
+    """Память и число потоков процесса приложения (/proc, только Linux)"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def read(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                fields = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            return None
+        return {'rss_mb': round(int(fields['VmRSS'].split()[0]) / 1024, 1),
+                'threads': int(fields['Threads'])}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            sample = self.read()
+            if sample:
+                self.samples.append((time.monotonic(), sample))
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def window(self, since=0):
+        """Пиковые значения с момента since (time.monotonic)"""
+        samples = [s for t, s in self.samples if t >= since]
+        if not samples:
+            return None
+        return {'rss_peak_mb': max(s['rss_mb'] for s in samples),
+                'threads_peak': max(s['threads'] for s in samples)}
+
+
+class LoadTest:
+    def __init__(self, args, base_url, session):
+        self.args = args
+        self.base_url = base_url
+        self.session = session
+        self.printer_ids = []
+        self.job_ids = []
+        self.upload_body = (b'G1 X10 Y10 E0.5 F3000\n' * (args.upload_size * 1024 // 22 + 1))[:args.upload_size * 1024]
+        self.uploads = 0
+
+    async def request(self, recorder, operation, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            async with self.session.request(method, self.base_url + path, **kwargs) as response:
+                body = await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            recorder.record(operation, time.perf_counter() - started, type(e).__name__)
+            return None
+        elapsed = time.perf_counter() - started
+        data = json.loads(body) if body and status < 400 else None
+        # Ошибки Moonraker приложение часто возвращает с кодом 200 и полем error
+        if isinstance(data, dict) and 'error' in data:
+            status = f'{status} error'
+        recorder.record(operation, elapsed, status)
+        return data
+
+    # Операции
+
+    async def op_printers(self, recorder):
+        await self.request(recorder, 'printers', 'GET', '/api/printers')
+
+    async def op_status(self, recorder):
+        await self.request(recorder, 'status', 'GET', '/api/printers/status')
+
+    async def op_printer_status(self, recorder):
+        printer_id = random.choice(self.printer_ids)
+        await self.request(recorder, 'printer_status', 'GET', f'/api/printers/{printer_id}/status')
+
+    async def op_jobs_list(self, recorder):
+        await self.request(recorder, 'jobs_list', 'GET', '/api/jobs')
+
+    async def op_job_create(self, recorder):
+        job = await self.request(recorder, 'job_create', 'POST', '/api/jobs', json={
+            'name': 'benchmark', 'filename': 'part_000.gcode', 'quantity': 1,
+            'printers': random.sample(self.printer_ids, min(2, len(self.printer_ids)))
+        })
+        if job and 'id' in job:
+            self.job_ids.append(job['id'])
+
+    async def op_job_cancel(self, recorder):
+        if not self.job_ids:
+            return await self.op_jobs_list(recorder)
+        job_id = self.job_ids.pop(random.randrange(len(self.job_ids)))
+        await self.request(recorder, 'job_cancel', 'POST', f'/api/jobs/{job_id}/cancel')
+
+    async def op_upload(self, recorder):
+        self.uploads += 1
+        printer_id = random.choice(self.printer_ids)
+        await self.request(
+            recorder, 'upload', 'POST',
+            f'/api/printers/{printer_id}/upload?filename=bench_{self.uploads:05d}.gcode',
+            data=self.upload_body, headers={'Content-Type': 'application/octet-stream'}
+        )
+
+    # Этапы
+
+    async def register_printers(self, ports, host):
+        recorder = Recorder()
+        semaphore = asyncio.Semaphore(10)
+        started = time.monotonic()
+
+        async def register(index, port):
+            async with semaphore:
+                printer = await self.request(recorder, 'register', 'POST', '/api/printers', json={
+                    'name': f'Bench {index:03d}', 'ip_address': host, 'port': port
+                })
+                if printer and 'id' in printer:
+                    self.printer_ids.append(printer['id'])
+
+        await asyncio.gather(*(register(i, port) for i, port in enumerate(ports)))
+        return recorder.summary(time.monotonic() - started)
+
+    async def wait_online(self, timeout):
+        """Секунды до появления всех зарегистрированных принтеров в сети (None - не дождались)"""
+        started = time.monotonic()
+        while time.monotonic() - started < timeout:
+            try:
+                async with self.session.get(self.base_url + '/api/printers/status') as response:
+                    statuses = (await response.json()).get('printers', {})
+                online = sum(1 for pid in self.printer_ids if (statuses.get(pid) or {}).get('online'))
+                if online >= len(self.printer_ids):
+                    return round(time.monotonic() - started, 2)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                pass
+            await asyncio.sleep(0.5)
+        return None
+
+    async def run_phase(self, name):
+        weights = PHASES[name]
+        operations = [getattr(self, f'op_{op}') for op in weights]
+        recorder = Recorder()
+        deadline = time.monotonic() + self.args.duration
+        started = time.monotonic()
+
+        async def worker():
+            while time.monotonic() < deadline:
+                operation = random.choices(operations, weights=list(weights.values()))[0]
+                await operation(recorder)
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        return recorder.summary(time.monotonic() - started)
+
+    async def server_metrics(self):
+        """Сводка из /metrics приложения: проходы опроса и ошибки запросов к Moonraker"""
+        try:
+            async with self.session.get(self.base_url + '/metrics') as response:
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        values = {'poller_cycles': 0, 'poller_cycle_seconds': 0.0, 'moonraker_errors': 0}
+        for line in text.splitlines():
+            if line.startswith('fcrm_poller_cycle_duration_seconds_count'):
+                values['poller_cycles'] = int(float(line.split()[-1]))
+            elif line.startswith('fcrm_poller_cycle_duration_seconds_sum'):
+                values['poller_cycle_seconds'] = float(line.split()[-1])
+            elif line.startswith('fcrm_moonraker_errors_total'):
+                values['moonraker_errors'] += int(float(line.split()[-1]))
+        cycles = values.pop('poller_cycles')
+        total = values.pop('poller_cycle_seconds')
+        values['poller_cycles'] = cycles
+        values['poller_cycle_mean_ms'] = round(total / cycles * 1000, 2) if cycles else None
+        return values
+
+    async def cleanup(self):
+        for printer_id in self.printer_ids:
+            try:
+                async with self.session.delete(f'{self.base_url}/api/printers/{printer_id}'):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+
+
+class Dashboards:
+    """Открытые SSE-потоки статусов, как у вкладок браузера с дашбордом"""
+
+    def __init__(self, count, base_url, session):
+        self.count = count
+        self.base_url = base_url
+        self.session = session
+        self.first_event = []
+        self.events = 0
+        self.bytes = 0
+        self.disconnects = 0
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._stream()) for _ in range(self.count)]
+
+    async def _stream(self):
+        while True:
+            started = time.perf_counter()
+            got_snapshot = False
+            try:
+                async with self.session.get(self.base_url + '/api/printers/stream',
+                                            timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as response:
+                    buffer = b''
+                    async for chunk in response.content.iter_any():
+                        self.bytes += len(chunk)
+                        buffer += chunk
+                        *events, buffer = buffer.split(b'\n\n')
+                        for event in events:
+                            if not event.startswith(b'event:'):
+                                continue
+                            self.events += 1
+                            if not got_snapshot:
+                                got_snapshot = True
+                                self.first_event.append(time.perf_counter() - started)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            self.disconnects += 1
+            await asyncio.sleep(1)
+
+    async def stop(self, duration):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        return {
+            'streams': self.count,
+            'connected': len(self.first_event),
+            'events': self.events,
+            'events_per_second': round(self.events / duration, 2) if duration else None,
+            'bytes': self.bytes,
+            'disconnects': self.disconnects,
+            'time_to_snapshot_ms': latency_summary(self.first_event),
+        }
+
+
+def start_fleet(args):
+    command = [sys.executable, '-m', 'benchmarks.fake_moonraker',
+               '--printers', str(args.printers), '--base-port', str(args.base_port),
+               '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--failure-rate', str(args.failure_rate), '--files', str(args.files),
+               '--print-seconds', str(args.print_seconds),
+               '--printing-fraction', str(args.printing_fraction),
+               '--update-interval', str(args.update_interval)]
+    if args.seed is not None:
+        command += ['--seed', str(args.seed)]
+    process = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.PIPE, text=True)
+    ready = json.loads(process.stdout.readline() or '{}')
+    if not ready.get('ready'):
+        process.terminate()
+        raise RuntimeError('Парк имитаций Moonraker не запустился')
+    return process, ready
+
+
+def start_server(args, data_dir):
+    env = dict(
+        os.environ,
+        FLASK_ENV='production',
+        HOST='127.0.0.1',
+        PORT=str(args.port),
+        DATABASE_FILE=os.path.join(data_dir, 'f-crm.db'),
+        TELEMETRY_DATABASE_FILE=os.path.join(data_dir, 'telemetry.db'),
+        UPLOAD_FOLDER=os.path.join(data_dir, 'uploads'),
+        LOG_FILE=os.path.join(data_dir, 'f-crm.log'),
+    )
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--app-dir', REPO_DIR,
+                   '--host', '127.0.0.1', '--port', str(args.port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, os.path.join(REPO_DIR, 'app.py')]
+    log = open(os.path.join(data_dir, 'server.log'), 'wb')
+    return subprocess.Popen(command, cwd=data_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(session, base_url, process, timeout):
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Приложение завершилось с кодом {process.returncode}')
+        try:
+            async with session.get(base_url + '/api/printers') as response:
+                if response.status == 200:
+                    return round(time.monotonic() - started, 2)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('Приложение не ответило за отведенное время')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    fleet, fleet_info = start_fleet(args)
+    data_dir = None
+    server = None
+    result = {
+        'benchmark': 'f-crm-load',
+        'format_version': 1,
+        'started': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': vars(args),
+    }
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            data_dir = tempfile.mkdtemp(prefix='f-crm-bench-')
+            server = start_server(args, data_dir)
+            base_url = f'http://127.0.0.1:{args.port}'
+
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            test = LoadTest(args, base_url, session)
+            result['server'] = {'mode': 'external' if args.url else args.server,
+                                'startup_seconds': await wait_ready(session, base_url, server,
+                                                                    args.startup_timeout)}
+            monitor = ProcessMonitor(server.pid) if server else None
+            if monitor:
+                monitor.start()
+
+            result['register'] = await test.register_printers(fleet_info['ports'], fleet_info['host'])
+            result['server']['printers_online_seconds'] = await test.wait_online(args.startup_timeout)
+            if monitor:
+                result['server']['memory_idle'] = monitor.read()
+
+            dashboards = Dashboards(args.dashboards, base_url, session)
+            dashboards.start()
+            load_started = time.monotonic()
+            result['phases'] = {}
+            for name in args.phases:
+                phase_started = time.monotonic()
+                result['phases'][name] = await test.run_phase(name)
+                if monitor:
+                    result['phases'][name]['memory'] = monitor.window(phase_started)
+                print(f"{name}: {result['phases'][name]['rps']} запросов/с, "
+                      f"p99 {result['phases'][name]['latency_ms'].get('p99')} мс, "
+                      f"ошибок {result['phases'][name]['errors']}", file=sys.stderr)
+
+            result['dashboards'] = await dashboards.stop(time.monotonic() - load_started)
+            result['server_metrics'] = await test.server_metrics()
+            if monitor:
+                monitor.stop()
+                result['memory'] = dict(monitor.window(load_started) or {}, end=monitor.read())
+            if args.url:
+                await test.cleanup()
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        fleet.terminate()
+        fleet.wait()
+        if data_dir and not args.keep_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        elif data_dir:
+            print(f'Данные приложения: {data_dir}', file=sys.stderr)
+    result['finished'] = datetime.now().isoformat()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест F-CRM на имитированном парке принтеров')
+    add_fleet_arguments(parser)
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help='режим запуска приложения (flask - app.py, asgi - uvicorn asgi:application)')
+    parser.add_argument('--url', help='адрес уже запущенного приложения (тогда оно не запускается)')
+    parser.add_argument('--port', type=int, default=5099, help='порт запускаемого приложения')
+    parser.add_argument('--dashboards', type=int, default=20, help='открытых SSE-потоков статусов')
+    parser.add_argument('--concurrency', type=int, default=20, help='одновременных клиентов в фазе')
+    parser.add_argument('--duration', type=float, default=10, help='длительность каждой фазы, с')
+    parser.add_argument('--phases', type=lambda s: [p for p in s.split(',') if p],
+                        default=list(PHASES), help=f"фазы через запятую: {','.join(PHASES)}")
+    parser.add_argument('--upload-size', type=int, default=256, help='размер загружаемого файла, КБ')
+    parser.add_argument('--request-timeout', type=float, default=30, help='таймаут запроса, с')
+    parser.add_argument('--startup-timeout', type=float, default=60, help='ожидание запуска приложения и принтеров, с')
+    parser.add_argument('--output', help='файл для результата JSON (по умолчанию stdout)')
+    parser.add_argument('--keep-data', action='store_true', help='не удалять временную папку приложения')
+    args = parser.parse_args()
+
+    unknown = [p for p in args.phases if p not in PHASES]
+    if unknown:
+        parser.error(f"неизвестные фазы: {', '.join(unknown)}")
+
+    result = asyncio.run(run(args))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Сжатие ответов API
+
+Выбор кодировки по Accept-Encoding: Brotli (если установлен модуль brotli),
+иначе gzip. Уровни подобраны для сжатия на лету: JSON статусов и списков
+сжимается в 5-15 раз за доли миллисекунды.
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:  # Brotli не установлен - используется только gzip
+    brotli = None
+
+BROTLI_AVAILABLE = brotli is not None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/csv', 'text/html',
+                      'text/css', 'text/javascript', 'application/javascript')
+
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' или None по заголовку Accept-Encoding (q=0 - запрет)"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if BROTLI_AVAILABLE and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', accepted.get('*', 0)) > 0:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
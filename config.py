@@ -19,10 +19,20 @@ class Config:
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))  # 100MB
     ALLOWED_EXTENSIONS = {'gcode', 'g', 'gco', 'gcode.gz', 'ufp', '3mf'}
+    LIBRARY_COMPRESS_LEVEL = int(os.environ.get('LIBRARY_COMPRESS_LEVEL', 6))  # gzip для G-code в библиотеке
+    WEBCAM_SNAPSHOT_INTERVAL = float(os.environ.get('WEBCAM_SNAPSHOT_INTERVAL', 2))  # секунд между запросами снимков к камере
+    WEBCAM_IDLE_TIMEOUT = int(os.environ.get('WEBCAM_IDLE_TIMEOUT', 10))  # отключение от камеры без зрителей
+    WEBCAM_THUMBNAIL_WIDTH = int(os.environ.get('WEBCAM_THUMBNAIL_WIDTH', 320))
+    WEBCAM_MAX_FPS = int(os.environ.get('WEBCAM_MAX_FPS', 15))
+    GCODE_ANALYZER_WORKERS = int(os.environ.get('GCODE_ANALYZER_WORKERS', 2))  # фоновый разбор метаданных G-code
+    DISTRIBUTION_WORKERS = int(os.environ.get('DISTRIBUTION_WORKERS', 8))  # параллельных загрузок при рассылке
+    UPLOAD_MIN_BANDWIDTH = int(os.environ.get('UPLOAD_MIN_BANDWIDTH', 256 * 1024))  # байт/с, для таймаута загрузки
     
     # Настройки базы данных
     PRINTERS_FILE = os.environ.get('PRINTERS_FILE', 'printers.json')
     PRINT_JOBS_FILE = os.environ.get('PRINT_JOBS_FILE', 'print_jobs.json')
+    DATABASE_FILE = os.environ.get('DATABASE_FILE', os.path.join('data', 'f-crm.db'))
+    TELEMETRY_DATABASE_FILE = os.environ.get('TELEMETRY_DATABASE_FILE', os.path.join('data', 'telemetry.db'))
     
     # Настройки Moonraker
     MOONRAKER_DEFAULT_PORT = int(os.environ.get('MOONRAKER_DEFAULT_PORT', 7125))
@@ -31,6 +41,33 @@ class Config:
     # Настройки обновления статуса
     STATUS_UPDATE_INTERVAL = int(os.environ.get('STATUS_UPDATE_INTERVAL', 5))  # секунды
     REQUEST_TIMEOUT = int(os.environ.get('REQUEST_TIMEOUT', 10))  # секунды
+    STATUS_POLL_WORKERS = int(os.environ.get('STATUS_POLL_WORKERS', 32))  # параллельных опросов
+    MOONRAKER_WEBSOCKET = os.environ.get('MOONRAKER_WEBSOCKET', 'True').lower() == 'true'  # push-обновления
+    STATUS_STREAM_MAX_RATE = float(os.environ.get('STATUS_STREAM_MAX_RATE', 2))  # событий в секунду
+    FILE_LIST_REFRESH_INTERVAL = int(os.environ.get('FILE_LIST_REFRESH_INTERVAL', 300))  # секунд между полными списками файлов без WebSocket
+    BULK_ACTION_TIMEOUT = float(os.environ.get('BULK_ACTION_TIMEOUT', 5))  # секунд на принтер в групповых командах
+    BULK_ACTION_WORKERS = int(os.environ.get('BULK_ACTION_WORKERS', 32))  # параллельных групповых команд
+    ASGI_WSGI_WORKERS = int(os.environ.get('ASGI_WSGI_WORKERS', 16))  # потоков для маршрутов Flask в режиме asgi.py
+    COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', 'True').lower() == 'true'  # gzip/Brotli для ответов API
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # байт, меньшие ответы не сжимаются
+    
+    # Настройки телеметрии
+    TELEMETRY_INTERVAL = int(os.environ.get('TELEMETRY_INTERVAL', 10))  # секунд между сэмплами
+    TELEMETRY_RAW_HOURS = int(os.environ.get('TELEMETRY_RAW_HOURS', 24))  # хранение исходных сэмплов
+    TELEMETRY_MINUTE_DAYS = int(os.environ.get('TELEMETRY_MINUTE_DAYS', 14))  # хранение средних по минутам
+    TELEMETRY_RETENTION_DAYS = int(os.environ.get('TELEMETRY_RETENTION_DAYS', 365))  # хранение средних по 15 минут
+    REPORTS_UPDATE_INTERVAL = int(os.environ.get('REPORTS_UPDATE_INTERVAL', 30))  # секунд между обновлениями сумм отчетов
+    
+    # Настройки планировщика заданий
+    SCHEDULER_AUTO_CONTINUE = os.environ.get('SCHEDULER_AUTO_CONTINUE', 'False').lower() == 'true'  # без подтверждения очистки стола
+    SCHEDULER_MAX_RETRIES = int(os.environ.get('SCHEDULER_MAX_RETRIES', 3))  # повторов неудачных копий
+    ETA_REFIT_INTERVAL = int(os.environ.get('ETA_REFIT_INTERVAL', 600))  # секунд между переобучениями модели времени печати
+    ETA_HALF_LIFE_DAYS = float(os.environ.get('ETA_HALF_LIFE_DAYS', 30))  # вес печати вдвое меньше каждые N дней
+    
+    # Профилирование запросов (cProfile); файлы .prof сохраняются в PROFILE_DIR
+    PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', 'False').lower() == 'true'
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+    PROFILE_MIN_MS = int(os.environ.get('PROFILE_MIN_MS', 100))  # сохранять запросы не короче, мс
     
     # Настройки логирования
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
@@ -93,6 +130,8 @@ class TestingConfig(Config):
     DEBUG = True
     PRINTERS_FILE = 'test_printers.json'
     PRINT_JOBS_FILE = 'test_print_jobs.json'
+    DATABASE_FILE = 'test_f-crm.db'
+    TELEMETRY_DATABASE_FILE = 'test_telemetry.db'
 
 config = {
     'development': DevelopmentConfig,
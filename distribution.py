@@ -0,0 +1,185 @@
+"""
+Параллельная рассылка файлов библиотеки на набор принтеров
+"""
+
+import hashlib
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при хэшировании файла, скачиваемого с принтера
+HASH_CHUNK_SIZE = 256 * 1024
+
+
+class FileDistributor:
+    """Загрузка одного файла на много принтеров ограниченным пулом потоков
+
+    Для каждого принтера в коллекции deliveries запоминается хэш отправленного
+    файла вместе с размером и временем изменения, которые сообщил Moonraker.
+    Если при следующей рассылке Moonraker сообщает те же размер и время, а хэш
+    совпадает с хэшем файла библиотеки, повторная загрузка пропускается.
+    Если записи о доставке нет, а на принтере уже лежит файл с тем же путем
+    и размером (загружен вручную или до F-CRM), файл скачивается с принтера
+    и хэшируется: при совпадении содержимого загрузка пропускается, а доставка
+    записывается по данным Moonraker.
+    """
+
+    def __init__(self, storage, printer_manager, max_workers=8, keep_tasks=50):
+        self.storage = storage
+        self.printer_manager = printer_manager
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='distribute')
+        self.keep_tasks = keep_tasks
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def distribute(self, file_info, printer_ids, force=False):
+        """Запуск рассылки; возвращает описание задачи с прогрессом по принтерам"""
+        task = {
+            'id': uuid.uuid4().hex,
+            'file_id': file_info['id'],
+            'filename': file_info['name'],
+            'created': datetime.now().isoformat(),
+            'finished': None,
+            'printers': {
+                printer_id: {'status': 'queued', 'upload_id': None, 'error': None}
+                for printer_id in printer_ids
+            }
+        }
+        with self.lock:
+            finished = [k for k, t in self.tasks.items() if t['finished']]
+            for task_id in finished[:max(0, len(self.tasks) - self.keep_tasks)]:
+                del self.tasks[task_id]
+            self.tasks[task['id']] = task
+
+        sha256 = file_info['sha256']
+        remaining = [len(printer_ids)]
+
+        def run(printer_id):
+            try:
+                self._deliver(task, printer_id, file_info, sha256, force)
+            except Exception as e:
+                logger.error(f"Рассылка {file_info['name']} на {printer_id}: {str(e)}")
+                task['printers'][printer_id].update({'status': 'failed', 'error': str(e)})
+            finally:
+                with self.lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        task['finished'] = datetime.now().isoformat()
+
+        if not printer_ids:
+            task['finished'] = task['created']
+        for printer_id in printer_ids:
+            self.executor.submit(run, printer_id)
+        return self.get_task(task['id'])
+
+    def get_task(self, task_id):
+        """Состояние рассылки с байтовым прогрессом активных загрузок"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            result = dict(task, printers={k: dict(v) for k, v in task['printers'].items()})
+
+        uploads = {u['id']: u for u in self.printer_manager.get_uploads()}
+        for entry in result['printers'].values():
+            upload = uploads.get(entry['upload_id'])
+            if upload:
+                entry['sent'] = upload['sent']
+                entry['size'] = upload['size']
+        return result
+
+    def get_tasks(self):
+        with self.lock:
+            task_ids = list(self.tasks)
+        return [self.get_task(task_id) for task_id in reversed(task_ids)]
+
+    def _deliver(self, task, printer_id, file_info, sha256, force):
+        entry = task['printers'][printer_id]
+        printer = self.printer_manager.get_printer(printer_id)
+        if not printer:
+            entry.update({'status': 'failed', 'error': 'Принтер не найден'})
+            return
+
+        client = self.printer_manager.get_client(printer)
+        filename = file_info['name']
+        delivery_id = f"{printer_id}:{filename}"
+
+        entry['status'] = 'checking'
+        if not force:
+            delivery = self.storage.get('deliveries', delivery_id)
+            # Размер и время изменения из кэша списка файлов, запрос к принтеру - если файла там нет
+            remote = (self.printer_manager.file_index.get(printer_id, filename)
+                      or _remote_file_info(client, filename))
+            if (delivery and remote and delivery['sha256'] == sha256
+                    and delivery['size'] == remote.get('size')
+                    and delivery['modified'] == remote.get('modified')):
+                entry['status'] = 'skipped'
+                return
+            if (not delivery and remote and remote.get('size') == file_info['size']
+                    and _remote_sha256(client, filename) == sha256):
+                # Файл загружен на принтер до F-CRM или вручную: записей о доставке нет,
+                # но содержимое файла с тем же путем совпадает - считаем его доставленным
+                self._record_delivery(delivery_id, printer_id, filename, sha256,
+                                      remote if 'modified' in remote else _remote_file_info(client, filename))
+                entry['status'] = 'skipped'
+                return
+
+        entry['status'] = 'uploading'
+        entry['upload_id'] = uuid.uuid4().hex
+        result = self.printer_manager.upload_library_file(
+            printer_id, file_info, upload_id=entry['upload_id'])
+        if 'error' in result:
+            entry.update({'status': 'failed', 'error': result['error']})
+            return
+
+        remote = _remote_file_info(client, filename) or {}
+        if remote:
+            self.printer_manager.record_file(printer_id, filename, size=remote.get('size'),
+                                             modified=remote.get('modified'))
+        self._record_delivery(delivery_id, printer_id, filename, sha256, remote)
+        entry['status'] = 'done'
+
+    def _record_delivery(self, delivery_id, printer_id, filename, sha256, remote):
+        remote = remote or {}
+        self.storage.put('deliveries', {
+            'id': delivery_id,
+            'printer_id': printer_id,
+            'filename': filename,
+            'sha256': sha256,
+            'size': remote.get('size'),
+            'modified': remote.get('modified'),
+            'delivered': datetime.now().isoformat()
+        })
+
+
+def _remote_file_info(client, filename):
+    """Размер и время изменения файла по данным Moonraker (None, если файла нет)"""
+    try:
+        response = client.get('/server/files/metadata', params={'filename': filename})
+        if response.status_code != 200:
+            return None
+        return response.json().get('result')
+    except Exception:
+        return None
+
+
+def _remote_sha256(client, filename):
+    """SHA-256 содержимого файла на принтере (None, если скачать не удалось)
+
+    Moonraker не сообщает хэш файла, поэтому файл читается потоком целиком.
+    """
+    digest = hashlib.sha256()
+    try:
+        with client.get(f"/server/files/gcodes/{quote(filename)}", stream=True) as response:
+            if response.status_code != 200:
+                return None
+            for chunk in response.iter_content(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+    except Exception:
+        return None
+    return digest.hexdigest()
@@ -0,0 +1,327 @@
+"""
+Оценка времени печати по истории парка
+
+Модель учится на завершенных копиях заданий: для каждой известны оценка
+слайсера (estimated_seconds задания) и фактическое время печати с принтера
+(print_duration копии). Логарифм отношения факт/оценка раскладывается на общую
+поправку и поправки принтера и материала. Это гребневая регрессия: поправки
+принтеров и материалов с малым числом печатей прижимаются к общей, а свежие
+печати весят больше старых (полупериод half_life_days). Интервал [low, high] -
+10-й и 90-й процентили остатков модели на тех же печатях.
+
+Обучение выполняется в фоновом потоке (start) не чаще раза в refit_interval
+и только если задания изменились; запросы и планировщик берут последнюю
+обученную модель без блокировок. Обучение и прогноз - матричные операции
+numpy сразу по всем копиям и по всем парам задание-принтер. Прогноз очереди раскладывает оставшиеся копии заданий
+по принтерам в порядке приоритета, начиная с момента освобождения каждого
+принтера; у печатающихся копий оценка уточняется по фактическому прогрессу.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from scheduler import ACTIVE_COPY_STATES, FINISHED_STATES, FREE_STATES, PRIORITY_RANK
+
+logger = logging.getLogger(__name__)
+
+# Сила прижатия поправок принтера и материала к общей (в "печатях")
+RIDGE = 2.0
+# Меньше печатей с оценкой слайсера - модель не обучается, оценки слайсера не меняются
+MIN_SAMPLES = 5
+INTERVAL_QUANTILES = (0.1, 0.9)
+# Прогресс, начиная с которого учитывается фактическая скорость печати
+MIN_LIVE_PROGRESS = 0.02
+
+
+def _timestamp(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _actual_seconds(copy):
+    """Фактическое время печати копии: print_duration принтера или время от запуска до завершения"""
+    if copy.get('print_duration'):
+        return float(copy['print_duration'])
+    started, finished = _timestamp(copy.get('started')), _timestamp(copy.get('finished'))
+    if started is None or finished is None or finished <= started:
+        return None
+    return finished - started
+
+
+def _weighted_quantiles(values, weights, quantiles):
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    cumulative = (cumulative - weights[order] / 2) / cumulative[-1]
+    return np.interp(quantiles, cumulative, values[order])
+
+
+def _iso(now, seconds):
+    if seconds is None or not np.isfinite(seconds):
+        return None
+    return datetime.fromtimestamp(now + seconds).isoformat(timespec='seconds')
+
+
+class PrintTimeEstimator:
+    """Модель времени печати и прогноз очереди заданий"""
+
+    def __init__(self, storage, refit_interval=600, half_life_days=30):
+        self.storage = storage
+        self.refit_interval = refit_interval
+        self.half_life_days = half_life_days
+        # Модель заменяется целиком одним присваиванием, поэтому читается без блокировки
+        self._model = self.fit([])
+        self._fitted_version = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='eta-model', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refit()
+            except Exception as e:
+                logger.error(f"Ошибка обучения модели времени печати: {str(e)}")
+            time.sleep(self.refit_interval)
+
+    def refit(self):
+        """Переобучение, если задания изменились с прошлого обучения; True - модель обновлена"""
+        version = self.storage.version('jobs')
+        if version == self._fitted_version:
+            return False
+        self._model = self.fit(self.storage.all('jobs'))
+        self._fitted_version = version
+        return True
+
+    def model(self):
+        """Последняя обученная модель (до первого обучения - оценки слайсера без поправок)"""
+        return self._model
+
+    def fit(self, jobs, now=None):
+        """Обучение по завершенным копиям заданий"""
+        now = now or time.time()
+        rows = []
+        file_seconds = {}
+        for job in jobs:
+            for copy in job.get('copies', []):
+                if copy['status'] != 'done':
+                    continue
+                actual = _actual_seconds(copy)
+                if actual is None:
+                    continue
+                file_seconds.setdefault(job['filename'], []).append(actual)
+                if job.get('estimated_seconds'):
+                    rows.append((copy['printer_id'], job.get('material') or '', float(job['estimated_seconds']),
+                                 actual, _timestamp(copy.get('finished')) or now))
+
+        model = {
+            'samples': len(rows),
+            'coef': np.zeros(1),
+            'printers': {},
+            'materials': {},
+            'interval': None,
+            'file_seconds': {name: float(np.median(values)) for name, values in file_seconds.items()},
+            'trained': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+        }
+        if len(rows) < MIN_SAMPLES:
+            return model
+
+        printer_ids, materials, estimates, actual, finished = zip(*rows)
+        printers = {p: i for i, p in enumerate(sorted(set(printer_ids)))}
+        material_index = {m: i for i, m in enumerate(sorted(set(materials)))}
+        n, offset = len(rows), 1 + len(printers)
+
+        X = np.zeros((n, offset + len(material_index)))
+        X[:, 0] = 1.0
+        X[np.arange(n), 1 + np.fromiter((printers[p] for p in printer_ids), int, n)] = 1.0
+        X[np.arange(n), offset + np.fromiter((material_index[m] for m in materials), int, n)] = 1.0
+        y = np.log(np.asarray(actual) / np.asarray(estimates))
+        age_days = np.maximum(0.0, now - np.asarray(finished)) / 86400
+        weights = 0.5 ** (age_days / self.half_life_days)
+
+        penalty = np.full(X.shape[1], RIDGE)
+        penalty[0] = 1e-9
+        coef = np.linalg.solve(X.T @ (X * weights[:, None]) + np.diag(penalty), X.T @ (weights * y))
+        residuals = y - X @ coef
+
+        model.update({
+            'coef': coef,
+            'printers': printers,
+            'materials': {m: offset + i for m, i in material_index.items()},
+            'interval': tuple(_weighted_quantiles(residuals, weights, INTERVAL_QUANTILES)),
+        })
+        return model
+
+    def describe(self, model=None):
+        """Параметры модели для API: множители к оценке слайсера"""
+        model = model or self.model()
+        coef = model['coef']
+        return {
+            'samples': model['samples'],
+            'trained': model['trained'],
+            'ratio': round(float(np.exp(coef[0])), 3),
+            'interval': [round(float(np.exp(q)), 3) for q in model['interval']] if model['interval'] else None,
+            'printers': {p: round(float(np.exp(coef[0] + coef[1 + i])), 3) for p, i in model['printers'].items()},
+            'materials': {m: round(float(np.exp(coef[0] + coef[i])), 3) for m, i in model['materials'].items()},
+        }
+
+    def predict(self, estimates, printer_ids, materials, filenames=None, model=None):
+        """Ожидаемое время печати в секундах: массивы (оценка, нижняя граница, верхняя граница)
+
+        estimates - оценки слайсера (None - нет). Без оценки слайсера берется
+        медиана прошлых печатей того же файла, без истории - nan.
+        """
+        model = model or self.model()
+        coef = model['coef']
+        count = len(estimates)
+        base = np.array([e if e else np.nan for e in estimates], dtype=float)
+        log_ratio = np.zeros(count)
+        if model['interval'] is not None:
+            printer_columns = np.array([model['printers'].get(p, -1) for p in printer_ids], dtype=int)
+            material_columns = np.array([model['materials'].get(m or '', 0) for m in materials], dtype=int)
+            log_ratio = (coef[0] + np.where(printer_columns >= 0, coef[1 + printer_columns], 0.0)
+                         + np.where(material_columns > 0, coef[material_columns], 0.0))
+        if filenames is not None:
+            history = np.array([model['file_seconds'].get(f, np.nan) for f in filenames], dtype=float)
+            from_history = np.isnan(base)
+            base = np.where(from_history, history, base)
+            log_ratio = np.where(from_history, 0.0, log_ratio)
+
+        seconds = base * np.exp(log_ratio)
+        if model['interval'] is None:
+            return seconds, np.full(count, np.nan), np.full(count, np.nan)
+        low, high = model['interval']
+        return seconds, seconds * np.exp(low), seconds * np.exp(high)
+
+    def predict_job(self, job, printer_ids):
+        """Ожидаемое время печати одной копии задания на каждом из принтеров"""
+        count = len(printer_ids)
+        seconds, _, _ = self.predict([job.get('estimated_seconds')] * count, printer_ids,
+                                     [job.get('material')] * count, [job['filename']] * count)
+        return seconds
+
+    # Прогноз очереди
+
+    def forecast(self, jobs, statuses, now=None):
+        """Когда освободится каждый принтер и когда завершится каждое задание
+
+        statuses - кэш статусов принтеров {printer_id: статус}. Оставшиеся копии
+        заданий (running, затем pending, по приоритету) раскладываются на принтер,
+        где копия закончится раньше всего.
+        """
+        now = now or time.time()
+        # Одна модель на весь прогноз, даже если фоновый поток успеет ее заменить
+        model = self.model()
+        printer_ids = list(statuses)
+        job_by_id = {job['id']: job for job in jobs}
+        active = {c['printer_id']: (job, c) for job in jobs if job['status'] in ('running', 'paused')
+                  for c in job.get('copies', []) if c['status'] in ACTIVE_COPY_STATES}
+
+        # Оценка текущих копий: по модели и по фактической скорости печати
+        current = [active.get(p, (None, None)) for p in printer_ids]
+        model_seconds, _, _ = self.predict(
+            [(j or {}).get('estimated_seconds') for j, _ in current], printer_ids,
+            [(j or {}).get('material') for j, _ in current], [(j or {}).get('filename') for j, _ in current],
+            model=model)
+
+        printers = {}
+        free_at = {}
+        for i, printer_id in enumerate(printer_ids):
+            status = statuses[printer_id] or {}
+            job, copy = current[i]
+            remaining = self._remaining_seconds(status, copy, model_seconds[i])
+            state = (status.get('print_stats') or {}).get('state')
+            if not status.get('online'):
+                remaining = None
+            elif copy is None and (state in FREE_STATES or state in FINISHED_STATES):
+                remaining = 0.0
+            printers[printer_id] = {
+                'job_id': job['id'] if job else None,
+                'remaining_seconds': round(remaining) if remaining is not None else None,
+                'free_at': _iso(now, remaining),
+            }
+            if remaining is not None:
+                free_at[printer_id] = remaining
+
+        job_end = {}
+        for job, copy in active.values():
+            remaining = free_at.get(copy['printer_id'], np.inf)
+            job_end[job['id']] = max(job_end.get(job['id'], 0.0), remaining)
+
+        queue = sorted((job for job in jobs if job['status'] in ('running', 'pending')),
+                       key=lambda j: (j['status'] != 'running', PRIORITY_RANK.get(j.get('priority'), 1),
+                                      j.get('created') or '', j['id']))
+        candidates = [p for p in printer_ids if p in free_at]
+        left = {}
+        if candidates and queue:
+            # Время копии каждого задания на каждом принтере - одним вызовом модели
+            pairs = [(job, p) for job in queue for p in candidates]
+            seconds, _, _ = self.predict([j.get('estimated_seconds') for j, _ in pairs], [p for _, p in pairs],
+                                         [j.get('material') for j, _ in pairs], [j['filename'] for j, _ in pairs],
+                                         model=model)
+            seconds = seconds.reshape(len(queue), len(candidates))
+            ready = np.array([free_at[p] for p in candidates])
+            for row, job in enumerate(queue):
+                copies = job.get('copies', [])
+                used = sum(1 for c in copies if c['status'] in ACTIVE_COPY_STATES + ('done',))
+                left[job['id']] = max(0, int(job.get('quantity') or 1) - used)
+                allowed = np.array([not job['printers'] or p in job['printers'] for p in candidates])
+                for _ in range(left[job['id']]):
+                    finish = np.where(allowed & np.isfinite(seconds[row]), ready + seconds[row], np.inf)
+                    best = int(np.argmin(finish))
+                    if not np.isfinite(finish[best]):
+                        job_end[job['id']] = np.inf
+                        break
+                    ready[best] = finish[best]
+                    job_end[job['id']] = max(job_end.get(job['id'], 0.0), finish[best])
+            for printer_id, value in zip(candidates, ready):
+                printers[printer_id]['queue_free_at'] = _iso(now, value)
+
+        low, high = np.exp(model['interval']) if model['interval'] else (None, None)
+        forecast_jobs = {}
+        for job_id, end in job_end.items():
+            finite = bool(np.isfinite(end))
+            forecast_jobs[job_id] = {
+                'status': job_by_id[job_id]['status'],
+                'copies_left': left.get(job_id, 0),
+                'remaining_seconds': round(float(end)) if finite else None,
+                'eta': _iso(now, end) if finite else None,
+                'eta_low': _iso(now, end * low) if finite and low else None,
+                'eta_high': _iso(now, end * high) if finite and high else None,
+            }
+        return {
+            'generated': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            'model': self.describe(model),
+            'printers': printers,
+            'jobs': forecast_jobs,
+        }
+
+    def _remaining_seconds(self, status, copy, model_total):
+        """Оставшееся время текущей печати: модель, уточненная фактическим прогрессом"""
+        print_stats = status.get('print_stats') or {}
+        if print_stats.get('state') not in ('printing', 'paused'):
+            return model_total if copy is not None and np.isfinite(model_total) else None
+        elapsed = float(print_stats.get('print_duration') or 0)
+        progress = (status.get('virtual_sdcard') or {}).get('progress') or 0
+        if copy is not None and copy.get('estimated_seconds'):
+            model_total = float(copy['estimated_seconds'])
+
+        total = model_total if np.isfinite(model_total) else None
+        if progress >= MIN_LIVE_PROGRESS and elapsed > 0:
+            live = elapsed / progress
+            # Чем дальше печать, тем больше вес фактической скорости
+            total = live if total is None else progress * live + (1 - progress) * total
+        if total is None:
+            return None
+        return max(0.0, total - elapsed)
@@ -0,0 +1,176 @@
+"""
+Кэш списков файлов на принтерах
+
+Список G-code каждого принтера хранится в памяти процесса и обновляется
+инкрементально: по notify_filelist_changed из WebSocket-подписки, после
+загрузок через F-CRM и периодическим полным запросом для принтеров без
+подписки. В статус принтера попадает только версия списка (files_version),
+а сам список отдается постранично из кэша.
+
+Версия - хэш путей, размеров и времен изменения, поэтому одинаковый список
+дает одинаковую версию во всех рабочих процессах.
+"""
+
+import hashlib
+import threading
+import time
+
+# Поля записи файла, которые отдаются клиентам
+FILE_FIELDS = ('path', 'size', 'modified', 'permissions')
+
+SORT_KEYS = {
+    'modified': (lambda f: f.get('modified') or 0, True),
+    'path': (lambda f: f['path'].lower(), False),
+    'size': (lambda f: f.get('size') or 0, True),
+}
+
+
+def same_file(printer_filename, job_filename):
+    """Файл на принтере совпадает с именем задания (в корне или во вложенной папке)"""
+    if not printer_filename:
+        return False
+    return printer_filename == job_filename or printer_filename.endswith('/' + job_filename)
+
+
+def normalize_entry(item):
+    """Запись файла Moonraker в едином виде (старые версии отдают filename вместо path)"""
+    path = item.get('path') or item.get('filename')
+    if not path:
+        return None
+    entry = {key: item[key] for key in FILE_FIELDS if key in item}
+    entry['path'] = path
+    return entry
+
+
+class PrinterFiles:
+    """Файлы одного принтера"""
+
+    def __init__(self):
+        self.by_path = {}
+        self.version = None
+        self.synced = 0
+        self._sorted = {}
+
+    def changed(self):
+        digest = hashlib.sha1()
+        for path in sorted(self.by_path):
+            entry = self.by_path[path]
+            digest.update(f"{path}\0{entry.get('size')}\0{entry.get('modified')}\n".encode())
+        version = digest.hexdigest()[:12]
+        if version == self.version:
+            return False
+        self.version = version
+        self._sorted = {}
+        return True
+
+    def sorted(self, sort):
+        if sort not in self._sorted:
+            key, reverse = SORT_KEYS[sort]
+            self._sorted[sort] = sorted(self.by_path.values(), key=key, reverse=reverse)
+        return self._sorted[sort]
+
+
+class FileIndex:
+    """Списки файлов всех принтеров с версиями"""
+
+    def __init__(self):
+        self.printers = {}
+        self.lock = threading.Lock()
+
+    def _files(self, printer_id):
+        files = self.printers.get(printer_id)
+        if files is None:
+            files = self.printers[printer_id] = PrinterFiles()
+        return files
+
+    def replace(self, printer_id, items):
+        """Полный список от Moonraker; True, если список изменился"""
+        entries = (normalize_entry(item) for item in items or [])
+        with self.lock:
+            files = self._files(printer_id)
+            files.by_path = {e['path']: e for e in entries if e}
+            files.synced = time.monotonic()
+            return files.changed()
+
+    def apply_change(self, printer_id, change):
+        """Изменение из notify_filelist_changed: True/False - изменился ли список,
+        None - нужен полный список
+
+        Изменения папок и изменения до первой синхронизации не применяются
+        по отдельности: список запрашивается целиком.
+        """
+        item = change.get('item') or {}
+        if item.get('root', 'gcodes') != 'gcodes':
+            return False
+        action = change.get('action')
+        with self.lock:
+            files = self.printers.get(printer_id)
+            if files is None or files.version is None or action not in (
+                    'create_file', 'modify_file', 'delete_file', 'move_file'):
+                return None
+            if action in ('delete_file', 'move_file'):
+                source = change.get('source_item') if action == 'move_file' else change.get('item')
+                files.by_path.pop((normalize_entry(source or {}) or {}).get('path'), None)
+            if action != 'delete_file':
+                entry = normalize_entry(item)
+                if entry:
+                    files.by_path[entry['path']] = entry
+            return files.changed()
+
+    def add(self, printer_id, path, size=None, modified=None):
+        """Файл, загруженный через F-CRM (до уведомления от принтера); True - список изменился
+
+        modified - только время от Moonraker: местное время у каждого рабочего
+        процесса свое, и версии списков разошлись бы. Без него время изменения
+        заполнит notify_filelist_changed или следующий полный запрос списка.
+        """
+        with self.lock:
+            files = self.printers.get(printer_id)
+            if files is None or files.version is None:
+                return False
+            entry = files.by_path.setdefault(path, {'path': path, 'permissions': 'rw'})
+            if size is not None:
+                entry['size'] = size
+            if modified is not None:
+                entry['modified'] = modified
+            else:
+                entry.pop('modified', None)
+            return files.changed()
+
+    def remove(self, printer_id):
+        with self.lock:
+            self.printers.pop(printer_id, None)
+
+    def version(self, printer_id):
+        with self.lock:
+            files = self.printers.get(printer_id)
+            return files.version if files else None
+
+    def is_stale(self, printer_id, max_age):
+        """Список не загружался или старше max_age секунд"""
+        with self.lock:
+            files = self.printers.get(printer_id)
+            return files is None or files.version is None or time.monotonic() - files.synced > max_age
+
+    def get(self, printer_id, filename):
+        """Запись файла по имени (None - нет в списке или список не загружен)"""
+        with self.lock:
+            files = self.printers.get(printer_id)
+            if files is None:
+                return None
+            entry = files.by_path.get(filename)
+            if entry is None:
+                entry = next((e for e in files.by_path.values() if same_file(e['path'], filename)), None)
+            return dict(entry) if entry else None
+
+    def page(self, printer_id, offset=0, limit=100, sort='modified', query=None):
+        """(версия, всего, страница) или None, если список еще не загружен"""
+        with self.lock:
+            files = self.printers.get(printer_id)
+            if files is None or files.version is None:
+                return None
+            items = files.sorted(sort)
+            if query:
+                query = query.lower()
+                items = [f for f in items if query in f['path'].lower()]
+            return files.version, len(items), [dict(f) for f in items[offset:offset + limit]]
@@ -0,0 +1,316 @@
+"""
+Извлечение метаданных из G-code: время печати, расход филамента, слои, миниатюры
+
+Слайсеры пишут сводку в комментарии в начале (Cura, Simplify3D) или в конце
+файла (PrusaSlicer, SuperSlicer, OrcaSlicer), поэтому для несжатых файлов
+читаются только первый и последний блоки через mmap. Весь файл проходится
+только если в заголовке и хвосте нет числа слоев.
+
+Сжатые файлы библиотеки не распаковываются: при приеме файла библиотека
+пропускает поток через GcodeScanner и сохраняет рядом с gzip несжатую сводку
+(файл .scan) - первый и последний блоки и число слоев. Полная распаковка
+нужна только для файлов, сохраненных без сводки.
+
+Результаты кэшируются по SHA-256 содержимого в коллекции analyses.
+"""
+
+import base64
+import gzip
+import logging
+import mmap
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+HEAD_SIZE = 1024 * 1024
+TAIL_SIZE = 256 * 1024
+CHUNK_SIZE = 1024 * 1024
+ANALYZED_TYPES = ('gcode', 'g', 'gco')
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)\s*(d|h|m|s)[a-z]*', re.I)
+
+# (поле, регулярное выражение, преобразование); первое найденное значение побеждает
+_FIELDS = [
+    ('slicer', re.compile(r'^;\s*generated (?:by|with) (\S+)', re.I), str),
+    ('slicer', re.compile(r'^;\s*G-Code generated by (\S+)', re.I), str),
+    ('estimated_time', re.compile(r'^;\s*estimated printing time(?: \(normal mode\))?\s*=\s*(.+)$', re.I), '_duration'),
+    ('estimated_time', re.compile(r'^;\s*total estimated time:\s*(.+)$', re.I), '_duration'),
+    ('estimated_time', re.compile(r'^;TIME:(\d+)', re.I), float),
+    ('estimated_time', re.compile(r'^;\s*Build time:\s*(.+)$', re.I), '_duration'),
+    ('estimated_time', re.compile(r'^;Print Time:\s*(\d+(?:\.\d+)?)', re.I), float),
+    ('filament_length', re.compile(r'^;\s*(?:total )?filament used \[mm\]\s*[=:]\s*([\d.]+)', re.I), float),
+    ('filament_length', re.compile(r'^;\s*total filament length \[mm\]\s*:\s*([\d.]+)', re.I), float),
+    ('filament_length', re.compile(r'^;Filament used:\s*([\d.]+)m', re.I), '_meters'),
+    ('filament_length', re.compile(r'^;\s*Filament length:\s*([\d.]+)\s*mm', re.I), float),
+    ('filament_weight', re.compile(r'^;\s*(?:total )?filament used \[g\]\s*[=:]\s*([\d.]+)', re.I), float),
+    ('filament_weight', re.compile(r'^;\s*total filament weight \[g\]\s*:\s*([\d.]+)', re.I), float),
+    ('filament_weight', re.compile(r'^;\s*Plastic weight:\s*([\d.]+)\s*g', re.I), float),
+    ('layer_count', re.compile(r'^;LAYER_COUNT:(\d+)', re.I), int),
+    ('layer_count', re.compile(r'^;\s*total layers? (?:count|number)\s*[=:]\s*(\d+)', re.I), int),
+    ('layer_height', re.compile(r'^;\s*layer_height\s*=\s*([\d.]+)', re.I), float),
+    ('layer_height', re.compile(r'^;\s*Layer height:\s*([\d.]+)', re.I), float),
+    ('object_height', re.compile(r'^;\s*max_layer_z\s*=\s*([\d.]+)', re.I), float),
+    ('object_height', re.compile(r'^;MAXZ:([\d.]+)', re.I), float),
+    ('filament_type', re.compile(r'^;\s*filament_type\s*=\s*(\S+)', re.I), str),
+]
+
+_THUMBNAIL_BEGIN = re.compile(r'^;\s*thumbnail(?:_(\w+))? begin (\d+)x(\d+)', re.I)
+_THUMBNAIL_END = re.compile(r'^;\s*thumbnail(?:_\w+)? end', re.I)
+_LAYER_MARKER = re.compile(rb'^;(?:LAYER_CHANGE|LAYER:\d+)', re.M)
+_SUMMARY_MAGIC = 'FCRM-SCAN-1'
+
+
+def parse_duration(text):
+    """'1d 2h 3m 4s' / '1 hours 2 minutes' -> секунды"""
+    text = text.strip()
+    if re.fullmatch(r'\d+(?:\.\d+)?', text):
+        return float(text)
+    multipliers = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+    parts = _DURATION_PART.findall(text)
+    if not parts:
+        return None
+    return float(sum(float(value) * multipliers[unit.lower()] for value, unit in parts))
+
+
+def format_duration(seconds):
+    """Секунды -> '2ч 15м' для отображения"""
+    if seconds is None:
+        return 'Неизвестно'
+    minutes = int(round(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}ч {minutes:02d}м" if hours else f"{minutes}м"
+
+
+def _convert(kind, value):
+    if kind == '_duration':
+        return parse_duration(value)
+    if kind == '_meters':
+        return float(value) * 1000
+    return kind(value)
+
+
+def parse_comments(text, metadata, thumbnails):
+    """Разбор комментариев блока текста: заполняет metadata и список миниатюр"""
+    thumbnail = None
+    for line in text.splitlines():
+        if not line.startswith(';'):
+            continue
+
+        if thumbnail is not None:
+            if _THUMBNAIL_END.match(line):
+                thumbnails.append(thumbnail)
+                thumbnail = None
+            else:
+                thumbnail['data'].append(line[1:].strip())
+            continue
+        match = _THUMBNAIL_BEGIN.match(line)
+        if match:
+            thumbnail = {'format': (match.group(1) or 'png').lower(),
+                         'width': int(match.group(2)), 'height': int(match.group(3)), 'data': []}
+            continue
+
+        for field, pattern, kind in _FIELDS:
+            if field in metadata:
+                continue
+            match = pattern.match(line)
+            if match:
+                try:
+                    value = _convert(kind, match.group(1))
+                except ValueError:
+                    continue
+                if value is not None:
+                    metadata[field] = value
+
+
+def analyze(path, compressed=False):
+    """Метаданные G-code файла; миниатюры возвращаются в поле thumbnails (байты)"""
+    metadata = {}
+    thumbnails = []
+
+    if compressed:
+        head, tail, layers = read_summary(summary_path(path)) or _scan_gzip(path)
+        parse_comments(head.decode('utf-8', 'replace'), metadata, thumbnails)
+        parse_comments(tail.decode('utf-8', 'replace'), metadata, thumbnails)
+        if 'layer_count' not in metadata and layers:
+            metadata['layer_count'] = layers
+    else:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if size == 0:
+                return {'thumbnails': []}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                head = data[:HEAD_SIZE]
+                tail = data[max(HEAD_SIZE, size - TAIL_SIZE):]
+                parse_comments(head.decode('utf-8', 'replace'), metadata, thumbnails)
+                parse_comments(tail.decode('utf-8', 'replace'), metadata, thumbnails)
+                if 'layer_count' not in metadata:
+                    # Полный проход нужен только когда слайсер не записал число слоев
+                    layers = sum(1 for _ in _LAYER_MARKER.finditer(data))
+                    if layers:
+                        metadata['layer_count'] = layers
+
+    metadata['thumbnails'] = [
+        {'format': t['format'], 'width': t['width'], 'height': t['height'],
+         'data': base64.b64decode(''.join(t['data']))}
+        for t in thumbnails
+    ]
+    return metadata
+
+
+class GcodeScanner:
+    """Первый блок, последний блок и число слоев за один проход по потоку"""
+
+    def __init__(self):
+        self.head = bytearray()
+        self.tail = deque()
+        self.tail_size = 0
+        self.total = 0
+        self.layers = 0
+        self.carry = b''
+
+    def feed(self, chunk):
+        if len(self.head) < HEAD_SIZE:
+            self.head += chunk[:HEAD_SIZE - len(self.head)]
+        self.tail.append(chunk)
+        self.tail_size += len(chunk)
+        self.total += len(chunk)
+        while self.tail_size - len(self.tail[0]) >= TAIL_SIZE:
+            self.tail_size -= len(self.tail.popleft())
+
+        # Маркер слоя может оказаться на границе блоков: неполная строка переносится
+        block = self.carry + chunk
+        cut = block.rfind(b'\n') + 1
+        self.layers += sum(1 for _ in _LAYER_MARKER.finditer(block, 0, cut))
+        self.carry = block[cut:]
+
+    def finish(self):
+        """(начало, хвост, число слоев)"""
+        layers = self.layers + sum(1 for _ in _LAYER_MARKER.finditer(self.carry))
+        # Хвост не должен повторять уже прочитанное начало файла
+        tail_length = min(TAIL_SIZE, max(0, self.total - HEAD_SIZE))
+        tail = b''.join(self.tail)[-tail_length:] if tail_length else b''
+        return bytes(self.head), tail, layers
+
+
+def _scan_gzip(path):
+    """Полный проход по сжатому файлу без сводки"""
+    scanner = GcodeScanner()
+    with gzip.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            scanner.feed(chunk)
+    return scanner.finish()
+
+
+def summary_path(path):
+    """Путь к несжатой сводке сжатого файла библиотеки"""
+    return path + '.scan'
+
+
+def write_summary(path, head, tail, layers):
+    """Сводка: строка заголовка с числом слоев и длинами блоков, затем сами блоки"""
+    with open(path, 'wb') as f:
+        f.write(f"{_SUMMARY_MAGIC} {layers} {len(head)} {len(tail)}\n".encode())
+        f.write(head)
+        f.write(tail)
+
+
+def read_summary(path):
+    """(начало, хвост, число слоев) из сводки или None, если ее нет или она повреждена"""
+    try:
+        with open(path, 'rb') as f:
+            magic, layers, head_size, tail_size = f.readline().decode('ascii').split()
+            if magic != _SUMMARY_MAGIC:
+                return None
+            head = f.read(int(head_size))
+            tail = f.read(int(tail_size))
+    except (OSError, ValueError):
+        return None
+    if len(head) != int(head_size) or len(tail) != int(tail_size):
+        return None
+    return head, tail, int(layers)
+
+
+class GcodeAnalyzer:
+    """Фоновый анализ файлов библиотеки с кэшем результатов по SHA-256"""
+
+    def __init__(self, storage, thumbnails_dir, max_workers=2, on_analyzed=None):
+        self.storage = storage
+        self.thumbnails_dir = thumbnails_dir
+        self.on_analyzed = on_analyzed
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gcode-analyzer')
+        self.pending = set()
+        self.lock = threading.Lock()
+        self._started = False
+        os.makedirs(self.thumbnails_dir, exist_ok=True)
+
+    def start(self):
+        """Однократный запуск анализа файлов, загруженных до появления анализатора"""
+        with self.lock:
+            if self._started:
+                return
+            self._started = True
+        self.submit_missing()
+
+    def cached(self, sha256):
+        """Готовый результат анализа или None"""
+        return self.storage.get('analyses', sha256)
+
+    def submit(self, file_info):
+        """Постановка файла в очередь анализа (повторы одного содержимого схлопываются)"""
+        if file_info.get('type') not in ANALYZED_TYPES or not file_info.get('sha256'):
+            return
+        sha256 = file_info['sha256']
+        with self.lock:
+            if sha256 in self.pending:
+                return
+            self.pending.add(sha256)
+        self.executor.submit(self._run, file_info)
+
+    def submit_missing(self):
+        """Постановка в очередь всех файлов без метаданных"""
+        for file_info in self.storage.all('files'):
+            if 'metadata' not in file_info:
+                self.submit(file_info)
+
+    def thumbnail_path(self, sha256, thumbnail):
+        return os.path.join(self.thumbnails_dir,
+                            f"{sha256}-{thumbnail['width']}x{thumbnail['height']}.{thumbnail['format']}")
+
+    def _run(self, file_info):
+        sha256 = file_info['sha256']
+        try:
+            result = self.cached(sha256)
+            if result is None:
+                result = self._analyze(file_info)
+            if self.on_analyzed:
+                self.on_analyzed(sha256, result)
+        except Exception as e:
+            logger.error(f"Ошибка анализа файла {file_info['name']}: {str(e)}")
+        finally:
+            with self.lock:
+                self.pending.discard(sha256)
+
+    def _analyze(self, file_info):
+        sha256 = file_info['sha256']
+        metadata = analyze(file_info['path'], compressed=file_info.get('compressed', False))
+
+        thumbnails = []
+        for thumbnail in metadata.pop('thumbnails'):
+            path = self.thumbnail_path(sha256, thumbnail)
+            with open(path, 'wb') as f:
+                f.write(thumbnail['data'])
+            thumbnails.append({'format': thumbnail['format'], 'width': thumbnail['width'],
+                               'height': thumbnail['height'], 'size': len(thumbnail['data'])})
+
+        result = dict(metadata, id=sha256, thumbnails=thumbnails,
+                      analyzed=datetime.now().isoformat())
+        self.storage.put('analyses', result)
+        logger.info(f"Файл {file_info['name']} проанализирован: "
+                    f"{format_duration(metadata.get('estimated_time'))}, "
+                    f"слоев {metadata.get('layer_count', '?')}")
+        return result
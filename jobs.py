@@ -0,0 +1,193 @@
+"""
+Жизненный цикл заданий печати
+
+Задания изменяются только через JobStore.modify: документ читается, изменяется
+и записывается в одной транзакции BEGIN IMMEDIATE, которая блокирует запись во
+всех рабочих процессах, поэтому одновременные запросы и планировщик не затирают
+изменения друг друга. Внутри транзакции переходы статусов задания и его копий
+сверяются с таблицами допустимых переходов, увеличивается revision задания
+и в журнал job_events добавляются события.
+
+revision используется для compare-and-set: изменение с ожидаемой ревизией
+(If-Match у PUT /api/jobs/<id>) отклоняется, если задание уже изменил кто-то другой.
+"""
+
+import copy
+from datetime import datetime
+
+# Допустимые переходы статуса задания (переход в тот же статус ничего не меняет)
+JOB_TRANSITIONS = {
+    'pending': ('running', 'cancelled'),
+    'running': ('paused', 'completed', 'failed', 'cancelled'),
+    'paused': ('running', 'completed', 'failed', 'cancelled'),
+    'failed': ('running', 'cancelled'),
+    'completed': (),
+    'cancelled': (),
+}
+
+# Допустимые переходы статуса копии задания
+COPY_TRANSITIONS = {
+    'starting': ('printing', 'failed', 'cancelled'),
+    'printing': ('done', 'failed', 'cancelled'),
+    'done': (),
+    'failed': (),
+    'cancelled': (),
+}
+
+# Поля, которые можно менять через PUT /api/jobs/<id>
+EDITABLE_FIELDS = ('name', 'filename', 'quantity', 'priority', 'material', 'printers', 'estimated_time')
+# Файл задания меняется только до запуска: на него уже ссылаются копии
+PENDING_ONLY_FIELDS = ('filename',)
+
+# Поля, изменения которых отражаются в журнале отдельными событиями или не отражаются вовсе
+_TRACKED_FIELDS = ('status', 'copies', 'progress', 'files_printed', 'current_file_index',
+                   'started', 'completed', 'modified', 'revision')
+# Итоги завершенной копии, которые записываются в журнал (время и расход по данным принтера)
+_COPY_TOTALS = ('started', 'finished', 'print_duration', 'filament_used', 'filament_weight')
+
+
+class JobNotFound(LookupError):
+    """Задание не найдено"""
+
+
+class JobConflict(Exception):
+    """Задание изменено другим запросом или находится в неподходящем состоянии"""
+
+    def __init__(self, message, job=None):
+        super().__init__(message)
+        self.job = job
+
+
+class InvalidTransition(JobConflict):
+    """Недопустимый переход статуса задания или копии"""
+
+
+def can_transition(current, new, transitions=JOB_TRANSITIONS):
+    return current == new or new in transitions.get(current, ())
+
+
+def check_transition(current, new, transitions=JOB_TRANSITIONS, job=None, what='задания'):
+    if not can_transition(current, new, transitions):
+        raise InvalidTransition(f"Недопустимый переход {what}: {current} -> {new}", job)
+
+
+def _events(before, after):
+    """События журнала по разнице двух версий задания (с проверкой переходов)"""
+    events = []
+    if before['status'] != after['status']:
+        check_transition(before['status'], after['status'], job=before)
+        data = {'from': before['status'], 'to': after['status']}
+        if after['status'] == 'completed':
+            # Сроки выполнения нужны отчетам и после удаления задания
+            data.update({key: after.get(key) for key in ('created', 'started', 'completed')})
+        events.append(('status', data))
+
+    old_copies = before.get('copies', [])
+    for new in after.get('copies', []):
+        old = old_copies[new['index']] if new['index'] < len(old_copies) else None
+        if old is not None and old['status'] == new['status']:
+            continue
+        if old is not None:
+            check_transition(old['status'], new['status'], COPY_TRANSITIONS, before,
+                             f"копии {new['index'] + 1}")
+        data = {
+            'index': new['index'], 'printer_id': new['printer_id'],
+            'from': old['status'] if old else None, 'to': new['status'],
+            **({'error': new['error']} if new.get('error') else {}),
+        }
+        if not COPY_TRANSITIONS.get(new['status'], ()):
+            # Завершенная копия описана в журнале полностью: отчеты читают только его
+            data.update({key: new.get(key) for key in _COPY_TOTALS})
+            data.update({'material': after.get('material'), 'filename': after.get('filename')})
+        events.append(('copy', data))
+
+    if before.get('progress') != after.get('progress'):
+        events.append(('progress', {'progress': after.get('progress'),
+                                    'files_printed': after.get('files_printed')}))
+
+    fields = sorted(key for key in set(before) | set(after)
+                    if key not in _TRACKED_FIELDS and before.get(key) != after.get(key))
+    if fields:
+        events.append(('updated', {'fields': fields}))
+    return events
+
+
+class JobStore:
+    """Атомарные изменения заданий с проверкой переходов и журналом событий"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, job_id):
+        return self.storage.get('jobs', job_id)
+
+    def create(self, job):
+        with self.storage.transaction():
+            job['revision'] = 1
+            self.storage.insert('jobs', job)
+            self.storage.append_event(job['id'], 'created', {'status': job['status']})
+        return job
+
+    def delete(self, job_id):
+        with self.storage.transaction():
+            deleted = self.storage.delete('jobs', job_id)
+            if deleted:
+                self.storage.append_event(job_id, 'deleted')
+        return deleted
+
+    def modify(self, job_id, change, revision=None):
+        """Изменение задания функцией change(job), которая правит документ на месте
+
+        revision - ожидаемая ревизия задания (compare-and-set). Возвращает новое
+        задание; если change ничего не изменил, запись не выполняется. Исключения:
+        JobNotFound, JobConflict (ревизия не совпала), InvalidTransition; исключение
+        из change отменяет транзакцию целиком.
+        """
+        with self.storage.transaction():
+            job = self.storage.get('jobs', job_id)
+            if job is None:
+                raise JobNotFound(job_id)
+            if revision is not None and job.get('revision', 0) != revision:
+                raise JobConflict('Задание изменено другим запросом', job)
+
+            before = copy.deepcopy(job)
+            change(job)
+            if job == before:
+                return job
+            events = _events(before, job)
+            job['id'] = job_id
+            job['revision'] = before.get('revision', 0) + 1
+            job['modified'] = datetime.now().isoformat()
+            self.storage.put('jobs', job)
+            for event, data in events:
+                self.storage.append_event(job_id, event, data)
+        return job
+
+    def transition(self, job_id, status, fields=None, revision=None):
+        """Перевод задания в status (с дополнительными полями fields)"""
+        def change(job):
+            check_transition(job['status'], status, job=job)
+            job['status'] = status
+            job.update(fields or {})
+        return self.modify(job_id, change, revision)
+
+    def edit(self, job_id, data, revision=None):
+        """Изменение редактируемых полей задания (статус - только командами start/pause/cancel)"""
+        if 'status' in data:
+            raise ValueError('Статус задания меняется через /start, /pause и /cancel')
+        unknown = sorted(set(data) - set(EDITABLE_FIELDS) - {'revision'})
+        if unknown:
+            raise ValueError(f"Поля нельзя изменить: {', '.join(unknown)}")
+        if 'quantity' in data and (not isinstance(data['quantity'], int) or data['quantity'] < 1):
+            raise ValueError('Количество копий должно быть целым числом больше 0')
+
+        def change(job):
+            fields = {key: data[key] for key in EDITABLE_FIELDS if key in data}
+            if job['status'] != 'pending' and any(
+                    fields.get(key, job.get(key)) != job.get(key) for key in PENDING_ONLY_FIELDS):
+                raise JobConflict('Файл можно изменить только до запуска задания', job)
+            job.update(fields)
+        return self.modify(job_id, change, revision)
+
+    def events(self, job_id, after=0, limit=500):
+        return self.storage.job_events(job_id, after, limit)
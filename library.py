@@ -0,0 +1,138 @@
+"""
+Библиотека файлов с адресацией по содержимому
+
+Содержимое файла хранится один раз под своим SHA-256 в UPLOAD_FOLDER/library,
+а записи коллекции files (имя, описание, даты) ссылаются на него. Повторная
+загрузка того же содержимого не занимает места на диске, а удаление записи
+удаляет содержимое только когда на него больше никто не ссылается.
+
+G-code хорошо сжимается, поэтому текстовые форматы хранятся в gzip; загрузки
+.gcode.gz распаковываются при приеме, чтобы совпадать по хэшу с обычными.
+Рядом со сжатым файлом сохраняется несжатая сводка для анализатора G-code
+(начало, хвост и число слоев), собранная в том же проходе по потоку.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+
+from gcode_analyzer import GcodeScanner, summary_path, write_summary
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Текстовые форматы, которые имеет смысл сжимать (3mf и ufp уже zip-архивы)
+COMPRESSED_TYPES = ('gcode', 'g', 'gco')
+
+
+class FileLibrary:
+    """Хранилище содержимого файлов библиотеки"""
+
+    def __init__(self, storage, root, compress_level=6):
+        self.storage = storage
+        self.root = root
+        self.compress_level = compress_level
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob_path(self, sha256, compressed):
+        return os.path.join(self.root, sha256[:2], sha256 + ('.gz' if compressed else ''))
+
+    def find(self, sha256):
+        """Путь и признак сжатия уже сохраненного содержимого (или None)"""
+        for compressed in (True, False):
+            path = self.blob_path(sha256, compressed)
+            if os.path.exists(path):
+                return path, compressed
+        return None
+
+    def store(self, stream, filename):
+        """Прием файла из потока; возвращает (имя, sha256, размер, сжат ли)
+
+        Имя с суффиксом .gz возвращается без него: содержимое распаковывается.
+        """
+        if filename.lower().endswith('.gz'):
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+            filename = filename[:-3]
+        compressed = self.compress_level > 0 and file_type(filename) in COMPRESSED_TYPES
+
+        digest = hashlib.sha256()
+        scanner = GcodeScanner() if compressed else None
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        tmp_summary = None
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.compress_level,
+                                    mtime=0) if compressed else raw
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+                    if scanner is not None:
+                        scanner.feed(chunk)
+                if compressed:
+                    out.close()
+
+            sha256 = digest.hexdigest()
+            existing = self.find(sha256)
+            if existing:
+                os.remove(tmp_path)
+                return filename, sha256, size, existing[1]
+
+            path = self.blob_path(sha256, compressed)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if scanner is not None:
+                # Сводка появляется раньше самого файла: анализатор не застанет файл без нее
+                tmp_summary = tmp_path + '.scan'
+                write_summary(tmp_summary, *scanner.finish())
+                os.replace(tmp_summary, summary_path(path))
+            os.replace(tmp_path, path)
+            return filename, sha256, size, compressed
+        except BaseException:
+            for leftover in (tmp_path, tmp_summary):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+
+    def open(self, file_info):
+        """Поток с исходным (распакованным) содержимым записи библиотеки"""
+        if file_info.get('compressed'):
+            return gzip.open(file_info['path'], 'rb')
+        return open(file_info['path'], 'rb')
+
+    def release(self, file_info):
+        """Удаление содержимого, если на него не ссылается ни одна другая запись"""
+        shared = any(
+            f['id'] != file_info['id'] and f.get('path') == file_info['path']
+            for f in self.storage.all('files')
+        )
+        if not shared:
+            for path in (file_info['path'], summary_path(file_info['path'])):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def adopt_legacy(self):
+        """Перенос файлов, сохраненных по имени (до появления библиотеки), в хранилище"""
+        for file_info in self.storage.all('files'):
+            if file_info.get('sha256') and file_info.get('path', '').startswith(self.root):
+                continue
+            legacy_path = file_info.get('path')
+            if not legacy_path or not os.path.exists(legacy_path):
+                continue
+            with open(legacy_path, 'rb') as f:
+                name, sha256, size, compressed = self.store(f, file_info['name'])
+            self.storage.update('files', file_info['id'], {
+                'sha256': sha256,
+                'size': size,
+                'compressed': compressed,
+                'path': self.blob_path(sha256, compressed)
+            })
+            if not any(f.get('path') == legacy_path for f in self.storage.all('files')):
+                os.remove(legacy_path)
+            logger.info(f"Файл {file_info['name']} перенесен в библиотеку ({sha256[:12]})")
+
+
+def file_type(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else 'unknown'
@@ -0,0 +1,212 @@
+"""
+Метрики в формате Prometheus и профилирование запросов
+
+Счетчики и гистограммы хранятся в памяти процесса и отдаются на /metrics в
+текстовом формате экспозиции (text/plain; version=0.0.4). При нескольких
+рабочих процессах каждый отдает свои значения - Prometheus различает их по
+адресу цели или по метке instance.
+
+Замер сделан так, чтобы его можно было оставить включенным: наблюдение -
+поиск корзины и сложение под блокировкой.
+"""
+
+import bisect
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Корзины по умолчанию (секунды): от миллисекунды до таймаута Moonraker
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Набор метрик одного процесса"""
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}_total{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счетчики по корзинам (последняя - +Inf), сумма]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замер блока кода (наблюдение записывается и при исключении)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+# Метрики приложения
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'fcrm_http_request_duration_seconds', 'Время обработки запроса API (до начала отправки тела)',
+    ('route', 'method', 'status'))
+
+MOONRAKER_REQUEST_SECONDS = Histogram(
+    'fcrm_moonraker_request_duration_seconds', 'Время HTTP-запроса к Moonraker',
+    ('printer', 'endpoint', 'method'))
+MOONRAKER_ERRORS = Counter(
+    'fcrm_moonraker_errors', 'Неудачные запросы к Moonraker по причине',
+    ('printer', 'endpoint', 'reason'))
+
+STORAGE_OPERATION_SECONDS = Histogram(
+    'fcrm_storage_operation_duration_seconds', 'Время чтения и записи документов хранилища',
+    ('collection', 'operation'))
+STORAGE_TRANSACTION_SECONDS = Histogram(
+    'fcrm_storage_transaction_duration_seconds',
+    'Время транзакции хранилища вместе с ожиданием блокировки на запись')
+STORAGE_CACHE_RELOADS = Counter(
+    'fcrm_storage_cache_reloads', 'Перечитывания коллекции из базы (изменена другим процессом)',
+    ('collection',))
+
+POLLER_CYCLE_SECONDS = Histogram(
+    'fcrm_poller_cycle_duration_seconds', 'Длительность прохода фонового опроса принтеров',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+def endpoint_label(path):
+    """Путь Moonraker без имен файлов: /server/files/gcodes/a.gcode -> /server/files/gcodes"""
+    return '/'.join(path.split('?', 1)[0].split('/')[:4])
+
+
+class ProfilingMiddleware:
+    """WSGI-обертка: cProfile каждого запроса, сохраняются только медленные
+
+    Файлы .prof пишутся в profile_dir и открываются через pstats или snakeviz.
+    Замеряется вызов приложения; потоковое тело ответа отдается уже без профиля.
+    Одновременно профилируется один запрос: в Python 3.12+ профилировщик может
+    быть активен только один на процесс, остальные запросы проходят без замера.
+    """
+
+    def __init__(self, wsgi_app, profile_dir, min_duration=0.1):
+        self.wsgi_app = wsgi_app
+        self.profile_dir = profile_dir
+        self.min_duration = min_duration
+        self.lock = threading.Lock()
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        if not self.lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        try:
+            return self._profile(environ, start_response)
+        finally:
+            self.lock.release()
+
+    def _profile(self, environ, start_response):
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.min_duration:
+                path = environ.get('PATH_INFO', '/').strip('/').replace('/', '.') or 'root'
+                filename = (f"{environ.get('REQUEST_METHOD', 'GET')}.{path}."
+                            f"{elapsed * 1000:.0f}ms.{time.time():.0f}.prof")
+                profile.dump_stats(os.path.join(self.profile_dir, filename))
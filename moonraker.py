@@ -0,0 +1,567 @@
+"""
+Клиентские компоненты для работы с Moonraker API
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import MOONRAKER_ERRORS, MOONRAKER_REQUEST_SECONDS, endpoint_label
+
+try:
+    import websocket
+except ImportError:  # websocket-client не установлен - остается HTTP-опрос
+    websocket = None
+
+WEBSOCKET_AVAILABLE = websocket is not None
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp не установлен - асинхронный режим (asgi.py) недоступен
+    aiohttp = None
+
+AIOHTTP_AVAILABLE = aiohttp is not None
+
+logger = logging.getLogger(__name__)
+
+# Объекты Klipper, на изменения которых подписывается панель (None - все поля объекта).
+# У virtual_sdcard берутся только поля прогресса: file_position меняется непрерывно
+SUBSCRIBED_OBJECTS = {
+    'print_stats': None,
+    'heater_bed': None,
+    'extruder': None,
+    'virtual_sdcard': ['progress', 'is_active', 'file_path'],
+}
+
+
+def objects_query(objects=SUBSCRIBED_OBJECTS):
+    """Строка запроса /printer/objects/query для объектов с выборкой полей"""
+    return '&'.join(name if fields is None else f"{name}={','.join(fields)}"
+                    for name, fields in objects.items())
+
+
+class PrinterOffline(Exception):
+    """Принтер помечен недоступным, запрос не выполнялся"""
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class MultipartStream:
+    """Тело multipart/form-data, формируемое на лету из потока блоков файла
+
+    Длина известна заранее, поэтому запрос уходит с Content-Length, а файл
+    не читается в память целиком. progress(sent) вызывается после каждого блока.
+    """
+
+    def __init__(self, filename, chunks, size, field='file', fields=None, progress=None):
+        self.boundary = uuid.uuid4().hex
+        self.chunks = chunks
+        self.size = size
+        self.progress = progress
+
+        head = b''
+        for name, value in (fields or {}).items():
+            head += (f"--{self.boundary}\r\n"
+                     f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f"{value}\r\n").encode('utf-8')
+        head += (f"--{self.boundary}\r\n"
+                 f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                 f"Content-Type: application/octet-stream\r\n\r\n").encode('utf-8')
+        self.head = head
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode('utf-8')
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        sent = 0
+        for chunk in self.chunks:
+            sent += len(chunk)
+            if sent > self.size:
+                raise ValueError('Размер файла больше заявленного')
+            yield chunk
+            if self.progress is not None:
+                self.progress(sent)
+        if sent != self.size:
+            raise ValueError('Размер файла меньше заявленного')
+        yield self.tail
+
+
+def iter_chunks(stream, chunk_size=UPLOAD_CHUNK_SIZE, tee=None):
+    """Чтение потока блоками с необязательной копией в файл tee"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if tee is not None:
+            tee.write(chunk)
+        yield chunk
+
+
+def uploaded_item(response):
+    """Описание загруженного файла из ответа /server/files/upload (path, size, modified)
+
+    Moonraker отдает его в result.item или, в старых версиях, прямо в item.
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    result = body.get('result', body) if isinstance(body, dict) else None
+    item = result.get('item') if isinstance(result, dict) else None
+    return item if isinstance(item, dict) else {}
+
+
+class MoonrakerClient:
+    """HTTP-клиент одного принтера: пул keep-alive соединений и автоматический выключатель
+
+    После failure_threshold подряд неудачных подключений принтер считается
+    недоступным: запросы сразу завершаются PrinterOffline, а доступность
+    проверяется одним легким запросом с нарастающей задержкой.
+    """
+
+    def __init__(self, base_url, timeout=10, connect_timeout=3, failure_threshold=3,
+                 min_backoff=5, max_backoff=300, pool_size=8, upload_bandwidth=256 * 1024,
+                 name=None):
+        self.base_url = base_url.rstrip('/')
+        # Метка принтера в метриках
+        self.name = name or self.base_url
+        self.timeout = (min(connect_timeout, timeout), timeout)
+        self.failure_threshold = failure_threshold
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.upload_bandwidth = upload_bandwidth
+
+        self.session = requests.Session()
+        # Повтор только при ошибке подключения: запрос до принтера еще не дошел
+        retries = Retry(total=1, connect=1, read=0, status=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.failures = 0
+        self.backoff = min_backoff
+        self.retry_at = 0
+        self._lock = threading.Lock()
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.failures < self.failure_threshold:
+            return 'closed'
+        return 'half_open' if time.monotonic() >= self.retry_at else 'open'
+
+    @property
+    def offline(self):
+        return self.failures >= self.failure_threshold
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Запрос к Moonraker через пул соединений с учетом состояния выключателя"""
+        endpoint = endpoint_label(path)
+        if self.offline:
+            try:
+                self._probe()
+            except PrinterOffline:
+                MOONRAKER_ERRORS.inc(printer=self.name, endpoint=endpoint, reason='offline')
+                raise
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                method,
+                f"{self.base_url}{path}",
+                timeout=timeout or self.timeout,
+                **kwargs
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            reason = 'timeout' if isinstance(e, requests.Timeout) else 'connection'
+            MOONRAKER_ERRORS.inc(printer=self.name, endpoint=endpoint, reason=reason)
+            self._record_failure()
+            raise
+        finally:
+            MOONRAKER_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                              printer=self.name, endpoint=endpoint, method=method)
+        if response.status_code >= 500:
+            MOONRAKER_ERRORS.inc(printer=self.name, endpoint=endpoint, reason='http_5xx')
+        self._record_success()
+        return response
+
+    def upload(self, filename, chunks, size, progress=None, root='gcodes'):
+        """Потоковая загрузка файла в Moonraker (/server/files/upload)
+
+        Время ожидания ответа растет с размером файла: к базовому таймауту
+        добавляется время передачи при минимальной ожидаемой скорости.
+        """
+        body = MultipartStream(filename, chunks, size, fields={'root': root}, progress=progress)
+        read_timeout = self.timeout[1] + size / self.upload_bandwidth
+        return self.post(
+            '/server/files/upload',
+            data=body,
+            headers={'Content-Type': body.content_type},
+            # Отправка блока тоже ограничена таймаутом подключения, поэтому он
+            # увеличен до базового: медленный Wi-Fi может надолго заполнять буфер
+            timeout=(self.timeout[1], read_timeout)
+        )
+
+    def close(self):
+        self.session.close()
+
+    def _probe(self):
+        """Легкая проверка доступности недоступного принтера (один поток за раз)"""
+        if not self._begin_probe():
+            return
+        try:
+            self.session.get(
+                f"{self.base_url}/server/info",
+                timeout=(self.timeout[0], self.timeout[0])
+            )
+        except requests.RequestException:
+            self._probe_failed()
+            raise PrinterOffline('Принтер недоступен')
+        finally:
+            self._probing = False
+        self._record_success()
+
+    def _begin_probe(self):
+        """Разрешение на проверку доступности; False - принтер уже снова доступен"""
+        with self._lock:
+            if not self.offline:
+                return False
+            wait = self.retry_at - time.monotonic()
+            if wait > 0 or self._probing:
+                raise PrinterOffline(
+                    f"Принтер недоступен, повторная проверка через {max(0, int(wait))} с")
+            self._probing = True
+            return True
+
+    def _probe_failed(self):
+        with self._lock:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self.retry_at = time.monotonic() + self.backoff
+
+    def _record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures == self.failure_threshold:
+                logger.warning(f"Moonraker {self.base_url} помечен недоступным")
+                self.backoff = self.min_backoff
+                self.retry_at = time.monotonic() + self.backoff
+
+    def _record_success(self):
+        with self._lock:
+            if self.offline:
+                logger.info(f"Moonraker {self.base_url} снова доступен")
+            self.failures = 0
+            self.backoff = self.min_backoff
+
+
+class AsyncResponse:
+    """Прочитанный ответ Moonraker в асинхронном режиме (интерфейс как у requests)"""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncMoonrakerClient:
+    """Асинхронные запросы к Moonraker через aiohttp для asgi.py
+
+    Состояние выключателя и метрики общие с синхронным MoonrakerClient того же
+    принтера, поэтому недоступный принтер не опрашивается обоими режимами.
+    """
+
+    def __init__(self, client, session):
+        self.client = client
+        self.session = session
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def request(self, method, path, timeout=None, **kwargs):
+        client = self.client
+        endpoint = endpoint_label(path)
+        if client.offline:
+            try:
+                await self._probe()
+            except PrinterOffline:
+                MOONRAKER_ERRORS.inc(printer=client.name, endpoint=endpoint, reason='offline')
+                raise
+
+        connect_timeout, read_timeout = timeout or client.timeout
+        started = time.perf_counter()
+        try:
+            response = await self._send(method, path, connect_timeout, read_timeout, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            reason = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'connection'
+            MOONRAKER_ERRORS.inc(printer=client.name, endpoint=endpoint, reason=reason)
+            client._record_failure()
+            raise
+        finally:
+            MOONRAKER_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                              printer=client.name, endpoint=endpoint, method=method)
+        if response.status_code >= 500:
+            MOONRAKER_ERRORS.inc(printer=client.name, endpoint=endpoint, reason='http_5xx')
+        client._record_success()
+        return response
+
+    async def _send(self, method, path, connect_timeout, read_timeout, **kwargs):
+        timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        async with self.session.request(method, f"{self.client.base_url}{path}",
+                                        timeout=timeout, **kwargs) as response:
+            return AsyncResponse(response.status, await response.read())
+
+    async def _probe(self):
+        client = self.client
+        if not client._begin_probe():
+            return
+        try:
+            await self._send('GET', '/server/info', client.timeout[0], client.timeout[0])
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            client._probe_failed()
+            raise PrinterOffline('Принтер недоступен')
+        finally:
+            client._probing = False
+        client._record_success()
+
+
+def websocket_url(moonraker_url):
+    """Адрес JSON-RPC WebSocket Moonraker по HTTP-адресу принтера"""
+    parsed = urlparse(moonraker_url)
+    scheme = 'wss' if parsed.scheme == 'https' else 'ws'
+    return f"{scheme}://{parsed.netloc}/websocket"
+
+
+def merge_status(state, delta):
+    """Рекурсивное применение инкрементального обновления к модели состояния"""
+    for key, value in delta.items():
+        if isinstance(value, dict) and isinstance(state.get(key), dict):
+            merge_status(state[key], value)
+        else:
+            state[key] = value
+    return state
+
+
+class MoonrakerSubscription:
+    """Постоянное WebSocket-подключение к принтеру с подпиской на notify_status_update
+
+    Соединение обслуживается отдельным потоком. Модель состояния (объекты Klipper,
+    информация о принтере) обновляется инкрементально, а после каждого
+    изменения вызывается on_update(printer_id, status). Список файлов ведется в
+    file_index по notify_filelist_changed, в статус попадает только его версия.
+    При обрыве соединения выполняется переподключение с экспоненциальной задержкой.
+    """
+
+    def __init__(self, printer_id, moonraker_url, on_update, file_index, objects=SUBSCRIBED_OBJECTS,
+                 min_backoff=1, max_backoff=60, heartbeat=15):
+        self.printer_id = printer_id
+        self.url = websocket_url(moonraker_url)
+        self.on_update = on_update
+        self.objects = dict(objects)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.heartbeat = heartbeat
+
+        self.connected = False
+        self.printer_info = None
+        self.objects_state = {}
+        self.file_index = file_index
+        self.last_message = 0
+
+        self._ws = None
+        self._request_id = 0
+        self._pending = {}
+        self._status_received = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def available(self):
+        """Подписка работает, и модель состояния уже заполнена"""
+        return self.connected and self.printer_info is not None and bool(self.objects_state)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"moonraker-ws-{self.printer_id}",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def snapshot(self):
+        """Статус в формате PrinterManager.get_printer_status"""
+        objects = copy.deepcopy(self.objects_state)
+        return {
+            'printer_info': {'result': copy.deepcopy(self.printer_info)},
+            'print_stats': objects.get('print_stats', {}),
+            'virtual_sdcard': objects.get('virtual_sdcard', {}),
+            'temperature': {k: objects[k] for k in ('heater_bed', 'extruder') if k in objects},
+            'files_version': self.file_index.version(self.printer_id),
+            'last_update': datetime.now().isoformat(),
+            'online': True
+        }
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self._stop.is_set():
+            try:
+                self._connect()
+                self._receive_loop()
+            except Exception as e:
+                if not self._stop.is_set():
+                    logger.warning(f"WebSocket принтера {self.printer_id}: {str(e)}")
+            finally:
+                self._disconnect()
+
+            if self._stop.is_set():
+                break
+            # Задержка сбрасывается, только если соединение успело передать статус:
+            # принтер, который принимает подключение и сразу его рвет, не получает
+            # переподключений каждую секунду
+            if self._status_received:
+                backoff = self.min_backoff
+            # Экспоненциальная задержка со случайным разбросом, чтобы принтеры
+            # не переподключались одновременно после сбоя сети
+            self._stop.wait(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _connect(self):
+        self._status_received = False
+        self._ws = websocket.create_connection(self.url, timeout=self.heartbeat)
+        self.connected = True
+        self.last_message = time.monotonic()
+        self._request('printer.info', handler=self._on_printer_info)
+        self._subscribe()
+        self._request('server.files.list', {'root': 'gcodes'}, handler=self._on_files)
+
+    def _disconnect(self):
+        was_available = self.available
+        self.connected = False
+        self.printer_info = None
+        self.objects_state = {}
+        self._pending.clear()
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+        if was_available and not self._stop.is_set():
+            self.on_update(self.printer_id, None)
+
+    def _subscribe(self):
+        self._request(
+            'printer.objects.subscribe',
+            {'objects': self.objects},
+            handler=self._on_subscribed
+        )
+
+    def _request(self, method, params=None, handler=None):
+        self._request_id += 1
+        message = {'jsonrpc': '2.0', 'method': method, 'id': self._request_id}
+        if params is not None:
+            message['params'] = params
+        if handler is not None:
+            self._pending[self._request_id] = handler
+        self._ws.send(json.dumps(message))
+
+    def _receive_loop(self):
+        while not self._stop.is_set():
+            try:
+                raw = self._ws.recv()
+            except websocket.WebSocketTimeoutException:
+                if time.monotonic() - self.last_message > self.heartbeat * 2:
+                    raise ConnectionError('нет данных от Moonraker, переподключение')
+                self._ws.ping()
+                continue
+
+            if not raw:
+                raise ConnectionError('соединение закрыто Moonraker')
+            self.last_message = time.monotonic()
+            self._handle_message(json.loads(raw))
+
+    def _handle_message(self, message):
+        if 'id' in message:
+            handler = self._pending.pop(message['id'], None)
+            if 'error' in message:
+                logger.warning(f"Moonraker {self.printer_id}: {message['error']}")
+            elif handler is not None:
+                handler(message.get('result'))
+            return
+
+        method = message.get('method')
+        params = message.get('params') or []
+        if method == 'notify_status_update' and params:
+            merge_status(self.objects_state, params[0])
+            self._status_received = True
+            self._publish()
+        elif method == 'notify_filelist_changed' and params:
+            changed = self.file_index.apply_change(self.printer_id, params[0])
+            if changed is None:
+                self._request('server.files.list', {'root': 'gcodes'}, handler=self._on_files)
+            elif changed:
+                self._publish()
+        elif method == 'notify_klippy_ready':
+            # После перезапуска Klipper подписку нужно оформить заново
+            self._request('printer.info', handler=self._on_printer_info)
+            self._subscribe()
+        elif method in ('notify_klippy_disconnected', 'notify_klippy_shutdown'):
+            self.objects_state = {}
+            self.on_update(self.printer_id, None)
+
+    def _on_printer_info(self, result):
+        self.printer_info = result
+        self._publish()
+
+    def _on_subscribed(self, result):
+        self.objects_state = (result or {}).get('status', {})
+        self._status_received = True
+        self._publish()
+
+    def _on_files(self, result):
+        self.file_index.replace(self.printer_id, result)
+        self._publish()
+
+    def _publish(self):
+        if self.available:
+            self.on_update(self.printer_id, self.snapshot())
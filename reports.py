@@ -0,0 +1,410 @@
+"""
+Отчеты по парку принтеров: загрузка, исходы печати, расход материалов, сроки заданий
+
+Отчеты строятся не по полной истории заданий, а по суммам по дням, которые
+обновляются по мере завершения копий и заданий. Фоновый проход читает только
+новые записи журнала job_events (после сохраненного курсора seq) и прибавляет
+к суммам завершенные копии и задания; курсор сдвигается в той же транзакции,
+что и суммы, поэтому каждая печать учитывается ровно один раз, даже если
+задание потом удалено. Стоимость прохода зависит от числа новых событий,
+а не от истории заданий. Запрос отчета за год читает не больше 365 строк
+на принтер или материал.
+
+Суммы хранятся в базе телеметрии рядом с telemetry_daily, по которой
+считается доля времени онлайн и в печати.
+"""
+
+import csv
+import io
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+import zipfile
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+
+FINISHED_COPY_STATES = ('done', 'cancelled', 'failed')
+# Записей журнала заданий за один запрос
+EVENTS_BATCH = 1000
+
+# Отчет -> колонки (ключ, заголовок для выгрузки)
+REPORTS = {
+    'utilization': [
+        ('printer_id', 'ID принтера'), ('printer', 'Принтер'), ('hours', 'Часов наблюдения'),
+        ('uptime', 'Онлайн, %'), ('utilization', 'Загрузка, %'), ('printing_hours', 'Часов печати'),
+    ],
+    'prints': [
+        ('printer_id', 'ID принтера'), ('printer', 'Принтер'), ('done', 'Успешно'),
+        ('cancelled', 'Отменено'), ('failed', 'С ошибкой'), ('success_rate', 'Успешных, %'),
+        ('print_hours', 'Часов печати'),
+    ],
+    'materials': [
+        ('material', 'Материал'), ('prints', 'Печатей'), ('filament_g', 'Филамент, г'),
+        ('filament_m', 'Филамент, м'), ('print_hours', 'Часов печати'),
+    ],
+    'lead_times': [
+        ('day', 'Дата'), ('jobs', 'Заданий завершено'), ('avg_wait_hours', 'Ожидание запуска, ч'),
+        ('avg_lead_hours', 'Среднее время выполнения, ч'), ('max_lead_hours', 'Максимальное время выполнения, ч'),
+    ],
+}
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _seconds_between(start, end):
+    try:
+        return max(0.0, (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _print_seconds(copy, finished):
+    """Время печати копии: print_duration принтера или время от запуска до завершения"""
+    if copy.get('print_duration'):
+        return float(copy['print_duration'])
+    return _seconds_between(copy.get('started'), finished) or 0
+
+
+def _hours(seconds):
+    return round((seconds or 0) / 3600, 2)
+
+
+class FleetReports:
+    """Суммы для отчетов и их инкрементальное обновление по журналу заданий"""
+
+    def __init__(self, telemetry_store, storage, interval=30):
+        self.telemetry_store = telemetry_store
+        self.storage = storage
+        self.interval = interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._thread = None
+        self._lock = threading.Lock()
+        self._create_schema()
+
+    @property
+    def connection(self):
+        return self.telemetry_store.connection
+
+    def _create_schema(self):
+        conn = self.connection
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS report_prints (
+                day TEXT NOT NULL,
+                printer_id TEXT NOT NULL,
+                material TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                prints INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                filament_g REAL NOT NULL,
+                filament_mm REAL NOT NULL,
+                PRIMARY KEY (day, printer_id, material, outcome)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                day TEXT PRIMARY KEY,
+                jobs INTEGER NOT NULL,
+                wait_seconds REAL NOT NULL,
+                lead_seconds REAL NOT NULL,
+                max_lead_seconds REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS report_cursor (
+                name TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    # Обновление сумм
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='reports', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.storage.acquire_lease('reports', self.owner, ttl=self.interval * 3):
+                    self.update()
+            except Exception as e:
+                logger.error(f"Ошибка обновления отчетов: {str(e)}")
+            time.sleep(self.interval)
+
+    def update(self):
+        """Учет копий и заданий, завершенных после курсора журнала; возвращает их число"""
+        conn = self.connection
+        row = conn.execute("SELECT seq FROM report_cursor WHERE name = 'job_events'").fetchone()
+        if row and not self.storage.job_events(after=row[0], limit=1):
+            return 0
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Курсор перечитывается внутри транзакции: второй процесс с истекшей арендой
+            # дождется ее фиксации и продолжит с нового места
+            row = conn.execute("SELECT seq FROM report_cursor WHERE name = 'job_events'").fetchone()
+            cursor = row[0] if row else 0
+
+            added = 0
+            while True:
+                events = self.storage.job_events(after=cursor, limit=EVENTS_BATCH)
+                for event in events:
+                    added += self._apply_event(event)
+                if events:
+                    cursor = events[-1]['seq']
+                if len(events) < EVENTS_BATCH:
+                    break
+
+            conn.execute(
+                "INSERT INTO report_cursor (name, seq) VALUES ('job_events', ?) "
+                "ON CONFLICT(name) DO UPDATE SET seq = excluded.seq", (cursor,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return added
+
+    def _apply_event(self, event):
+        """Прибавление завершенной копии или задания из записи журнала (1 - учтено)"""
+        data = event['data'] or {}
+        if event['event'] == 'copy' and data.get('to') in FINISHED_COPY_STATES:
+            self._add_print(data, data.get('finished') or event['time'])
+            return 1
+        if event['event'] == 'status' and data.get('to') == 'completed':
+            self._add_job(data, data.get('completed') or event['time'])
+            return 1
+        return 0
+
+    def _add_print(self, copy, finished):
+        """Итоги копии - из записи журнала, сделанной при ее завершении"""
+        self.connection.execute("""
+            INSERT INTO report_prints VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT (day, printer_id, material, outcome) DO UPDATE SET
+                prints = prints + 1,
+                seconds = seconds + excluded.seconds,
+                filament_g = filament_g + excluded.filament_g,
+                filament_mm = filament_mm + excluded.filament_mm
+        """, (finished[:10], copy['printer_id'], copy.get('material') or 'Неизвестно',
+              copy['to'], _print_seconds(copy, finished), copy.get('filament_weight') or 0.0,
+              copy.get('filament_used') or 0.0))
+
+    def _add_job(self, job, completed):
+        lead = _seconds_between(job.get('created'), completed) or 0
+        wait = _seconds_between(job.get('created'), job.get('started')) or 0
+        self.connection.execute("""
+            INSERT INTO report_jobs VALUES (?, 1, ?, ?, ?)
+            ON CONFLICT (day) DO UPDATE SET
+                jobs = jobs + 1,
+                wait_seconds = wait_seconds + excluded.wait_seconds,
+                lead_seconds = lead_seconds + excluded.lead_seconds,
+                max_lead_seconds = MAX(max_lead_seconds, excluded.max_lead_seconds)
+        """, (completed[:10], wait, lead, lead))
+
+    # Отчеты
+
+    def report(self, name, start_day, end_day):
+        """Строки отчета (словари с ключами из REPORTS[name]) за период включительно"""
+        return getattr(self, f"_report_{name}")(start_day, end_day)
+
+    def _printer_name(self, printer_id):
+        printer = self.storage.get('printers', printer_id)
+        return printer['name'] if printer else printer_id
+
+    def _report_utilization(self, start_day, end_day):
+        for printer_id, seconds, online, printing in self.telemetry_store.daily_totals(start_day, end_day):
+            yield {
+                'printer_id': printer_id,
+                'printer': self._printer_name(printer_id),
+                'hours': _hours(seconds),
+                'uptime': round(online / seconds * 100, 1) if seconds else 0.0,
+                'utilization': round(printing / seconds * 100, 1) if seconds else 0.0,
+                'printing_hours': _hours(printing),
+            }
+
+    def _report_prints(self, start_day, end_day):
+        rows = self.connection.execute("""
+            SELECT printer_id,
+                   SUM(CASE WHEN outcome = 'done' THEN prints ELSE 0 END),
+                   SUM(CASE WHEN outcome = 'cancelled' THEN prints ELSE 0 END),
+                   SUM(CASE WHEN outcome = 'failed' THEN prints ELSE 0 END),
+                   SUM(seconds)
+            FROM report_prints
+            WHERE day >= ? AND day <= ?
+            GROUP BY printer_id
+            ORDER BY printer_id
+        """, (start_day, end_day)).fetchall()
+        for printer_id, done, cancelled, failed, seconds in rows:
+            total = done + cancelled + failed
+            yield {
+                'printer_id': printer_id,
+                'printer': self._printer_name(printer_id),
+                'done': done,
+                'cancelled': cancelled,
+                'failed': failed,
+                'success_rate': round(done / total * 100, 1) if total else 0.0,
+                'print_hours': _hours(seconds),
+            }
+
+    def _report_materials(self, start_day, end_day):
+        rows = self.connection.execute("""
+            SELECT material, SUM(prints), SUM(filament_g), SUM(filament_mm), SUM(seconds)
+            FROM report_prints
+            WHERE day >= ? AND day <= ? AND outcome = 'done'
+            GROUP BY material
+            ORDER BY SUM(filament_g) DESC, material
+        """, (start_day, end_day)).fetchall()
+        for material, prints, filament_g, filament_mm, seconds in rows:
+            yield {
+                'material': material,
+                'prints': prints,
+                'filament_g': round(filament_g, 1),
+                'filament_m': round(filament_mm / 1000, 2),
+                'print_hours': _hours(seconds),
+            }
+
+    def _report_lead_times(self, start_day, end_day):
+        rows = self.connection.execute("""
+            SELECT day, jobs, wait_seconds, lead_seconds, max_lead_seconds
+            FROM report_jobs
+            WHERE day >= ? AND day <= ?
+            ORDER BY day
+        """, (start_day, end_day)).fetchall()
+        for day, jobs, wait, lead, max_lead in rows:
+            yield {
+                'day': day,
+                'jobs': jobs,
+                'avg_wait_hours': _hours(wait / jobs),
+                'avg_lead_hours': _hours(lead / jobs),
+                'max_lead_hours': _hours(max_lead),
+            }
+
+
+def day_range(days=None, start=None, end=None):
+    """Период отчета: даты 'YYYY-MM-DD' или последние days дней, включая сегодня"""
+    end = end or date.today().isoformat()
+    if not start:
+        start = (date.fromisoformat(end) - timedelta(days=max(1, days or 30) - 1)).isoformat()
+    # Проверка формата: неверная дата вызывает ValueError
+    date.fromisoformat(start)
+    date.fromisoformat(end)
+    return start, end
+
+
+# Выгрузка
+
+def stream_csv(columns, rows):
+    """CSV по частям; BOM нужен Excel, чтобы распознать UTF-8"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow([title for _, title in columns])
+    for row in rows:
+        writer.writerow([row.get(key) for key, _ in columns])
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkWriter:
+    """Приемник для zipfile без seek: накопленные байты забираются генератором"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = escape(_XML_INVALID.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t>{text}</t></is></c>'
+
+
+def _xlsx_row(values):
+    return '<row>' + ''.join(_xlsx_cell(v) for v in values) + '</row>'
+
+
+def stream_xlsx(columns, rows, sheet_name='Отчет'):
+    """Минимальная книга XLSX по частям: zip пишется без seek, строки - inline-строками"""
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        archive.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        yield out.take()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row([title for _, title in columns])
+            ).encode('utf-8'))
+            for row in rows:
+                sheet.write(_xlsx_row([row.get(key) for key, _ in columns]).encode('utf-8'))
+                if out.size >= EXPORT_CHUNK_SIZE:
+                    yield out.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield out.take()
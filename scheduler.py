@@ -0,0 +1,405 @@
+"""
+Планировщик заданий: распределение копий заданий по свободным принтерам
+"""
+
+import heapq
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from file_index import same_file
+from jobs import JobStore, JobNotFound
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_RANK = {'high': 0, 'normal': 1, 'low': 2}
+
+# Состояния print_stats, в которых принтер готов к новой печати
+FREE_STATES = ('standby', 'idle')
+# Печать завершена, но на столе может остаться деталь
+FINISHED_STATES = ('complete', 'cancelled')
+
+ACTIVE_COPY_STATES = ('starting', 'printing')
+
+# Проходы по изменению статусов принтеров - не чаще раза в секунду
+TRACK_MIN_INTERVAL = 1.0
+
+
+class JobDispatcher:
+    """Фоновое распределение заданий в статусе running по свободным принтерам
+
+    Каждое задание печатается quantity копиями. Для каждой копии в задании
+    хранится запись в copies (принтер, статус, время, прогресс), по которой
+    считаются files_printed и progress задания. Неудачные и отмененные на
+    принтере копии печатаются повторно, пока не исчерпан лимит max_retries.
+
+    Состояние копий обновляется по изменениям статусов принтеров: проход
+    запускается при изменении кэша статусов и проверяет только копии на
+    принтерах, статус которых изменился (и копии, ожидающие подтверждения
+    запуска, - по времени), а не все задания подряд.
+
+    В нескольких рабочих процессах распределением занимается только один -
+    тот, кто держит аренду 'scheduler' в хранилище. Задания изменяются через
+    JobStore, поэтому изменения планировщика и обработчиков API не затирают друг друга.
+    """
+
+    def __init__(self, storage, printer_manager, find_file, interval=5,
+                 auto_continue=False, start_timeout=120, max_retries=3, max_workers=4, estimator=None):
+        self.storage = storage
+        self.estimator = estimator
+        self.jobs = JobStore(storage)
+        self.printer_manager = printer_manager
+        self.find_file = find_file
+        self.interval = interval
+        self.auto_continue = auto_continue
+        self.start_timeout = start_timeout
+        self.max_retries = max_retries
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dispatch')
+        self.wakeup = threading.Event()
+        self._thread = None
+        self._watcher = None
+        self._lock = threading.Lock()
+        self._status_version = None
+        self._active = (None, {})
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='job-dispatcher', daemon=True)
+            self._thread.start()
+            self._watcher = threading.Thread(target=self._watch_statuses, name='job-status-watcher',
+                                             daemon=True)
+            self._watcher.start()
+
+    def notify(self):
+        """Немедленный проход распределения (например, после запуска задания)"""
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                if self.storage.acquire_lease('scheduler', self.owner, ttl=self.interval * 3):
+                    self.dispatch_once()
+            except Exception as e:
+                logger.error(f"Ошибка планировщика заданий: {str(e)}")
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def _watch_statuses(self):
+        """Пробуждение планировщика при изменении кэша статусов принтеров"""
+        version = None
+        while True:
+            new_version = self.printer_manager.wait_for_status_change(version, self.interval)
+            if new_version != version:
+                version = new_version
+                self.wakeup.set()
+                time.sleep(TRACK_MIN_INTERVAL)
+
+    def dispatch_once(self):
+        """Один проход: учет копий на принтерах с изменившимся статусом и запуск новых копий"""
+        version, changed = self.printer_manager.get_statuses(since=self._status_version)
+        statuses = {
+            printer['id']: self.printer_manager.peek_status(printer['id'])
+            for printer in self.printer_manager.printers
+        }
+
+        # Копии, ожидающие подтверждения запуска, проверяются на каждом проходе (по времени)
+        due = {}
+        for printer_id, copies in self._active_copies().items():
+            for job_id, copy in copies:
+                if printer_id in changed or not copy.get('confirmed'):
+                    due.setdefault(job_id, []).append(copy['index'])
+        for job_id, indexes in due.items():
+            self._track_copies(job_id, indexes, statuses)
+        self._status_version = version
+
+        busy = set(self._active_copies())
+        free = [printer_id for printer_id, status in statuses.items()
+                if printer_id not in busy and self._is_free(status)]
+        if not free:
+            return
+
+        queue = [_queue_key(job) for job in self.storage.all('jobs', 'running')
+                 if _remaining_copies(job) > 0]
+        heapq.heapify(queue)
+        while queue and free:
+            _, _, job_id = heapq.heappop(queue)
+            job = self.storage.get('jobs', job_id)
+            if job is None:
+                # Задание удалили после выборки очереди
+                continue
+            eligible = [p for p in free if not job['printers'] or p in job['printers']]
+            if not eligible:
+                continue
+
+            printer_id, estimated = self._choose_printer(job, eligible)
+            copy = self._reserve_copy(job_id, printer_id, estimated)
+            if copy is None:
+                continue
+            free.remove(printer_id)
+            self.executor.submit(self._start_copy, job_id, copy['index'], printer_id)
+
+            job = self.storage.get('jobs', job_id)
+            if job is not None and _remaining_copies(job) > 0:
+                heapq.heappush(queue, _queue_key(job))
+
+    def _active_copies(self):
+        """Активные копии по принтерам: {printer_id: [(job_id, копия)]}
+
+        Пересобирается только после изменения заданий (по версии коллекции).
+        """
+        version = self.storage.version('jobs')
+        if self._active[0] != version:
+            active = {}
+            for job in self.storage.all('jobs', 'running') + self.storage.all('jobs', 'paused'):
+                for copy in job.get('copies', []):
+                    if copy['status'] in ACTIVE_COPY_STATES:
+                        active.setdefault(copy['printer_id'], []).append((job['id'], copy))
+            self._active = (version, active)
+        return self._active[1]
+
+    def _is_free(self, status):
+        if not status or not status.get('online'):
+            return False
+        state = status.get('print_stats', {}).get('state')
+        if state in FREE_STATES:
+            return True
+        return self.auto_continue and state in FINISHED_STATES
+
+    def _choose_printer(self, job, eligible):
+        """Свободный принтер, на котором копия напечатается быстрее всего, и ожидаемое время
+
+        Без модели времени печати (или без истории) - первый подходящий.
+        """
+        if self.estimator is None:
+            return eligible[0], None
+        predicted = [(float(seconds), printer_id) for seconds, printer_id
+                     in zip(self.estimator.predict_job(job, eligible), eligible)
+                     if not math.isnan(seconds)]
+        if not predicted:
+            return eligible[0], None
+        seconds, printer_id = min(predicted)
+        return printer_id, round(seconds)
+
+    def _reserve_copy(self, job_id, printer_id, estimated_seconds=None):
+        """Атомарное добавление копии в задание (если задание еще требует копий)"""
+        reserved = []
+
+        def reserve(job):
+            if job['status'] != 'running' or _remaining_copies(job) <= 0:
+                return
+            copies = job.setdefault('copies', [])
+            copies.append({
+                'index': len(copies),
+                'printer_id': printer_id,
+                'status': 'starting',
+                'started': datetime.now().isoformat(),
+                'finished': None,
+                'confirmed': False,
+                'error': None,
+                'estimated_seconds': estimated_seconds
+            })
+            job['current_file_index'] = len(copies)
+            reserved.append(copies[-1])
+        try:
+            self.jobs.modify(job_id, reserve)
+        except JobNotFound:
+            return None
+        return reserved[0] if reserved else None
+
+    def _start_copy(self, job_id, index, printer_id):
+        """Загрузка файла (при необходимости) и запуск печати одной копии"""
+        job = self.storage.get('jobs', job_id)
+        if job is None:
+            # Задание удалили после резервирования копии: запускать нечего
+            logger.info(f"Задание {job_id} удалено до запуска копии {index + 1}")
+            return
+        filename = job['filename']
+        try:
+            if not self.printer_manager.has_file(printer_id, filename):
+                file_info = self.find_file(filename)
+                if file_info is None:
+                    raise RuntimeError(f"Файл {filename} не найден ни на принтере, ни в библиотеке")
+                result = self.printer_manager.upload_library_file(printer_id, file_info)
+                if 'error' in result:
+                    raise RuntimeError(result['error'])
+
+            result = self.printer_manager.start_print(printer_id, filename)
+            if 'error' in result:
+                raise RuntimeError(result['error'])
+        except Exception as e:
+            logger.error(f"Задание {job_id}: не удалось запустить копию на {printer_id}: {str(e)}")
+            self._update_copy(job_id, index, {'status': 'failed', 'error': str(e),
+                                              'finished': datetime.now().isoformat()})
+            return
+
+        if not self._update_copy(job_id, index, {'status': 'printing',
+                                                 'started': datetime.now().isoformat()}):
+            # Задание отменили, пока запускалась печать
+            logger.info(f"Задание {job_id}: копия {index + 1} отменена во время запуска на {printer_id}")
+            self.printer_manager.run_command(printer_id, 'cancel')
+            return
+        logger.info(f"Задание {job_id}: копия {index + 1} запущена на {printer_id}")
+
+    def _track_copies(self, job_id, indexes, statuses):
+        """Обновление статусов и прогресса копий задания по кэшу статусов принтеров"""
+        job = self.storage.get('jobs', job_id)
+        if job is None:
+            return None
+        updates = {}
+        for index in indexes:
+            copy = job['copies'][index]
+            if copy['status'] not in ACTIVE_COPY_STATES:
+                continue
+            fields = self._copy_transition(job, copy, statuses.get(copy['printer_id']))
+            if fields:
+                updates[index] = (copy['status'], fields)
+
+        if not updates:
+            return job
+
+        def apply(job):
+            for index, (expected, fields) in updates.items():
+                # Копию мог уже изменить поток запуска или обработчик API
+                if job['copies'][index]['status'] == expected:
+                    job['copies'][index].update(fields)
+            _refresh_job_counters(job, self.max_retries)
+        try:
+            return self.jobs.modify(job['id'], apply)
+        except JobNotFound:
+            return job
+
+    def _update_copy(self, job_id, index, fields):
+        """Изменение активной копии; False - копия уже завершена или задание удалено"""
+        applied = []
+
+        def update(job):
+            if job['copies'][index]['status'] in ACTIVE_COPY_STATES:
+                job['copies'][index].update(fields)
+                _refresh_job_counters(job, self.max_retries)
+                applied.append(True)
+        try:
+            self.jobs.modify(job_id, update)
+        except JobNotFound:
+            return False
+        return bool(applied)
+
+    def _copy_transition(self, job, copy, status):
+        """Новые поля копии по состоянию принтера (None - без изменений)"""
+        started = datetime.fromisoformat(copy['started'])
+        age = (datetime.now() - started).total_seconds()
+
+        if copy['status'] == 'starting':
+            # Процесс, запускавший копию, мог завершиться, не дойдя до конца
+            if age > self.start_timeout * 5:
+                return {'status': 'failed', 'error': 'Запуск печати не завершен',
+                        'finished': datetime.now().isoformat()}
+            return None
+
+        if not status or not status.get('online'):
+            return None
+
+        print_stats = status.get('print_stats', {})
+        state = print_stats.get('state')
+        is_job_file = same_file(print_stats.get('filename'), job['filename'])
+        finished = datetime.now().isoformat()
+
+        if not copy.get('confirmed'):
+            # До подтверждения состояние принтера может относиться к предыдущей печати
+            if state in ('printing', 'paused') and is_job_file:
+                return {'confirmed': True, 'progress': _print_progress(status) or 0}
+            if age > self.start_timeout:
+                return {'status': 'failed', 'error': 'Печать не началась', 'finished': finished}
+            return None
+
+        if state == 'complete' and is_job_file:
+            return {'status': 'done', 'progress': 100, **self._print_totals(job, print_stats, finished)}
+        if state == 'cancelled':
+            return {'status': 'cancelled', **self._print_totals(job, print_stats, finished)}
+        if state == 'error':
+            return {'status': 'failed', 'error': print_stats.get('message') or 'Ошибка принтера',
+                    **self._print_totals(job, print_stats, finished)}
+        if state == 'standby' or not is_job_file:
+            return {'status': 'failed', 'error': 'Печать прервана', 'finished': finished}
+
+        progress = _print_progress(status)
+        if progress is not None and progress != copy.get('progress'):
+            return {'progress': progress}
+        return None
+
+    def _print_totals(self, job, print_stats, finished):
+        """Итоги печати по данным принтера (для отчетов и оценок времени)
+
+        Вес филамента считается сразу, по метаданным файла на момент завершения:
+        отчеты не зависят от того, что потом станет с файлом в библиотеке.
+        """
+        filament_used = print_stats.get('filament_used')
+        return {'print_duration': print_stats.get('print_duration'), 'filament_used': filament_used,
+                'filament_weight': self._filament_weight(job['filename'], filament_used),
+                'finished': finished}
+
+    def _filament_weight(self, filename, filament_used):
+        """Вес израсходованного филамента, г: длина по принтеру, плотность по метаданным файла"""
+        if not filament_used:
+            return None
+        metadata = (self.find_file(filename) or {}).get('metadata') or {}
+        weight, length = metadata.get('filament_weight'), metadata.get('filament_length')
+        if not weight or not length:
+            return None
+        return round(weight * filament_used / length, 2)
+
+
+def _queue_key(job):
+    return (PRIORITY_RANK.get(job.get('priority'), PRIORITY_RANK['normal']),
+            job.get('created') or '', job['id'])
+
+
+def _remaining_copies(job):
+    """Сколько копий еще нужно запустить"""
+    if job.get('status') != 'running':
+        return 0
+    used = sum(1 for c in job.get('copies', []) if c['status'] in ACTIVE_COPY_STATES + ('done',))
+    return max(0, int(job.get('quantity') or 1) - used)
+
+
+def _print_progress(status):
+    """Прогресс печати в целых процентах по virtual_sdcard (None - нет данных)
+
+    Целые проценты ограничивают запись задания сотней изменений на копию.
+    """
+    progress = (status.get('virtual_sdcard') or {}).get('progress')
+    return int(progress * 100) if progress is not None else None
+
+
+def _refresh_job_counters(job, max_retries):
+    """Пересчет files_printed, progress и итогового статуса задания по копиям
+
+    Прогресс задания - доля напечатанного по всем копиям: завершенные копии
+    считаются целиком, печатающиеся - по своему прогрессу (не больше 99%).
+    """
+    copies = job.get('copies', [])
+    quantity = int(job.get('quantity') or 1)
+    done = sum(1 for c in copies if c['status'] == 'done')
+    retries = sum(1 for c in copies if c['status'] in ('failed', 'cancelled'))
+    active = any(c['status'] in ACTIVE_COPY_STATES for c in copies)
+    printing = sum(min(c.get('progress') or 0, 99) for c in copies if c['status'] in ACTIVE_COPY_STATES)
+
+    job['files_printed'] = done
+    job['progress'] = min(100, int((done * 100 + printing) / quantity))
+    if active or job['status'] not in ('running', 'paused'):
+        return
+    if done >= quantity:
+        job['status'] = 'completed'
+        job['completed'] = datetime.now().isoformat()
+    elif retries > max_retries:
+        job['status'] = 'failed'
+        job['completed'] = datetime.now().isoformat()
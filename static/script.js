@@ -6,6 +6,11 @@ class PrinterManager {
         this.currentView = 'grid';
         this.statusFilter = 'all';
         this.updateInterval = null;
+        this.statusVersion = null;
+        this.statusStream = null;
+        this.webcamInterval = null;
+        this.forecast = null;
+        this.forecastInterval = null;
         this.init();
     }
 
@@ -13,9 +18,34 @@ class PrinterManager {
         this.setupEventListeners();
         await this.loadPrinters();
         this.startStatusUpdates();
+        this.startWebcamRefresh();
+        this.startForecastRefresh();
         this.updateCounters();
     }
 
+    startForecastRefresh() {
+        // Прогноз по модели времени печати меняется медленно: раз в минуту достаточно
+        this.loadForecast();
+        if (this.forecastInterval) clearInterval(this.forecastInterval);
+        this.forecastInterval = setInterval(() => {
+            if (!document.hidden) this.loadForecast();
+        }, 60000);
+    }
+
+    async loadForecast() {
+        try {
+            const response = await fetch('/api/forecast');
+            this.forecast = await response.json();
+        } catch (error) {
+            console.error('Ошибка загрузки прогноза:', error);
+        }
+        return this.forecast;
+    }
+
+    formatEta(isoTime) {
+        return isoTime ? new Date(isoTime).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' }) : '—';
+    }
+
     setupEventListeners() {
         // Навигация
         document.querySelectorAll('.nav-item').forEach(item => {
@@ -120,6 +150,8 @@ class PrinterManager {
         try {
             const response = await fetch('/api/printers');
             this.printers = await response.json();
+            // Новый список принтеров без статусов: следующий опрос вернет полный снимок
+            this.statusVersion = null;
             this.renderPrinters();
         } catch (error) {
             console.error('Ошибка загрузки принтеров:', error);
@@ -196,7 +228,7 @@ class PrinterManager {
 
     async getPrinterStatus(printerId) {
         try {
-            const response = await fetch(`/api/printers/${printerId}/status`);
+            const response = await fetch(`/api/printers/${printerId}/status?format=compact`);
             return await response.json();
         } catch (error) {
             console.error('Ошибка получения статуса принтера:', error);
@@ -204,18 +236,94 @@ class PrinterManager {
         }
     }
 
-    async startStatusUpdates() {
+    async getFleetStatus() {
+        // Один запрос на весь парк: сервер отдает только изменившиеся статусы
+        const params = '?format=compact' + (this.statusVersion ? `&since=${encodeURIComponent(this.statusVersion)}` : '');
+        const headers = this.statusVersion ? { 'If-None-Match': `"${this.statusVersion}"` } : {};
+        try {
+            const response = await fetch(`/api/printers/status${params}`, { headers });
+            if (response.status === 304) {
+                return {};
+            }
+            const data = await response.json();
+            this.statusVersion = data.version;
+            return data.printers || {};
+        } catch (error) {
+            console.error('Ошибка получения статуса принтеров:', error);
+            return {};
+        }
+    }
+
+    startWebcamRefresh() {
+        // Карточки показывают кэшированные снимки камер вместо живых потоков
+        if (this.webcamInterval) clearInterval(this.webcamInterval);
+        this.webcamInterval = setInterval(() => {
+            if (document.hidden) return;
+            document.querySelectorAll('img[data-webcam]').forEach(img => {
+                img.src = `/api/printers/${img.dataset.webcam}/webcam/thumbnail.jpg?t=${Date.now()}`;
+            });
+        }, 5000);
+    }
+
+    startStatusUpdates() {
+        // Push-обновления через Server-Sent Events, опрос - только как запасной вариант
+        if (!window.EventSource) {
+            this.startStatusPolling();
+            return;
+        }
+
+        this.statusStream = new EventSource('/api/printers/stream?format=compact');
+        this.statusStream.addEventListener('snapshot', (e) => {
+            const data = JSON.parse(e.data);
+            this.statusVersion = data.version;
+            for (const printer of this.printers) {
+                if (data.printers[printer.id]) {
+                    this.setCompactStatus(printer, data.printers[printer.id]);
+                    this.updatePrinterCard(printer);
+                }
+            }
+            this.updateCounters();
+        });
+        this.statusStream.addEventListener('delta', (e) => {
+            const data = JSON.parse(e.data);
+            this.statusVersion = data.version;
+            for (const [printerId, delta] of Object.entries(data.printers)) {
+                const printer = this.printers.find(p => p.id === printerId);
+                if (printer && delta) {
+                    this.updatePrinterCard(printer, delta);
+                }
+            }
+            this.updateCounters();
+        });
+        this.statusStream.onopen = () => this.stopStatusPolling();
+        // EventSource переподключается сам, до этого статус берется опросом
+        this.statusStream.onerror = () => this.startStatusPolling();
+    }
+
+    startStatusPolling() {
+        if (this.updateInterval) {
+            return;
+        }
         // Обновление статуса каждые 5 секунд
         this.updateInterval = setInterval(async () => {
+            const statuses = await this.getFleetStatus();
             for (const printer of this.printers) {
-                const status = await this.getPrinterStatus(printer.id);
-                printer.status = status;
-                this.updatePrinterCard(printer);
+                if (statuses[printer.id]) {
+                    this.setCompactStatus(printer, statuses[printer.id]);
+                    this.updatePrinterCard(printer);
+                }
             }
             this.updateCounters();
         }, 5000);
     }
 
+    stopStatusPolling() {
+        if (this.updateInterval) {
+            clearInterval(this.updateInterval);
+            this.updateInterval = null;
+        }
+    }
+
     renderPrinters() {
         const container = document.getElementById('printers-container');
         container.innerHTML = '';
@@ -285,7 +393,7 @@ class PrinterManager {
             
             <div class="printer-webcam">
                 ${status.online ? 
-                    `<img src="${printer.webcam_url}" alt="Веб-камера ${printer.name}" onerror="this.parentElement.innerHTML='<div class=\\'no-image\\'>Нет изображения</div>'">` :
+                    `<img src="/api/printers/${printer.id}/webcam/thumbnail.jpg" data-webcam="${printer.id}" alt="Веб-камера ${printer.name}" onerror="this.parentElement.innerHTML='<div class=\\'no-image\\'>Нет изображения</div>'">` :
                     '<div class="no-image">Принтер недоступен</div>'
                 }
             </div>
@@ -316,6 +424,7 @@ class PrinterManager {
         const progress = printStats.progress || 0;
         const timeLeft = this.formatTime(printStats.print_duration || 0);
         const layers = `${printStats.info?.current_layer || 0}/${printStats.info?.total_layer || 0}`;
+        const freeAt = this.forecast?.printers?.[printer.id]?.free_at;
 
         return `
             <div class="print-info">
@@ -333,7 +442,7 @@ class PrinterManager {
                     </div>
                     <div class="print-stats">
                         <span>Слои: ${layers}</span>
-                        <span>${new Date().toLocaleString()}</span>
+                        <span>${freeAt ? `Освободится ~${this.formatEta(freeAt)}` : new Date().toLocaleString()}</span>
                     </div>
                 </div>
             </div>
@@ -362,6 +471,13 @@ class PrinterManager {
                 </button>
             `);
         } else {
+            if (printStats.state === 'complete' || printStats.state === 'cancelled') {
+                buttons.push(`
+                    <button class="action-btn btn-secondary" onclick="printerManager.markPrinterReady('${printer.id}')" title="Стол очищен, принтер готов к следующей копии задания">
+                        <i class="fas fa-check"></i> Стол очищен
+                    </button>
+                `);
+            }
             buttons.push(`
                 <button class="action-btn btn-primary" onclick="printerManager.showStartPrintModal('${printer.id}')">
                     <i class="fas fa-play"></i> Запустить
@@ -456,6 +572,24 @@ class PrinterManager {
         }
     }
 
+    async markPrinterReady(printerId) {
+        try {
+            const response = await fetch(`/api/printers/${printerId}/ready`, {
+                method: 'POST'
+            });
+            const result = await response.json();
+
+            if (result.success) {
+                this.showNotification('Принтер готов к следующей печати', 'success');
+            } else {
+                this.showNotification(result.error || 'Ошибка сброса состояния', 'error');
+            }
+        } catch (error) {
+            console.error('Ошибка сброса состояния принтера:', error);
+            this.showNotification('Ошибка сброса состояния', 'error');
+        }
+    }
+
     async toggleLight(printerId) {
         try {
             const response = await fetch(`/api/printers/${printerId}/light/toggle`, {
@@ -623,17 +757,17 @@ class PrinterManager {
 
     async showStartPrintModal(printerId) {
         try {
-            const response = await fetch(`/api/printers/${printerId}/files`);
-            const files = await response.json();
+            const response = await fetch(`/api/printers/${printerId}/files?sort=path&limit=1000`);
+            const page = await response.json();
             
             const select = document.getElementById('print-file');
             select.innerHTML = '<option value="">Выберите файл</option>';
             
-            files.forEach(file => {
-                if (file.pathname.endsWith('.gcode') || file.pathname.endsWith('.3mf')) {
+            page.files.forEach(file => {
+                if (file.path.endsWith('.gcode') || file.path.endsWith('.3mf')) {
                     const option = document.createElement('option');
-                    option.value = file.pathname;
-                    option.textContent = file.pathname.split('/').pop();
+                    option.value = file.path;
+                    option.textContent = file.path.split('/').pop();
                     select.appendChild(option);
                 }
             });
@@ -679,7 +813,7 @@ class PrinterManager {
         const printer = this.printers.find(p => p.id === printerId);
         if (!printer) return;
 
-        const status = await this.getPrinterStatus(printerId);
+        const status = this.expandStatus(await this.getPrinterStatus(printerId));
         
         document.getElementById('detail-printer-name').textContent = printer.name;
         document.getElementById('detail-printer-id').textContent = printer.id;
@@ -688,7 +822,7 @@ class PrinterManager {
         
         const webcamImg = document.getElementById('detail-webcam');
         if (status.online) {
-            webcamImg.src = printer.webcam_url;
+            webcamImg.src = `/api/printers/${printer.id}/webcam/stream`;
         } else {
             webcamImg.src = '';
             webcamImg.alt = 'Принтер недоступен';
@@ -703,20 +837,25 @@ class PrinterManager {
             document.getElementById('detail-bed-temp').textContent = `${Math.round(bedTemp)}°C`;
         }
 
-        // Файлы
+        // Файлы: последние измененные из кэша сервера (в статусе только версия списка)
         const filesList = document.getElementById('detail-files-list');
         filesList.innerHTML = '';
         
-        if (status.files) {
-            status.files.forEach(file => {
-                const fileItem = document.createElement('div');
-                fileItem.className = 'file-item';
-                fileItem.innerHTML = `
-                    <div class="file-name">${file.pathname.split('/').pop()}</div>
-                    <div class="file-size">${this.formatFileSize(file.size)}</div>
-                `;
-                filesList.appendChild(fileItem);
-            });
+        if (status.online) {
+            try {
+                const page = await (await fetch(`/api/printers/${printer.id}/files?limit=50`)).json();
+                (page.files || []).forEach(file => {
+                    const fileItem = document.createElement('div');
+                    fileItem.className = 'file-item';
+                    fileItem.innerHTML = `
+                        <div class="file-name">${file.path.split('/').pop()}</div>
+                        <div class="file-size">${this.formatFileSize(file.size)}</div>
+                    `;
+                    filesList.appendChild(fileItem);
+                });
+            } catch (error) {
+                console.error('Ошибка загрузки файлов:', error);
+            }
         }
 
         // Обработчик открытия веб-интерфейса принтера
@@ -736,17 +875,33 @@ class PrinterManager {
             return;
         }
 
+        const file = fileInput.files[0];
         const formData = new FormData();
-        formData.append('file', fileInput.files[0]);
         if (fileDescription) {
             formData.append('description', fileDescription);
         }
 
         try {
-            const response = await fetch('/api/files', {
-                method: 'POST',
-                body: formData
-            });
+            // Если такое содержимое уже есть в библиотеке, файл не передается повторно
+            let response = null;
+            const sha256 = await this.fileSha256(file);
+            if (sha256) {
+                formData.append('sha256', sha256);
+                formData.append('name', file.name);
+                response = await fetch('/api/files', {
+                    method: 'POST',
+                    body: formData
+                });
+                formData.delete('sha256');
+                formData.delete('name');
+            }
+            if (!response || response.status === 404) {
+                formData.append('file', file);
+                response = await fetch('/api/files', {
+                    method: 'POST',
+                    body: formData
+                });
+            }
             
             if (response.ok) {
                 const uploadedFile = await response.json();
@@ -771,21 +926,97 @@ class PrinterManager {
         }
     }
 
+    async fileSha256(file) {
+        // crypto.subtle доступен только в защищенном контексте (HTTPS или localhost)
+        if (!window.crypto || !window.crypto.subtle || file.name.toLowerCase().endsWith('.gz')) {
+            return null;
+        }
+        try {
+            const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+        } catch (error) {
+            return null;
+        }
+    }
+
     async refreshPrinterStatus(printerId) {
         const status = await this.getPrinterStatus(printerId);
         const printer = this.printers.find(p => p.id === printerId);
         if (printer) {
-            printer.status = status;
+            this.setCompactStatus(printer, status);
             this.updatePrinterCard(printer);
         }
     }
 
-    updatePrinterCard(printer) {
+    setCompactStatus(printer, compact) {
+        printer.compact = compact;
+        printer.status = this.expandStatus(compact);
+    }
+
+    expandStatus(compact) {
+        // Компактный статус сервера (?format=compact) в прежнем виде для отрисовки карточек
+        compact = compact || { online: false };
+        const temps = compact.temps || {};
+        const layer = compact.layer || [];
+        const temperature = {};
+        if (temps.extruder) temperature.extruder = { temperature: temps.extruder[0], target: temps.extruder[1] };
+        if (temps.bed) temperature.heater_bed = { temperature: temps.bed[0], target: temps.bed[1] };
+        return {
+            online: compact.online,
+            error: compact.error,
+            last_update: compact.last_update,
+            files_version: compact.files_version,
+            print_stats: compact.online ? {
+                state: compact.state,
+                filename: compact.filename || '',
+                progress: compact.progress,
+                print_duration: compact.duration,
+                filament_used: compact.filament,
+                message: compact.message,
+                info: { current_layer: layer[0], total_layer: layer[1] }
+            } : undefined,
+            temperature
+        };
+    }
+
+    updatePrinterCard(printer, delta = null) {
         const card = document.querySelector(`[data-printer-id="${printer.id}"]`);
-        if (card) {
-            const newCard = this.createPrinterCard(printer);
-            card.replaceWith(newCard);
+        if (delta) {
+            this.setCompactStatus(printer, this.applyStatusDelta(printer.compact || {}, delta));
+        }
+        if (!card) {
+            return;
+        }
+
+        // Прогресс и температуры обновляются на месте, без пересоздания карточки
+        // (пересоздание перезапускает поток веб-камеры)
+        const details = card.querySelector('.printer-details');
+        if (delta && details && this.isLiveOnlyDelta(delta)) {
+            details.innerHTML = this.renderPrintInfo(printer.status.print_stats || {}, printer);
+            return;
+        }
+
+        const newCard = this.createPrinterCard(printer);
+        card.replaceWith(newCard);
+    }
+
+    applyStatusDelta(target, delta) {
+        for (const [key, value] of Object.entries(delta)) {
+            if (value === null) {
+                delete target[key];
+            } else if (typeof value === 'object' && !Array.isArray(value) &&
+                       typeof target[key] === 'object' && target[key] !== null && !Array.isArray(target[key])) {
+                this.applyStatusDelta(target[key], value);
+            } else {
+                target[key] = value;
+            }
         }
+        return target;
+    }
+
+    isLiveOnlyDelta(delta) {
+        const liveFields = ['progress', 'duration', 'filament', 'layer', 'temps', 'last_update'];
+        return Object.keys(delta).every(key => liveFields.includes(key));
     }
 
     getFilteredPrinters() {
@@ -928,6 +1159,10 @@ class PrinterManager {
 
     hideModal(modalId) {
         document.getElementById(modalId).classList.remove('show');
+        if (modalId === 'printer-details-modal') {
+            // Закрываем поток камеры, чтобы сервер мог отключиться от нее
+            document.getElementById('detail-webcam').src = '';
+        }
     }
 
     showNotification(message, type = 'info') {
@@ -1136,17 +1371,31 @@ class PrinterManager {
         const size = this.formatFileSize(file.size);
         const modified = new Date(file.modified || file.uploaded).toLocaleDateString();
         const description = file.description ? `<div class="file-description">${file.description}</div>` : '';
+        const metadata = file.metadata || {};
+        const preview = metadata.thumbnails && metadata.thumbnails.length
+            ? `<img class="file-thumbnail" src="/api/files/${file.id}/thumbnail" alt="">`
+            : `<i class="${icon}"></i>`;
+        const metaParts = [];
+        if (metadata.estimated_time) metaParts.push(`<i class="fas fa-clock"></i> ${this.formatDuration(metadata.estimated_time)}`);
+        if (metadata.filament_weight) metaParts.push(`${metadata.filament_weight.toFixed(1)} г`);
+        else if (metadata.filament_length) metaParts.push(`${(metadata.filament_length / 1000).toFixed(2)} м`);
+        if (metadata.layer_count) metaParts.push(`${metadata.layer_count} слоев`);
+        const meta = metaParts.length ? `<div class="file-meta">${metaParts.join(' • ')}</div>` : '';
 
         div.innerHTML = `
             <div class="file-icon">
-                <i class="${icon}"></i>
+                ${preview}
             </div>
             <div class="file-content">
                 <div class="file-name">${file.name}</div>
                 <div class="file-info">${size} • ${modified}</div>
+                ${meta}
                 ${description}
             </div>
             <div class="file-actions">
+                <button class="file-action-btn" onclick="printerManager.distributeFile('${file.id}')" title="Отправить на выбранные принтеры">
+                    <i class="fas fa-share-square"></i>
+                </button>
                 <button class="file-action-btn" onclick="printerManager.downloadFile('${file.id}')" title="Скачать">
                     <i class="fas fa-download"></i>
                 </button>
@@ -1159,6 +1408,12 @@ class PrinterManager {
         return div;
     }
 
+    formatDuration(seconds) {
+        const minutes = Math.round(seconds / 60);
+        const hours = Math.floor(minutes / 60);
+        return hours ? `${hours}ч ${String(minutes % 60).padStart(2, '0')}м` : `${minutes}м`;
+    }
+
     getFileIcon(type) {
         const icons = {
             'gcode': 'fas fa-cube',
@@ -1173,7 +1428,7 @@ class PrinterManager {
     // Загрузка заданий
     async loadJobs() {
         try {
-            const response = await fetch('/api/jobs');
+            const [response] = await Promise.all([fetch('/api/jobs'), this.loadForecast()]);
             const jobs = await response.json();
             this.renderJobs(jobs);
         } catch (error) {
@@ -1202,6 +1457,10 @@ class PrinterManager {
         const statusClass = this.getJobStatusClass(job.status);
         const printers = job.printers.map(p => `<span class="printer-tag">${p}</span>`).join('');
         const created = new Date(job.created).toLocaleDateString();
+        const eta = this.forecast?.jobs?.[job.id];
+        const etaText = eta?.eta
+            ? `~${this.formatEta(eta.eta)}` + (eta.eta_low ? ` (${this.formatEta(eta.eta_low)}–${this.formatEta(eta.eta_high)})` : '')
+            : '—';
 
         div.innerHTML = `
             <div class="job-header">
@@ -1218,8 +1477,9 @@ class PrinterManager {
                     <strong>Приоритет:</strong> ${this.getPriorityText(job.priority)}
                 </div>
                 <div class="job-info">
-                    <strong>Прогресс:</strong> ${job.progress}%<br>
+                    <strong>Прогресс:</strong> ${job.progress}% (${job.files_printed || 0}/${job.quantity} шт.)<br>
                     <strong>Время:</strong> ${job.estimated_time}<br>
+                    ${eta ? `<strong>Окончание:</strong> ${etaText}<br>` : ''}
                     <strong>Материал:</strong> ${job.material}
                 </div>
             </div>
@@ -1238,7 +1498,9 @@ class PrinterManager {
         const classes = {
             'pending': 'pending',
             'running': 'running',
+            'paused': 'pending',
             'completed': 'completed',
+            'cancelled': 'failed',
             'failed': 'failed'
         };
         return classes[status] || 'pending';
@@ -1248,7 +1510,9 @@ class PrinterManager {
         const texts = {
             'pending': 'Ожидает',
             'running': 'Выполняется',
+            'paused': 'Приостановлено',
             'completed': 'Завершено',
+            'cancelled': 'Отменено',
             'failed': 'Ошибка'
         };
         return texts[status] || 'Неизвестно';
@@ -1387,37 +1651,38 @@ class PrinterManager {
         const container = document.getElementById('printer-performance');
         if (!container) return;
 
-        // Prepare data for chart
-        const printersData = [];
-        for (const printer of this.printers) {
-            if (printer.status?.online) {
-                const printStats = printer.status.print_stats || {};
-                printersData.push({
-                    name: printer.name,
-                    completed: printStats.total_duration || 0,
-                    failed: printStats.filament_used || 0
-                });
-            }
-        }
+        // Доля времени онлайн и в печати за неделю по истории телеметрии
+        const response = await fetch('/api/telemetry/summary?hours=168');
+        const summary = await response.json();
+        const printersData = this.printers
+            .filter(printer => summary[printer.id])
+            .map(printer => ({ name: printer.name, ...summary[printer.id] }));
 
-        // Sort by completed prints
-        printersData.sort((a, b) => b.completed - a.completed);
+        // Самые загруженные принтеры - первыми
+        printersData.sort((a, b) => b.utilization - a.utilization);
 
-        // Create chart canvas
-        container.innerHTML = '<canvas id="performance-chart" width="400" height="300"></canvas>';
+        container.innerHTML = `
+            <canvas id="performance-chart" width="400" height="300"></canvas>
+            <canvas id="utilization-chart" width="400" height="200"></canvas>
+        `;
 
-        // Initialize chart
         const ctx = document.getElementById('performance-chart').getContext('2d');
         new Chart(ctx, {
             type: 'bar',
             data: {
                 labels: printersData.map(p => p.name),
                 datasets: [{
-                    label: 'Время печати (часы)',
-                    data: printersData.map(p => (p.completed / 3600).toFixed(1)),
+                    label: 'В печати, %',
+                    data: printersData.map(p => p.utilization),
                     backgroundColor: 'rgba(54, 162, 235, 0.5)',
                     borderColor: 'rgba(54, 162, 235, 1)',
                     borderWidth: 1
+                }, {
+                    label: 'Онлайн, %',
+                    data: printersData.map(p => p.uptime),
+                    backgroundColor: 'rgba(75, 192, 192, 0.5)',
+                    borderColor: 'rgba(75, 192, 192, 1)',
+                    borderWidth: 1
                 }]
             },
             options: {
@@ -1425,14 +1690,54 @@ class PrinterManager {
                 scales: {
                     y: {
                         beginAtZero: true,
+                        max: 100,
                         title: {
                             display: true,
-                            text: 'Часы'
+                            text: '% времени за 7 дней'
                         }
                     }
                 }
             }
         });
+
+        await this.loadUtilizationHistory();
+    }
+
+    async loadUtilizationHistory() {
+        // Доля печатающих принтеров во времени (среднее по парку)
+        const response = await fetch('/api/telemetry?hours=168&points=168&metrics=printing');
+        const history = await response.json();
+        const series = Object.values(history.series);
+        if (series.length === 0) return;
+
+        const times = series[0].t;
+        const fleet = times.map((_, i) => {
+            const values = series.map(s => s.printing[i]).filter(v => v !== null);
+            return values.length ? Math.round(values.reduce((a, b) => a + b, 0) / values.length * 100) : null;
+        });
+
+        const ctx = document.getElementById('utilization-chart').getContext('2d');
+        new Chart(ctx, {
+            type: 'line',
+            data: {
+                labels: times.map(t => new Date(t * 1000).toLocaleString([], { weekday: 'short', hour: '2-digit' })),
+                datasets: [{
+                    label: 'Загрузка парка, %',
+                    data: fleet,
+                    borderColor: 'rgba(54, 162, 235, 1)',
+                    backgroundColor: 'rgba(54, 162, 235, 0.1)',
+                    fill: true,
+                    spanGaps: true,
+                    pointRadius: 0
+                }]
+            },
+            options: {
+                responsive: true,
+                scales: {
+                    y: { beginAtZero: true, max: 100 }
+                }
+            }
+        });
     }
 
     async loadMaterialUsage() {
@@ -1771,17 +2076,26 @@ class PrinterManager {
                 <div class="form-group">
                     <label for="report-type">Тип отчета</label>
                     <select id="report-type">
-                        <option value="printers">Статистика принтеров</option>
-                        <option value="jobs">История заданий</option>
+                        <option value="utilization">Загрузка принтеров</option>
+                        <option value="prints">Успешные и отмененные печати</option>
                         <option value="materials">Использование материалов</option>
+                        <option value="lead_times">Сроки выполнения заданий</option>
+                    </select>
+                </div>
+                <div class="form-group">
+                    <label for="report-days">Период</label>
+                    <select id="report-days">
+                        <option value="7">7 дней</option>
+                        <option value="30" selected>30 дней</option>
+                        <option value="90">90 дней</option>
+                        <option value="365">Год</option>
                     </select>
                 </div>
                 <div class="form-group">
                     <label for="export-format">Формат</label>
                     <select id="export-format">
-                        <option value="pdf">PDF</option>
+                        <option value="xlsx">Excel (XLSX)</option>
                         <option value="csv">CSV</option>
-                        <option value="json">JSON</option>
                     </select>
                 </div>
                 <div class="form-actions">
@@ -1808,23 +2122,18 @@ class PrinterManager {
         modal.querySelector('#generate-report').addEventListener('click', async () => {
             const reportType = document.getElementById('report-type').value;
             const exportFormat = document.getElementById('export-format').value;
+            const days = document.getElementById('report-days').value;
             
             try {
-                // В реальном приложении здесь будет вызов API
-                // const response = await fetch(`/api/reports/export?type=${reportType}&format=${exportFormat}`);
-                
-                // Создаем фиктивную ссылку для скачивания
-                const blob = new Blob([`Отчет типа ${reportType} в формате ${exportFormat}`], {type: 'text/plain'});
-                const url = URL.createObjectURL(blob);
+                // Файл отдается потоком: браузер скачивает его сам, без буфера в памяти страницы
                 const a = document.createElement('a');
-                a.href = url;
-                a.download = `report_${new Date().toISOString().slice(0,10)}.${exportFormat}`;
+                a.href = `/api/reports/export?type=${reportType}&format=${exportFormat}&days=${days}`;
+                a.download = '';
                 document.body.appendChild(a);
                 a.click();
                 document.body.removeChild(a);
-                URL.revokeObjectURL(url);
                 
-                this.showNotification('Отчет успешно сгенерирован', 'success');
+                this.showNotification('Отчет формируется', 'success');
                 document.body.removeChild(modal);
             } catch (error) {
                 console.error('Ошибка генерации отчета:', error);
@@ -1994,6 +2303,45 @@ class PrinterManager {
         }
     }
 
+    async distributeFile(fileId) {
+        const printers = Array.from(this.selectedPrinters);
+        if (printers.length === 0) {
+            this.showNotification('Выберите принтеры для отправки файла', 'error');
+            return;
+        }
+
+        try {
+            const response = await fetch(`/api/files/${fileId}/distribute`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ printers })
+            });
+            let task = await response.json();
+            if (!response.ok) {
+                this.showNotification(task.error || 'Ошибка отправки файла', 'error');
+                return;
+            }
+
+            this.showNotification(`Отправка ${task.filename} на ${printers.length} принтер(ов)...`, 'info');
+            while (!task.finished) {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                task = await (await fetch(`/api/files/distributions/${task.id}`)).json();
+            }
+
+            const results = Object.values(task.printers);
+            const failed = results.filter(r => r.status === 'failed').length;
+            const skipped = results.filter(r => r.status === 'skipped').length;
+            const done = results.length - failed - skipped;
+            this.showNotification(
+                `${task.filename}: загружено ${done}, уже на принтере ${skipped}, ошибок ${failed}`,
+                failed ? 'error' : 'success'
+            );
+        } catch (error) {
+            console.error('Ошибка отправки файла:', error);
+            this.showNotification('Ошибка отправки файла', 'error');
+        }
+    }
+
     async deleteFile(fileId) {
         if (!confirm('Вы уверены, что хотите удалить этот файл?')) {
             return;
@@ -0,0 +1,389 @@
+"""
+Хранилище данных F-CRM на базе SQLite (режим WAL)
+
+Каждая коллекция (принтеры, задания, файлы, пользователи) хранится в своей
+таблице: документ целиком в JSON, плюс индексируемые колонки id и status.
+Поиск по id/status и изменение одной записи не требуют чтения всей коллекции,
+а транзакции BEGIN IMMEDIATE защищают от потери записей при нескольких
+рабочих процессах. Журнал событий заданий (job_events) - отдельная таблица,
+в которую записи только добавляются.
+
+Поверх базы работает кэш в памяти процесса: каждая запись увеличивает счетчик
+версии коллекции в таблице meta, и чтение сверяет его со своей копией. Записи
+этого процесса применяются к кэшу сразу после фиксации транзакции, а изменения
+других процессов обнаруживаются по расхождению версии.
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import STORAGE_CACHE_RELOADS, STORAGE_OPERATION_SECONDS, STORAGE_TRANSACTION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+COLLECTIONS = ('printers', 'jobs', 'files', 'users', 'deliveries', 'analyses')
+
+
+class _CollectionCache:
+    """Копия коллекции в памяти: строки по id и индекс по статусу"""
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = {}
+        self.by_status = {}
+        for seq, item_id, status, data in rows:
+            self.put(item_id, seq, status, data)
+
+    def put(self, item_id, seq, status, data):
+        self.delete(item_id)
+        self.rows[item_id] = (seq, status, data)
+        self.by_status.setdefault(status, set()).add(item_id)
+
+    def delete(self, item_id):
+        row = self.rows.pop(item_id, None)
+        if row is not None:
+            self.by_status.get(row[1], set()).discard(item_id)
+
+    def items(self, status=None):
+        if status is None:
+            rows = self.rows.values()
+        else:
+            rows = (self.rows[item_id] for item_id in self.by_status.get(status, ()))
+        return [json.loads(data) for _, _, data in sorted(rows, key=lambda row: row[0])]
+
+
+class Storage:
+    """Доступ к коллекциям документов в SQLite"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._caches = {}
+        self._cache_lock = threading.Lock()
+        self._create_schema()
+
+    @property
+    def connection(self):
+        """Отдельное соединение на поток (sqlite3 не разделяет соединения между потоками)"""
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = conn
+            self._local.depth = 0
+            self._local.pending = {}
+        return conn
+
+    def _create_schema(self):
+        with self.transaction() as conn:
+            for collection in COLLECTIONS:
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {collection} (
+                        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                        id TEXT NOT NULL UNIQUE,
+                        status TEXT,
+                        data TEXT NOT NULL
+                    )
+                """)
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{collection}_status ON {collection}(status)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    time TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    data TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events(job_id, seq)")
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой на запись; вложенные вызовы входят во внешнюю"""
+        conn = self.connection
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        with STORAGE_TRANSACTION_SECONDS.time():
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.depth = 1
+            self._local.pending = {}
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                self._local.pending = {}
+                raise
+            finally:
+                self._local.depth = 0
+        self._apply_pending()
+
+    # Чтение
+
+    def all(self, collection, status=None):
+        """Все документы коллекции в порядке добавления (опционально с фильтром по статусу)"""
+        with STORAGE_OPERATION_SECONDS.time(collection=collection, operation='read'):
+            return self._all(collection, status)
+
+    def _all(self, collection, status):
+        if not self._local_depth():
+            return self._cache(collection).items(status)
+        if status is None:
+            rows = self.connection.execute(
+                f"SELECT data FROM {collection} ORDER BY seq").fetchall()
+        else:
+            rows = self.connection.execute(
+                f"SELECT data FROM {collection} WHERE status = ? ORDER BY seq",
+                (status,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, collection, item_id):
+        """Документ по id или None"""
+        with STORAGE_OPERATION_SECONDS.time(collection=collection, operation='read'):
+            return self._get(collection, item_id)
+
+    def _get(self, collection, item_id):
+        if not self._local_depth():
+            row = self._cache(collection).rows.get(item_id)
+            return json.loads(row[2]) if row else None
+        row = self.connection.execute(
+            f"SELECT data FROM {collection} WHERE id = ?", (item_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self, collection):
+        return len(self._cache(collection).rows)
+
+    def version(self, collection):
+        """Счетчик изменений коллекции (общий для всех процессов)"""
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (f"version:{collection}",)).fetchone()
+        return int(row[0]) if row else 0
+
+    # Кэш
+
+    def _local_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def _cache(self, collection):
+        """Актуальная копия коллекции (перечитывается, если ее изменил другой процесс)"""
+        version = self.version(collection)
+        with self._cache_lock:
+            cache = self._caches.get(collection)
+            if cache is not None and cache.version == version:
+                return cache
+        STORAGE_CACHE_RELOADS.inc(collection=collection)
+        rows = self.connection.execute(
+            f"SELECT seq, id, status, data FROM {collection} ORDER BY seq").fetchall()
+        cache = _CollectionCache(version, rows)
+        with self._cache_lock:
+            self._caches[collection] = cache
+        return cache
+
+    def _changed(self, collection, operation=None):
+        """Учет изменения в текущей транзакции: новая версия и операция для кэша"""
+        conn = self.connection
+        previous = self.version(collection)
+        conn.execute(
+            """INSERT INTO meta (key, value) VALUES (?, '1')
+               ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1""",
+            (f"version:{collection}",))
+        pending = self._local.pending.setdefault(
+            collection, {'from': previous, 'to': previous, 'operations': []})
+        pending['to'] = previous + 1
+        # None - операцию нельзя применить к кэшу, коллекция будет перечитана
+        pending['operations'].append(operation)
+
+    def _apply_pending(self):
+        """Применение зафиксированных изменений к кэшу (write-through)"""
+        pending, self._local.pending = self._local.pending, {}
+        with self._cache_lock:
+            for collection, change in pending.items():
+                cache = self._caches.get(collection)
+                if cache is None:
+                    continue
+                if cache.version != change['from'] or None in change['operations']:
+                    del self._caches[collection]
+                    continue
+                for operation in change['operations']:
+                    operation(cache)
+                cache.version = change['to']
+
+    def _row_written(self, collection, item):
+        seq = self.connection.execute(
+            f"SELECT seq FROM {collection} WHERE id = ?", (item['id'],)).fetchone()[0]
+        item_id, status, data = item['id'], item.get('status'), _dumps(item)
+        self._changed(collection, lambda cache: cache.put(item_id, seq, status, data))
+
+    # Запись
+
+    def insert(self, collection, item):
+        with STORAGE_OPERATION_SECONDS.time(collection=collection, operation='write'), \
+                self.transaction() as conn:
+            conn.execute(
+                f"INSERT INTO {collection} (id, status, data) VALUES (?, ?, ?)",
+                (item['id'], item.get('status'), _dumps(item)))
+            self._row_written(collection, item)
+        return item
+
+    def put(self, collection, item):
+        """Вставка или полная замена документа (порядок существующего сохраняется)"""
+        with STORAGE_OPERATION_SECONDS.time(collection=collection, operation='write'), \
+                self.transaction() as conn:
+            conn.execute(
+                f"""INSERT INTO {collection} (id, status, data) VALUES (?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET status = excluded.status, data = excluded.data""",
+                (item['id'], item.get('status'), _dumps(item)))
+            self._row_written(collection, item)
+        return item
+
+    def update(self, collection, item_id, fields):
+        """Изменение полей одного документа; возвращает новый документ или None"""
+        with self.transaction():
+            item = self.get(collection, item_id)
+            if item is None:
+                return None
+            item.update(fields)
+            item['id'] = item_id
+            self.put(collection, item)
+        return item
+
+    def delete(self, collection, item_id):
+        with STORAGE_OPERATION_SECONDS.time(collection=collection, operation='write'), \
+                self.transaction() as conn:
+            cursor = conn.execute(f"DELETE FROM {collection} WHERE id = ?", (item_id,))
+            if cursor.rowcount:
+                self._changed(collection, lambda cache: cache.delete(item_id))
+        return cursor.rowcount > 0
+
+    def replace_all(self, collection, items):
+        """Полная перезапись коллекции (совместимость со старыми save_*)"""
+        with STORAGE_OPERATION_SECONDS.time(collection=collection, operation='write'), \
+                self.transaction() as conn:
+            conn.execute(f"DELETE FROM {collection}")
+            conn.executemany(
+                f"INSERT INTO {collection} (id, status, data) VALUES (?, ?, ?)",
+                [(item['id'], item.get('status'), _dumps(item)) for item in items])
+            self._changed(collection)
+
+    def next_id(self, collection, prefix):
+        """Следующий идентификатор вида prefix-NNN (не повторяется после удалений)
+
+        Номер берется из счетчика в meta, который только растет; при первом
+        вызове счетчик начинается с наибольшего существующего номера.
+        Вызывайте в той же транзакции, что и вставку, иначе два процесса
+        могут получить один номер.
+        """
+        key = f"id:{collection}:{prefix}"
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            if row:
+                number = int(row[0])
+            else:
+                pattern = re.compile(rf"^{re.escape(prefix)}-(\d+)$")
+                number = max((int(match.group(1))
+                              for (item_id,) in conn.execute(f"SELECT id FROM {collection}")
+                              if (match := pattern.match(item_id))), default=0)
+            while True:
+                number += 1
+                item_id = f"{prefix}-{number:03d}"
+                # Записи, добавленные с явным id (миграция, replace_all), не перезаписываются
+                if not conn.execute(f"SELECT 1 FROM {collection} WHERE id = ?", (item_id,)).fetchone():
+                    break
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, str(number)))
+        return item_id
+
+    # Журнал заданий
+
+    def append_event(self, job_id, event, data=None):
+        """Запись в журнал событий задания (только добавление, в текущей транзакции)"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO job_events (job_id, time, event, data) VALUES (?, ?, ?, ?)",
+                (job_id, datetime.now().isoformat(), event, _dumps(data) if data is not None else None))
+        return cursor.lastrowid
+
+    def job_events(self, job_id=None, after=0, limit=500):
+        """События после seq=after в порядке записи (все задания, если job_id не указан)"""
+        query = "SELECT seq, job_id, time, event, data FROM job_events WHERE seq > ?"
+        params = [after]
+        if job_id is not None:
+            query += " AND job_id = ?"
+            params.append(job_id)
+        rows = self.connection.execute(query + " ORDER BY seq LIMIT ?", (*params, limit)).fetchall()
+        return [
+            {'seq': seq, 'job_id': job, 'time': time_, 'event': event,
+             'data': json.loads(data) if data is not None else None}
+            for seq, job, time_, event, data in rows
+        ]
+
+    # Блокировки
+
+    def acquire_lease(self, name, owner, ttl):
+        """Аренда роли (например, планировщика) одним процессом на ttl секунд
+
+        Возвращает True, если роль свободна, истекла или уже принадлежит owner.
+        """
+        key = f"lease:{name}"
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            if row:
+                holder, _, expires = row[0].rpartition('@')
+                if holder != owner and float(expires) > now:
+                    return False
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, f"{owner}@{now + ttl}"))
+        return True
+
+    # Миграция
+
+    def migrate_json(self, collection, json_path, default=None):
+        """Однократный перенос данных из JSON-файла в коллекцию
+
+        Если файла нет, коллекция заполняется записями default.
+        """
+        key = f"migrated:{collection}"
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return 0
+            items = default or []
+            if os.path.exists(json_path):
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    items = json.load(f) or []
+            for item in items:
+                self.put(collection, item)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, json_path))
+        if items:
+            logger.info(f"Перенесено {len(items)} записей из {json_path} в {collection}")
+        return len(items)
+
+
+def _dumps(item):
+    return json.dumps(item, ensure_ascii=False)
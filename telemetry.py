@@ -0,0 +1,365 @@
+"""
+История телеметрии принтеров: температуры, прогресс, доступность
+
+Сэмплы из кэша статусов раз в TELEMETRY_INTERVAL секунд записываются в
+отдельную базу SQLite (таблица samples_raw). Фоновый проход сворачивает их
+в средние по минутам и по 15 минут, а старые строки каждого уровня удаляются
+по своему сроку хранения. Запрос диапазона выбирает самый подробный уровень,
+который еще хранится и дает разумное число строк, и усредняет строки до
+нужного числа точек за один вызов numpy.bincount для всех принтеров сразу.
+
+Для отчетов за месяцы и годы те же сэмплы накапливаются в суммы по дням
+(telemetry_daily): каждый сэмпл прибавляется один раз, когда проходит свертку.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('online', 'printing', 'extruder', 'extruder_target', 'bed', 'bed_target', 'progress')
+
+# (таблица, шаг в секундах); raw - исходные сэмплы
+LEVELS = (('samples_raw', 0), ('samples_1m', 60), ('samples_15m', 900))
+
+
+def sample_from_status(status):
+    """Строка метрик из статуса принтера (None для отсутствующих значений)"""
+    status = status or {}
+    online = 1.0 if status.get('online') else 0.0
+    print_stats = status.get('print_stats') or {}
+    temperature = status.get('temperature') or {}
+    extruder = temperature.get('extruder') or {}
+    bed = temperature.get('heater_bed') or {}
+    progress = (status.get('virtual_sdcard') or {}).get('progress')
+    return (
+        online,
+        1.0 if online and print_stats.get('state') == 'printing' else 0.0,
+        extruder.get('temperature'),
+        extruder.get('target'),
+        bed.get('temperature'),
+        bed.get('target'),
+        progress * 100 if progress is not None else None,
+    )
+
+
+class TelemetryStore:
+    """Хранилище сэмплов с уровнями детализации"""
+
+    def __init__(self, path, retention=None):
+        self.path = path
+        # Срок хранения каждого уровня в секундах
+        self.retention = retention or {
+            'samples_raw': 24 * 3600,
+            'samples_1m': 14 * 24 * 3600,
+            'samples_15m': 365 * 24 * 3600,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._create_schema()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = conn
+        return conn
+
+    def _create_schema(self):
+        columns = ', '.join(f"{metric} REAL" for metric in METRICS)
+        for table, _ in LEVELS:
+            self.connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    printer_id TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    {columns},
+                    PRIMARY KEY (ts, printer_id)
+                ) WITHOUT ROWID
+            """)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS telemetry_meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Секунды наблюдения, онлайн и в печати по дням (локальная дата)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS telemetry_daily (
+                day TEXT NOT NULL,
+                printer_id TEXT NOT NULL,
+                seconds REAL NOT NULL,
+                online REAL NOT NULL,
+                printing REAL NOT NULL,
+                PRIMARY KEY (day, printer_id)
+            ) WITHOUT ROWID
+        """)
+
+    # Запись
+
+    def append(self, samples, ts=None):
+        """Добавление сэмплов {printer_id: status} с одной отметкой времени"""
+        ts = int(ts if ts is not None else time.time())
+        rows = [(printer_id, ts) + sample_from_status(status)
+                for printer_id, status in samples.items()]
+        placeholders = ', '.join('?' * (2 + len(METRICS)))
+        conn = self.connection
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO samples_raw VALUES ({placeholders})", rows)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def maintain(self, now=None, sample_interval=10):
+        """Свертка завершенных интервалов в следующий уровень и удаление старых строк"""
+        now = int(now if now is not None else time.time())
+        conn = self.connection
+        averages = ', '.join(f"AVG({metric})" for metric in METRICS)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for (source, _), (target, step) in zip(LEVELS, LEVELS[1:]):
+                key = f"rollup:{target}"
+                done = self._get_meta(key) or 0
+                # Сворачиваются только интервалы, в которые уже не придут новые сэмплы
+                until = now // step * step
+                if until <= done:
+                    continue
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO {target}
+                    SELECT printer_id, ts / {step} * {step} AS bucket, {averages}
+                    FROM {source}
+                    WHERE ts >= ? AND ts < ?
+                    GROUP BY printer_id, bucket
+                """, (done, until))
+                self._set_meta(key, until)
+
+            self._add_daily(now // LEVELS[1][1] * LEVELS[1][1], sample_interval)
+            for table, _ in LEVELS:
+                conn.execute(f"DELETE FROM {table} WHERE ts < ?", (now - self.retention[table],))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _add_daily(self, until, sample_interval):
+        """Прибавление к суммам по дням сэмплов, пришедших с прошлого прохода
+
+        При первом запуске суммы восстанавливаются по уже свернутым уровням,
+        чтобы отчеты охватывали всю сохраненную историю.
+        """
+        done = self._get_meta('rollup:telemetry_daily')
+        if done is None:
+            done = 0
+            for table, step in reversed(LEVELS[1:]):
+                watermark = min(self._get_meta(f"rollup:{table}") or 0, until)
+                self._add_daily_from(table, step, done, watermark)
+                done = max(done, watermark)
+        if until > done:
+            self._add_daily_from('samples_raw', sample_interval, done, until)
+            done = until
+        self._set_meta('rollup:telemetry_daily', done)
+
+    def _add_daily_from(self, source, weight, start, end):
+        if start >= end:
+            return
+        self.connection.execute(f"""
+            INSERT INTO telemetry_daily (day, printer_id, seconds, online, printing)
+            SELECT date(ts, 'unixepoch', 'localtime') AS day, printer_id,
+                   COUNT(*) * {weight}, TOTAL(online) * {weight}, TOTAL(printing) * {weight}
+            FROM {source}
+            WHERE ts >= ? AND ts < ?
+            GROUP BY day, printer_id
+            ON CONFLICT (day, printer_id) DO UPDATE SET
+                seconds = seconds + excluded.seconds,
+                online = online + excluded.online,
+                printing = printing + excluded.printing
+        """, (start, end))
+
+    def _get_meta(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM telemetry_meta WHERE key = ?", (key,)).fetchone()
+        return int(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO telemetry_meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def remove_printer(self, printer_id):
+        for table, _ in LEVELS + (('telemetry_daily', None),):
+            self.connection.execute(f"DELETE FROM {table} WHERE printer_id = ?", (printer_id,))
+
+    # Чтение
+
+    def _level_for(self, start, end, points, now):
+        """Самый грубый уровень, шаг которого не больше шага точки графика
+
+        Уровни, которые уже не хранят начало интервала, пропускаются.
+        """
+        resolution = max(1, end - start) / points
+        retained = [(table, step) for table, step in LEVELS
+                    if start >= now - self.retention[table]] or [LEVELS[-1]]
+        for table, step in reversed(retained):
+            if step <= resolution:
+                return table, step
+        return retained[0]
+
+    def _fetch(self, printer_ids, start, end, columns, points, sample_interval):
+        """Строки уровня для интервала; еще не свернутый хвост берется из samples_raw
+
+        Каждой строке дается вес - сколько секунд она представляет.
+        """
+        now = int(time.time())
+        table, step = self._level_for(start, end, points, now)
+        ranges = [(table, step or sample_interval, start, end)]
+        if step:
+            watermark = self._get_meta(f"rollup:{table}") or 0
+            if watermark < end:
+                ranges = [(table, step, start, min(end, watermark)),
+                          ('samples_raw', sample_interval, max(start, watermark), end)]
+
+        rows, weights = [], []
+        for source, weight, range_start, range_end in ranges:
+            if range_start >= range_end:
+                continue
+            sql = (f"SELECT printer_id, ts, {', '.join(columns)} FROM {source} "
+                   f"WHERE ts >= ? AND ts < ?")
+            params = [range_start, range_end]
+            if printer_ids:
+                sql += f" AND printer_id IN ({', '.join('?' * len(printer_ids))})"
+                params += list(printer_ids)
+            part = self.connection.execute(sql, params).fetchall()
+            rows += part
+            weights.append(np.full(len(part), float(weight)))
+        weights = np.concatenate(weights) if weights else np.zeros(0)
+        return table, rows, weights
+
+    def query(self, printer_ids, start, end, points=300, metrics=METRICS, sample_interval=10):
+        """Ряды метрик по принтерам, усредненные до points интервалов
+
+        Возвращает {'start', 'end', 'step', 'source', 'series': {printer_id:
+        {'t': [...], metric: [...]}}}; пустые интервалы - None.
+        """
+        start, end = int(start), int(end)
+        points = max(1, min(int(points), 5000))
+        metrics = [m for m in metrics if m in METRICS]
+        table, rows, weights = self._fetch(printer_ids, start, end, metrics, points, sample_interval)
+
+        step = max(1, end - start) / points
+        times = [int(start + step * i) for i in range(points)]
+        result = {'start': start, 'end': end, 'step': step, 'source': table, 'series': {}}
+        if not rows:
+            return result
+
+        names, printer_index, ts_values, values = _columns(rows, len(metrics))
+        bucket = np.minimum(((ts_values - start) / step).astype(np.int64), points - 1)
+        slot = printer_index * points + bucket
+        size = len(names) * points
+
+        series = {str(printer_id): {'t': times} for printer_id in names}
+        for column, metric in enumerate(metrics):
+            column_values = values[:, column]
+            present = ~np.isnan(column_values)
+            sums = np.bincount(slot[present], weights=column_values[present] * weights[present],
+                               minlength=size)
+            totals = np.bincount(slot[present], weights=weights[present], minlength=size)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = np.round(sums / totals, 2).reshape(len(names), points)
+            # NaN (нет данных) -> None в JSON
+            means = np.where(np.isnan(means), None, means).tolist()
+            for i, printer_id in enumerate(names):
+                series[str(printer_id)][metric] = means[i]
+        result['series'] = series
+        return result
+
+    def summary(self, start, end, printer_ids=None, sample_interval=10):
+        """Доля времени онлайн и в печати по принтерам за период, в процентах"""
+        start, end = int(start), int(end)
+        _, rows, weights = self._fetch(printer_ids, start, end, ('online', 'printing'), 200,
+                                       sample_interval)
+        if not rows:
+            return {}
+
+        names, printer_index, _, values = _columns(rows, 2)
+        totals = np.bincount(printer_index, weights=weights, minlength=len(names))
+        online = np.bincount(printer_index, weights=np.nan_to_num(values[:, 0]) * weights,
+                             minlength=len(names))
+        printing = np.bincount(printer_index, weights=np.nan_to_num(values[:, 1]) * weights,
+                               minlength=len(names))
+        return {
+            str(printer_id): {
+                'hours': round(float(totals[i]) / 3600, 1),
+                'uptime': round(float(online[i] / totals[i] * 100), 1),
+                'utilization': round(float(printing[i] / totals[i] * 100), 1),
+            }
+            for i, printer_id in enumerate(names)
+        }
+
+    def daily_totals(self, start_day, end_day):
+        """Суммы по дням за период (даты 'YYYY-MM-DD' включительно) по принтерам
+
+        Возвращает строки (printer_id, секунд наблюдения, онлайн, в печати).
+        """
+        return self.connection.execute("""
+            SELECT printer_id, SUM(seconds), SUM(online), SUM(printing)
+            FROM telemetry_daily
+            WHERE day >= ? AND day <= ?
+            GROUP BY printer_id
+            ORDER BY printer_id
+        """, (start_day, end_day)).fetchall()
+
+
+def _columns(rows, metric_count):
+    """Строки SQLite -> (id принтеров, индекс принтера, время, значения; None -> NaN)"""
+    columns = list(zip(*rows))
+    index = {}
+    printer_index = np.fromiter((index.setdefault(printer_id, len(index)) for printer_id in columns[0]),
+                                dtype=np.int64, count=len(rows))
+    ts_values = np.array(columns[1], dtype=np.int64)
+    values = np.array(columns[2:], dtype=np.float64).reshape(metric_count, len(rows)).T
+    return list(index), printer_index, ts_values, values
+
+
+class TelemetryRecorder:
+    """Фоновая запись сэмплов из кэша статусов (одним процессом - по аренде)"""
+
+    def __init__(self, store, storage, get_statuses, interval=10, maintain_interval=60):
+        self.store = store
+        self.storage = storage
+        self.get_statuses = get_statuses
+        self.interval = interval
+        self.maintain_interval = maintain_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        last_maintain = 0
+        while True:
+            started = time.monotonic()
+            try:
+                if self.storage.acquire_lease('telemetry', self.owner, ttl=self.interval * 3):
+                    statuses = self.get_statuses()
+                    if statuses:
+                        self.store.append(statuses)
+                    if started - last_maintain >= self.maintain_interval:
+                        self.store.maintain(sample_interval=self.interval)
+                        last_maintain = started
+            except Exception as e:
+                logger.error(f"Ошибка записи телеметрии: {str(e)}")
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
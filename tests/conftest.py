@@ -0,0 +1,71 @@
+"""
+Общие фикстуры тестов: временные базы и парк имитаций Moonraker
+
+Тесты запускаются из корня проекта: python -m pytest
+"""
+
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_moonraker import FakeFleet  # noqa: E402
+from storage import Storage  # noqa: E402
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return Storage(str(tmp_path / 'f-crm.db'))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FleetRunner:
+    """Парк имитаций в отдельном цикле asyncio; start/stop вызываются из теста"""
+
+    def __init__(self, count=1):
+        self.fleet = FakeFleet(count, base_port=free_port(), printing_fraction=0,
+                               update_interval=0.2)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.running = False
+
+    def url(self, index=0):
+        return f"http://127.0.0.1:{self.fleet.ports[index]}"
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout=10)
+
+    def start(self):
+        self.fleet.runners = []
+        self._call(self.fleet.start())
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self._call(self.fleet.stop())
+            self.running = False
+
+    def close(self):
+        self.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self.loop.close()
+
+
+@pytest.fixture
+def fake_fleet():
+    runner = FleetRunner()
+    runner.start()
+    yield runner
+    runner.close()
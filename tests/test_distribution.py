@@ -0,0 +1,113 @@
+import hashlib
+import time
+
+from distribution import FileDistributor
+from file_index import FileIndex
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.status_code = 200 if content is not None else 404
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class FakeClient:
+    """Скачивание файлов принтера: содержимое задается тестом"""
+
+    def __init__(self, files):
+        self.files = files
+        self.downloads = []
+
+    def get(self, path, **kwargs):
+        if not path.startswith('/server/files/gcodes/'):
+            return FakeResponse(None)
+        filename = path[len('/server/files/gcodes/'):]
+        self.downloads.append(filename)
+        return FakeResponse(self.files.get(filename))
+
+
+class FakePrinterManager:
+    """Менеджер принтеров без сети: файлы принтера - в кэше списка и в FakeClient"""
+
+    def __init__(self):
+        self.file_index = FileIndex()
+        self.clients = {}
+        self.uploaded = []
+
+    def get_printer(self, printer_id):
+        return {'id': printer_id}
+
+    def get_client(self, printer):
+        return self.clients.setdefault(printer['id'], FakeClient({}))
+
+    def get_uploads(self):
+        return []
+
+    def upload_library_file(self, printer_id, file_info, upload_id=None):
+        self.uploaded.append(printer_id)
+        return {'success': True}
+
+    def record_file(self, printer_id, path, size=None, modified=None):
+        pass
+
+
+def wait_finished(distributor, task):
+    for _ in range(100):
+        task = distributor.get_task(task['id'])
+        if task['finished']:
+            return task
+        time.sleep(0.02)
+    raise AssertionError('Рассылка не завершилась')
+
+
+CONTENT = b'G28\n' * 250
+FILE = {'id': 'file-001', 'name': 'part.gcode', 'sha256': hashlib.sha256(CONTENT).hexdigest(),
+        'size': len(CONTENT)}
+
+
+def test_file_already_on_printer_is_not_uploaded(storage):
+    manager = FakePrinterManager()
+    manager.file_index.replace('P-1', [{'path': 'part.gcode', 'size': 1000, 'modified': 5.0}])
+    manager.file_index.replace('P-2', [{'path': 'part.gcode', 'size': 999, 'modified': 5.0}])
+    manager.clients['P-1'] = FakeClient({'part.gcode': CONTENT})
+    distributor = FileDistributor(storage, manager)
+
+    task = wait_finished(distributor, distributor.distribute(FILE, ['P-1', 'P-2']))
+
+    assert task['printers']['P-1']['status'] == 'skipped'
+    assert manager.uploaded == ['P-2']
+    delivery = storage.get('deliveries', 'P-1:part.gcode')
+    assert (delivery['sha256'], delivery['size'], delivery['modified']) == (FILE['sha256'], 1000, 5.0)
+
+
+def test_same_size_with_other_content_is_uploaded(storage):
+    manager = FakePrinterManager()
+    manager.file_index.replace('P-1', [{'path': 'part.gcode', 'size': 1000, 'modified': 5.0}])
+    manager.clients['P-1'] = FakeClient({'part.gcode': b'G29\n' * 250})
+    distributor = FileDistributor(storage, manager)
+
+    task = wait_finished(distributor, distributor.distribute(FILE, ['P-1']))
+
+    assert task['printers']['P-1']['status'] == 'done'
+    assert manager.clients['P-1'].downloads == ['part.gcode']
+    assert manager.uploaded == ['P-1']
+    assert storage.get('deliveries', 'P-1:part.gcode')['sha256'] == FILE['sha256']
+
+
+def test_force_uploads_again(storage):
+    manager = FakePrinterManager()
+    manager.file_index.replace('P-1', [{'path': 'part.gcode', 'size': 1000, 'modified': 5.0}])
+    distributor = FileDistributor(storage, manager)
+
+    wait_finished(distributor, distributor.distribute(FILE, ['P-1'], force=True))
+    assert manager.uploaded == ['P-1']
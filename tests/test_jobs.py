@@ -0,0 +1,119 @@
+import pytest
+
+from jobs import InvalidTransition, JobConflict, JobNotFound, JobStore
+
+
+@pytest.fixture
+def jobs(storage):
+    store = JobStore(storage)
+    store.create({'id': 'job-001', 'name': 'Корпус', 'filename': 'case.gcode', 'quantity': 2,
+                  'status': 'pending', 'progress': 0, 'copies': []})
+    return store
+
+
+def test_create_sets_revision_and_logs_event(jobs):
+    job = jobs.get('job-001')
+    assert job['revision'] == 1
+    assert [e['event'] for e in jobs.events('job-001')] == ['created']
+
+
+def test_transition_bumps_revision_and_logs_status(jobs):
+    job = jobs.transition('job-001', 'running', {'started': '2026-01-01T10:00:00'})
+    assert job['status'] == 'running'
+    assert job['revision'] == 2
+    event = jobs.events('job-001')[-1]
+    assert event['event'] == 'status'
+    assert event['data'] == {'from': 'pending', 'to': 'running'}
+
+
+@pytest.mark.parametrize('status', ['paused', 'completed', 'failed'])
+def test_invalid_transition_from_pending_is_rejected(jobs, status):
+    with pytest.raises(InvalidTransition):
+        jobs.transition('job-001', status)
+    assert jobs.get('job-001')['status'] == 'pending'
+    assert jobs.get('job-001')['revision'] == 1
+
+
+def test_terminal_status_is_final(jobs):
+    jobs.transition('job-001', 'cancelled')
+    with pytest.raises(InvalidTransition):
+        jobs.transition('job-001', 'running')
+
+
+def test_stale_revision_is_a_conflict(jobs):
+    jobs.edit('job-001', {'name': 'Корпус v2'}, revision=1)
+    with pytest.raises(JobConflict) as error:
+        jobs.edit('job-001', {'name': 'Корпус v3'}, revision=1)
+    assert error.value.job['name'] == 'Корпус v2'
+    assert jobs.get('job-001')['revision'] == 2
+
+
+def test_change_without_effect_does_not_write(jobs):
+    job = jobs.modify('job-001', lambda job: None)
+    assert job['revision'] == 1
+    assert len(jobs.events('job-001')) == 1
+
+
+def test_exception_in_change_rolls_back(jobs):
+    def change(job):
+        job['name'] = 'Другое'
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        jobs.modify('job-001', change)
+    assert jobs.get('job-001')['name'] == 'Корпус'
+
+
+def test_copy_transitions_are_checked(jobs):
+    jobs.transition('job-001', 'running')
+
+    def add_copy(job):
+        job['copies'].append({'index': 0, 'printer_id': 'P-1', 'status': 'starting'})
+    jobs.modify('job-001', add_copy)
+
+    def finish(job):
+        job['copies'][0]['status'] = 'done'
+    with pytest.raises(InvalidTransition):
+        jobs.modify('job-001', finish)
+
+
+def test_edit_rejects_status_and_unknown_fields(jobs):
+    with pytest.raises(ValueError):
+        jobs.edit('job-001', {'status': 'running'})
+    with pytest.raises(ValueError):
+        jobs.edit('job-001', {'revision': 5, 'owner': 'x'})
+    with pytest.raises(ValueError):
+        jobs.edit('job-001', {'quantity': 0})
+
+
+def test_filename_is_fixed_after_start(jobs):
+    jobs.transition('job-001', 'running')
+    with pytest.raises(JobConflict):
+        jobs.edit('job-001', {'filename': 'other.gcode'})
+
+
+def test_missing_job(jobs):
+    with pytest.raises(JobNotFound):
+        jobs.transition('job-404', 'running')
+
+
+def test_finished_copy_event_carries_printer_totals(jobs):
+    jobs.transition('job-001', 'running')
+
+    def add_copy(job):
+        job['copies'].append({'index': 0, 'printer_id': 'P-1', 'status': 'starting',
+                              'started': '2026-01-01T10:00:00'})
+    jobs.modify('job-001', add_copy)
+
+    def printing(job):
+        job['copies'][0]['status'] = 'printing'
+    jobs.modify('job-001', printing)
+
+    def done(job):
+        job['copies'][0].update(status='done', finished='2026-01-01T12:00:00',
+                                print_duration=6900.0, filament_used=3100.0, filament_weight=9.2)
+    jobs.modify('job-001', done)
+
+    data = jobs.events('job-001')[-1]['data']
+    assert data['to'] == 'done'
+    assert (data['print_duration'], data['filament_used'], data['filament_weight']) == (6900.0, 3100.0, 9.2)
@@ -0,0 +1,94 @@
+import json
+import time
+
+import pytest
+import requests
+
+from file_index import FileIndex
+from moonraker import MoonrakerClient, MoonrakerSubscription, PrinterOffline
+
+
+def make_client(url):
+    return MoonrakerClient(url, timeout=2, connect_timeout=1, failure_threshold=2,
+                           min_backoff=0.3, max_backoff=1)
+
+
+def test_client_talks_to_fake_printer(fake_fleet):
+    client = make_client(fake_fleet.url())
+    response = client.get('/printer/info')
+    assert response.status_code == 200
+    assert response.json()['result']['hostname'] == 'fake-000'
+    assert client.state == 'closed'
+
+
+def test_breaker_opens_and_recovers(fake_fleet):
+    client = make_client(fake_fleet.url())
+    assert client.get('/printer/info').status_code == 200
+
+    fake_fleet.stop()
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            client.get('/printer/info')
+    assert client.state == 'open'
+
+    # Пока выключатель разомкнут, запросы до принтера не доходят
+    with pytest.raises(PrinterOffline):
+        client.get('/printer/info')
+
+    time.sleep(0.35)
+    assert client.state == 'half_open'
+    # Проверка доступности не удалась - задержка до следующей растет
+    with pytest.raises(PrinterOffline):
+        client.get('/printer/info')
+    assert client.state == 'open'
+    assert client.backoff > client.min_backoff
+
+    fake_fleet.start()
+    time.sleep(client.backoff + 0.05)
+    assert client.get('/printer/info').status_code == 200
+    assert client.state == 'closed'
+    assert client.failures == 0
+
+
+class FakeSocket:
+    """WebSocket, который отдает заданные сообщения и затем закрывается"""
+
+    def __init__(self, messages):
+        self.messages = [json.dumps(message) for message in messages]
+
+    def send(self, data):
+        pass
+
+    def recv(self):
+        return self.messages.pop(0) if self.messages else ''
+
+    def close(self):
+        pass
+
+
+def reconnect_delays(monkeypatch, messages, attempts=4):
+    subscription = MoonrakerSubscription('P-1', 'http://127.0.0.1:1', lambda *args: None, FileIndex(),
+                                         min_backoff=1, max_backoff=8)
+    monkeypatch.setattr('moonraker.websocket.create_connection',
+                        lambda url, timeout: FakeSocket(messages))
+    monkeypatch.setattr('moonraker.random.uniform', lambda low, high: 1.0)
+    delays = []
+
+    def wait(seconds):
+        delays.append(seconds)
+        if len(delays) >= attempts:
+            subscription._stop.set()
+        return subscription._stop.is_set()
+    monkeypatch.setattr(subscription._stop, 'wait', wait)
+    subscription._run()
+    return delays
+
+
+def test_subscription_backoff_grows_while_connections_drop_at_once(monkeypatch):
+    assert reconnect_delays(monkeypatch, []) == [1, 2, 4, 8]
+
+
+def test_subscription_backoff_resets_after_status(monkeypatch):
+    status = {'jsonrpc': '2.0', 'method': 'notify_status_update',
+              'params': [{'print_stats': {'state': 'standby'}}, 0]}
+    assert reconnect_delays(monkeypatch, [status]) == [1, 1, 1, 1]
@@ -0,0 +1,60 @@
+import pytest
+
+from reports import FleetReports
+from telemetry import TelemetryStore
+
+PERIOD = ('2026-01-01', '2026-01-31')
+
+
+@pytest.fixture
+def reports(storage, tmp_path):
+    telemetry = TelemetryStore(str(tmp_path / 'telemetry.db'))
+    return FleetReports(telemetry, storage)
+
+
+def print_job(storage, job_id, outcome='done', print_duration=5400.0):
+    """Записи журнала, которые оставляет одна копия задания и его завершение"""
+    storage.append_event(job_id, 'copy', {
+        'index': 0, 'printer_id': 'P-1', 'from': 'printing', 'to': outcome,
+        'started': '2026-01-10T09:00:00', 'finished': '2026-01-10T11:00:00',
+        'material': 'PETG', 'filename': 'part.gcode', 'print_duration': print_duration,
+        'filament_used': 4200.0, 'filament_weight': 12.5})
+    if outcome == 'done':
+        storage.append_event(job_id, 'status', {
+            'from': 'running', 'to': 'completed', 'created': '2026-01-10T08:00:00',
+            'started': '2026-01-10T09:00:00', 'completed': '2026-01-10T11:00:00'})
+
+
+def test_update_is_idempotent(storage, reports):
+    print_job(storage, 'job-001')
+    print_job(storage, 'job-002', outcome='failed', print_duration=1800.0)
+    storage.append_event('job-001', 'progress', {'progress': 50})
+
+    assert reports.update() == 3
+    assert reports.update() == 0
+
+    prints = list(reports.report('prints', *PERIOD))
+    assert prints[0]['done'] == 1 and prints[0]['failed'] == 1
+    assert prints[0]['print_hours'] == 2.0
+    materials = list(reports.report('materials', *PERIOD))
+    assert materials == [{'material': 'PETG', 'prints': 1, 'filament_g': 12.5,
+                          'filament_m': 4.2, 'print_hours': 1.5}]
+    lead_times = list(reports.report('lead_times', *PERIOD))
+    assert lead_times[0]['jobs'] == 1 and lead_times[0]['avg_lead_hours'] == 3.0
+
+
+def test_duration_falls_back_to_copy_timestamps(storage, reports):
+    print_job(storage, 'job-001', outcome='cancelled', print_duration=None)
+    assert reports.update() == 1
+    assert list(reports.report('prints', *PERIOD))[0]['print_hours'] == 2.0
+
+
+def test_second_instance_continues_from_saved_cursor(storage, reports):
+    print_job(storage, 'job-001')
+    assert reports.update() == 2
+
+    other = FleetReports(reports.telemetry_store, storage)
+    print_job(storage, 'job-002')
+    assert other.update() == 2
+    assert reports.update() == 0
+    assert list(reports.report('prints', *PERIOD))[0]['done'] == 2
@@ -0,0 +1,67 @@
+import pytest
+
+
+def test_nested_transaction_commits_with_outer(storage):
+    with storage.transaction():
+        storage.insert('printers', {'id': 'P-1', 'status': 'offline'})
+        with storage.transaction():
+            storage.insert('printers', {'id': 'P-2', 'status': 'offline'})
+        # Вложенная транзакция не фиксируется отдельно: снаружи записи еще не видны
+        assert storage.get('printers', 'P-2') is not None
+
+    assert [p['id'] for p in storage.all('printers')] == ['P-1', 'P-2']
+
+
+def test_error_in_nested_transaction_rolls_back_everything(storage):
+    version = storage.version('printers')
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.insert('printers', {'id': 'P-1'})
+            with storage.transaction():
+                storage.insert('printers', {'id': 'P-2'})
+                raise RuntimeError('boom')
+
+    assert storage.all('printers') == []
+    assert storage.version('printers') == version
+
+
+def test_cache_follows_writes_of_other_connections(storage, tmp_path):
+    from storage import Storage
+
+    other = Storage(storage.path)
+    storage.insert('jobs', {'id': 'job-001', 'status': 'pending'})
+    assert other.get('jobs', 'job-001')['status'] == 'pending'
+
+    other.update('jobs', 'job-001', {'status': 'running'})
+    assert storage.get('jobs', 'job-001')['status'] == 'running'
+    assert [j['id'] for j in storage.all('jobs', status='running')] == ['job-001']
+
+
+def test_next_id_is_not_reused_after_delete(storage):
+    with storage.transaction():
+        first = storage.next_id('jobs', 'job')
+        storage.insert('jobs', {'id': first})
+    with storage.transaction():
+        second = storage.next_id('jobs', 'job')
+        storage.insert('jobs', {'id': second})
+    assert (first, second) == ('job-001', 'job-002')
+
+    storage.delete('jobs', second)
+    assert storage.next_id('jobs', 'job') == 'job-003'
+
+
+def test_next_id_starts_after_existing_ids(storage):
+    storage.insert('users', {'id': 'user-007'})
+    storage.insert('users', {'id': 'admin-001'})
+    assert storage.next_id('users', 'user') == 'user-008'
+    # Запись с явным id, совпавшим со счетчиком, не перезаписывается
+    storage.insert('users', {'id': 'user-009'})
+    assert storage.next_id('users', 'user') == 'user-010'
+
+
+def test_next_id_rolls_back_with_transaction(storage):
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.next_id('files', 'file')
+            raise RuntimeError('boom')
+    assert storage.next_id('files', 'file') == 'file-001'
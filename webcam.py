@@ -0,0 +1,283 @@
+"""
+Прокси веб-камер принтеров
+
+К каждой камере держится не больше одного входящего MJPEG-соединения: кадры
+читаются в фоновом потоке, а все зрители получают последний кадр. Медленный
+зритель пропускает кадры, а не копит очередь. Снимки для сетки карточек
+отдаются из кэша и запрашиваются у камеры не чаще заданного интервала.
+"""
+
+import io
+import logging
+import threading
+import time
+
+import requests
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен - миниатюры отдаются в исходном размере
+    Image = None
+
+PIL_AVAILABLE = Image is not None
+
+logger = logging.getLogger(__name__)
+
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+READ_CHUNK_SIZE = 16 * 1024
+# Защита от потока без маркеров JPEG: буфер больше этого размера сбрасывается
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+BOUNDARY = 'frame'
+# Допустимая ширина миниатюры (?width= у thumbnail.jpg)
+THUMBNAIL_MIN_WIDTH = 16
+THUMBNAIL_MAX_WIDTH = 1920
+
+
+def snapshot_url(stream_url):
+    """Адрес снимка mjpg-streamer/crowsnest по адресу потока"""
+    if 'action=stream' in stream_url:
+        return stream_url.replace('action=stream', 'action=snapshot')
+    return None
+
+
+def multipart_part(frame):
+    """Часть multipart/x-mixed-replace с одним кадром"""
+    return (f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+            f"Content-Length: {len(frame)}\r\n\r\n").encode() + frame + b'\r\n'
+
+
+class CameraStream:
+    """Одна камера: фоновое чтение MJPEG и раздача кадров зрителям"""
+
+    def __init__(self, url, timeout=10, idle_timeout=10, snapshot_interval=1.0,
+                 thumbnail_width=320):
+        self.url = url
+        self.snapshot_url = snapshot_url(url)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.snapshot_interval = snapshot_interval
+        self.thumbnail_width = thumbnail_width
+
+        self.session = requests.Session()
+        self.frame = None
+        self.frame_seq = 0
+        self.frame_time = 0
+        self.viewers = 0
+        self.listeners = set()
+        self.last_viewer = 0
+        self.error = None
+        self.changed = threading.Condition()
+        self.snapshot_lock = threading.Lock()
+        self.thumbnails = {}
+        self._thread = None
+        self._closed = False
+
+    # Поток
+
+    def frames(self, max_fps=15):
+        """Генератор частей multipart/x-mixed-replace для одного зрителя"""
+        min_interval = 1.0 / max_fps if max_fps else 0
+        self.attach()
+        seq = 0
+        try:
+            while not self._closed:
+                with self.changed:
+                    self.changed.wait_for(
+                        lambda: self.frame_seq != seq or self._closed, timeout=self.timeout)
+                    if self.frame_seq == seq:
+                        # Поток чтения мог завершиться по простою прямо перед подключением
+                        self._ensure_reader()
+                        continue
+                    seq, frame = self.frame_seq, self.frame
+                yield multipart_part(frame)
+                if min_interval:
+                    time.sleep(min_interval)
+        finally:
+            self.detach()
+
+    def attach(self, listener=None):
+        """Подключение зрителя; listener() вызывается из потока чтения на каждый кадр"""
+        with self.changed:
+            self.viewers += 1
+            if listener is not None:
+                self.listeners.add(listener)
+            self._ensure_reader()
+
+    def detach(self, listener=None):
+        with self.changed:
+            self.viewers -= 1
+            self.listeners.discard(listener)
+            self.last_viewer = time.time()
+
+    def latest(self):
+        """Номер и содержимое последнего кадра"""
+        with self.changed:
+            self._ensure_reader()
+            return self.frame_seq, self.frame
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _ensure_reader(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._read_loop, name='webcam', daemon=True)
+            self._thread.start()
+
+    def _idle(self):
+        with self.changed:
+            return self.viewers == 0 and time.time() - self.last_viewer > self.idle_timeout
+
+    def _read_loop(self):
+        """Чтение входящего потока, пока есть зрители (с переподключением)"""
+        backoff = 1
+        while not self._closed and not self._idle():
+            try:
+                with self.session.get(self.url, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    self.error = None
+                    backoff = 1
+                    self._read_frames(response)
+            except Exception as e:
+                if not self.error:
+                    logger.error(f"Ошибка чтения камеры {self.url}: {str(e)}")
+                self.error = str(e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def _read_frames(self, response):
+        buffer = bytearray()
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            if self._closed or self._idle():
+                return
+            buffer += chunk
+            while True:
+                start = buffer.find(JPEG_START)
+                if start < 0:
+                    del buffer[:-1]
+                    break
+                end = buffer.find(JPEG_END, start + 2)
+                if end < 0:
+                    del buffer[:start]
+                    if len(buffer) > MAX_FRAME_SIZE:
+                        buffer.clear()
+                    break
+                self._publish(bytes(buffer[start:end + 2]))
+                del buffer[:end + 2]
+
+    def _publish(self, frame):
+        with self.changed:
+            self.frame = frame
+            self.frame_seq += 1
+            self.frame_time = time.time()
+            self.changed.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    # Снимки
+
+    def snapshot(self):
+        """Последний кадр не старше snapshot_interval (None, если камера недоступна)"""
+        if time.time() - self.frame_time <= self.snapshot_interval:
+            return self.frame
+        # Параллельные запросы ждут один запрос к камере
+        with self.snapshot_lock:
+            if time.time() - self.frame_time <= self.snapshot_interval:
+                return self.frame
+            try:
+                if self.snapshot_url:
+                    response = self.session.get(self.snapshot_url, timeout=self.timeout)
+                    response.raise_for_status()
+                    self._publish(response.content)
+                else:
+                    self._first_frame()
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                # Устаревший кадр лучше пустой карточки; повтор - не раньше интервала
+                self.frame_time = time.time()
+        return self.frame
+
+    def _first_frame(self):
+        """Один кадр из потока (для камер без адреса снимка)"""
+        with self.session.get(self.url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            seq = self.frame_seq
+            buffer = bytearray()
+            for chunk in response.iter_content(READ_CHUNK_SIZE):
+                buffer += chunk
+                start = buffer.find(JPEG_START)
+                end = buffer.find(JPEG_END, start + 2) if start >= 0 else -1
+                if end >= 0:
+                    self._publish(bytes(buffer[start:end + 2]))
+                    return
+                if len(buffer) > MAX_FRAME_SIZE or self.frame_seq != seq:
+                    return
+
+    def thumbnail(self, width=None):
+        """Уменьшенный снимок; пересчитывается только для нового кадра"""
+        width = width or self.thumbnail_width
+        self.snapshot()
+        with self.changed:
+            seq, frame = self.frame_seq, self.frame
+        if frame is None or not PIL_AVAILABLE:
+            return frame
+
+        cached = self.thumbnails.get(width)
+        if cached and cached[0] == seq:
+            return cached[1]
+
+        try:
+            image = Image.open(io.BytesIO(frame))
+            if image.width > width:
+                image.thumbnail((width, max(1, width * image.height // image.width)))
+            out = io.BytesIO()
+            image.convert('RGB').save(out, format='JPEG', quality=75)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # Оборванный или поврежденный кадр: отдается как есть, браузер покажет что сможет.
+            # Кадр запоминается вместо миниатюры, чтобы не разбирать его и не писать в лог
+            # на каждом запросе, пока камера не пришлет новый
+            logger.error(f"Ошибка уменьшения кадра камеры {self.url}: {str(e)}")
+            self.thumbnails = {width: (seq, frame)}
+            return frame
+        self.thumbnails = {width: (seq, out.getvalue())}
+        return out.getvalue()
+
+    def close(self):
+        self._closed = True
+        with self.changed:
+            self.changed.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+        self.session.close()
+
+
+class WebcamProxy:
+    """Реестр камер по принтерам"""
+
+    def __init__(self, **options):
+        self.options = options
+        self.cameras = {}
+        self.lock = threading.Lock()
+
+    def get(self, printer):
+        url = printer.get('webcam_url')
+        if not url:
+            return None
+        with self.lock:
+            camera = self.cameras.get(printer['id'])
+            if camera is None or camera.url != url:
+                if camera is not None:
+                    camera.close()
+                camera = CameraStream(url, **self.options)
+                self.cameras[printer['id']] = camera
+            return camera
+
+    def remove(self, printer_id):
+        with self.lock:
+            camera = self.cameras.pop(printer_id, None)
+        if camera is not None:
+            camera.close()